@@ -2,20 +2,42 @@
 3D-Scere app.
 """
 
+import collections
+import os
+import tempfile
+import threading
+import time
+import uuid
+
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
 import dash_bootstrap_components as dbc
 import dash_cytoscape as cyto
 import dash_table
-from dash.dependencies import Input, Output, State
+import flask
+from dash.dependencies import ClientsideFunction, Input, Output, State
 
-import networkx as nx
 import numpy as np
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
 
+import lib.api as api
+import lib.chromosomes as chromosomes
+import lib.crowding as crowding
+import lib.distance_decay as distance_decay
+import lib.distances as distances
+import lib.enrichment as enrichment
+import lib.ensembles as ensembles
+import lib.gene_lists as gene_lists
+import lib.genomes as genomes
+import lib.http_cache as http_cache
+import lib.intervals as intervals
+import lib.jobs as jobs
+import lib.metrics as metrics
+import lib.profiling as profiling
+import lib.spatial as spatial
 import lib.tools as tools
 import lib.visualization_2D as vis2D
 import lib.visualization_3D as vis3D
@@ -28,11 +50,105 @@ NAME = "3D-Scere"
 FONTAWESOME = "https://cdnjs.cloudflare.com/ajax/libs/font-awesome/4.7.0/css/font-awesome.min.css"
 LITERA = "https://cdn.jsdelivr.net/npm/bootswatch@4.5.2/dist/litera/bootstrap.min.css"
 
-GO_terms = pd.read_csv("./static/GO_terms.csv")
+#Genome bundles (directories with the layout of ./static), loaded on first use: the dashboard shows GENOME,
+#the API serves the other genomes of GENOMES_DIRECTORY with its genome parameter
+GENOME = os.getenv("GENOME", "SCERE")
+GENOMES_DIRECTORY = os.getenv("GENOMES_DIRECTORY")
+#Memory budget of the loaded genomes (MB), the least recently used are unloaded above it
+GENOMES_MEMORY = float(os.getenv("GENOMES_MEMORY", 4096))
+
+def load_genome_bundle(directory, metadata):
+    """Load the reference data of a genome bundle.
+
+    Parameters
+    ----------
+    directory : str
+        Bundle directory: SCERE.db, plotly_segments.csv, 3D_distances.parquet.gzip (computed from the segments if missing).
+    metadata : dict
+        Bundle description, chromosome_labels names the chromosomes of the figures.
+
+    Returns
+    -------
+    genomes.GenomeBundle
+        Features, GO membership, 3D segments and distances, crowding track, chromosomes layout, genomic distance decay, 3D models ensemble and their indexes.
+        The 3D distances, their summaries over all the pairs of loci, the spatial weights and the crowding track are computed when first read.
+    """
+    database = os.path.join(directory, genomes.DATABASE_FILE)
+    bundle = genomes.GenomeBundle()
+    bundle["chromosome_layout"] = vis2D.get_chromosome_layout(database, labels=metadata.get("chromosome_labels"))
+
+    bundle["plotly_segments"] = pd.read_csv(os.path.join(directory, genomes.SEGMENTS_FILE))
+    bundle["locus_centroids"] = spatial.get_locus_centroids(bundle["plotly_segments"])
+    bundle["spatial_index"] = spatial.build_spatial_index(bundle["locus_centroids"])
+    bundle.set_loader("spatial_weights", lambda bundle: spatial.get_spatial_weights(bundle["spatial_index"], k=SMOOTHING_NEIGHBOURS))
+
+    #3D crowding and radial position of the loci, precomputed by crowding_track.py (computed here if missing or of another model)
+    def load_crowding_track(bundle):
+        crowding_file = os.path.join(directory, genomes.CROWDING_FILE)
+        crowding_track = None
+        if os.path.exists(crowding_file):
+            crowding_track = pd.read_parquet(crowding_file, engine="pyarrow").set_index("Primary_SGDID").reindex(index=bundle["locus_centroids"].index,
+                                                                                                                 columns=crowding.TRACKS)
+        if crowding_track is None or crowding_track.isna().any(axis=None):
+            crowding_track = crowding.compute_crowding_track(bundle["locus_centroids"], bundle["spatial_index"])
+        return crowding_track
+    bundle.set_loader("crowding_track", load_crowding_track)
+
+    bundle["feature_name"] = tools.get_locus_info(database, SQL_QUERY)
+    bundle["interval_index"] = intervals.build_interval_index(bundle["feature_name"])
+    bundle["go_membership"] = enrichment.build_membership_matrix(tools.get_locus_info(database, enrichment.SQL_QUERY_GO))
+
+    #3D distance matrix, memory-mapped a pair of chromosome blocks at a time from a store in DISTANCES_CACHE written from
+    #the precomputed 3D distances, or from the segments when the file is not deployed (then the blocks are computed at their first read)
+    def load_distance_matrix(bundle):
+        return genomes.open_distance_matrix(os.path.join(directory, genomes.DISTANCES_FILE), os.path.join(directory, genomes.SEGMENTS_FILE),
+                                            bundle["feature_name"], method=os.getenv("DISTANCE_METHOD", "centroid"),
+                                            get_geometry=lambda: distances.get_locus_geometry(bundle["plotly_segments"], bundle["feature_name"]["Primary_SGDID"]))
+    bundle.set_loader("distance_sgdids", lambda bundle: load_distance_matrix(bundle)[0])
+    bundle.set_loader("distance_matrix", lambda bundle: load_distance_matrix(bundle)[1])
+
+    #Histogram and 3D distances between chromosome pairs of all the pairs of loci, read from the matrix a block at a time
+    bundle["X"] = np.linspace(0, 200, BIN_NUMBER + 1)
+    def load_histogram(bundle):
+        counts, _, pairs_number = distances.get_distance_histogram(bundle["distance_matrix"], bin_number=BIN_NUMBER, max_distance=200)
+        return counts/pairs_number
+    bundle.set_loader("H2", load_histogram)
+    bundle.set_loader("F2", lambda bundle: np.cumsum(bundle["H2"])/sum(bundle["H2"]))
+    bundle.set_loader("background_chromosome_distances",
+                      lambda bundle: chromosomes.get_matrix_chromosome_distances(bundle["distance_matrix"], bundle["distance_sgdids"], bundle["feature_name"],
+                                                                                 bundle["chromosome_layout"]["chromosome"].max()))
+
+    #Genomic distance decay of the 3D distances within chromosomes, precomputed by distance_decay.py or computed from the matrix
+    bundle.set_loader("distance_chromosomes", lambda bundle: distance_decay.get_locus_midpoints(bundle["feature_name"], bundle["distance_sgdids"])[0])
+    bundle.set_loader("distance_midpoints", lambda bundle: distance_decay.get_locus_midpoints(bundle["feature_name"], bundle["distance_sgdids"])[1])
+    def load_decay_bins(bundle):
+        decay_bins_file = os.path.join(directory, genomes.DECAY_BINS_FILE)
+        if os.path.exists(decay_bins_file):
+            return pd.read_csv(decay_bins_file)
+        return distance_decay.get_decay_bins(distance_decay.iter_cis_pairs(bundle["distance_matrix"], bundle["distance_chromosomes"],
+                                                                           bundle["distance_midpoints"]))
+    bundle.set_loader("decay_bins", load_decay_bins)
+    bundle.set_loader("decay_curves", lambda bundle: distance_decay.fit_decay_curves(bundle["decay_bins"]))
+
+    #Ensemble of 3D models written by build_ensemble.py: only the models list is read here, their stores are memory-mapped on first use
+    models_directory = os.path.join(directory, genomes.MODELS_DIRECTORY)
+    bundle["model_ensemble"] = ensembles.ModelEnsemble.open(models_directory) if os.path.isdir(models_directory) else None
+
+    return bundle
+
+genome_registry = genomes.GenomeRegistry(load_genome_bundle, max_bytes=GENOMES_MEMORY * 2**20)
+genome_registry.register("SCERE", "./static", organism="Saccharomyces cerevisiae", chromosome_labels=chromosomes.CHROMOSOME_LABELS)
+if GENOMES_DIRECTORY:
+    genome_registry.discover(GENOMES_DIRECTORY)
+genome_registry.pin(GENOME)
+
+GENOME_DIRECTORY = genome_registry.get_directory(GENOME)
+DATABASE = os.path.join(GENOME_DIRECTORY, genomes.DATABASE_FILE)
+
+GO_terms = pd.read_csv(os.path.join(GENOME_DIRECTORY, genomes.GO_TERMS_FILE))
 GO_terms_options = [{"label": GO, "value": GO} for GO in GO_terms["GO_terms"]]
 
-plotly_segments = pd.read_csv("./static/plotly_segments.csv")
-edges_list = pd.read_parquet("./static/3D_distances.parquet.gzip", engine="pyarrow")
+SMOOTHING_NEIGHBOURS = 10
 
 demo_1 = pd.read_csv("./example_data/gene_list_example_UPC2_38_targets.csv")
 demo_2 = pd.read_csv("./example_data/quantitative_variables_example.csv")
@@ -42,14 +158,75 @@ SQL_QUERY = \
 """SELECT Primary_SGDID, Standard_gene_name, Chromosome, Feature_name, Strand, Stop_coordinate, Start_coordinate, Description
 FROM SGD_features
 """
-all_feature_name = tools.get_locus_info("./static/SCERE.db", SQL_QUERY)
+
+# 3D compactness of the GO slim terms, computed by go_atlas.py
+GO_COMPACTNESS_FILE = os.path.join(GENOME_DIRECTORY, genomes.GO_COMPACTNESS_FILE)
+if os.path.exists(GO_COMPACTNESS_FILE):
+    go_compactness = pd.read_csv(GO_COMPACTNESS_FILE).dropna(subset=["p_value"])
+    go_compactness["FDR"] = enrichment.benjamini_hochberg(go_compactness["p_value"])
+    go_compactness = go_compactness.sort_values("z_score").round({"mean_distance": 2, "median_distance": 2, "null_mean": 2, "null_sd": 2, "z_score": 2, "p_value": 4, "FDR": 4})
+else:
+    go_compactness = None
 
 #3D distance histogram constants
 BIN_NUMBER = 50
-all_x = list(edges_list["3D_distances"])
-H2, X = np.histogram(all_x, bins=BIN_NUMBER, range=(0, 200))
-H2 = H2/len(all_x)
-F2 = np.cumsum(H2)/sum(H2)
+
+#3D distances of the Tab 3 histogram and network: the reference 3D model, or a statistic of the distances
+#across the models of the ensemble of the genome (if any)
+ENSEMBLE_AVAILABLE = os.path.isdir(os.path.join(GENOME_DIRECTORY, genomes.MODELS_DIRECTORY))
+distances_options_tab3 = [{"label": "Reference 3D model", "value": "reference"}]
+if ENSEMBLE_AVAILABLE:
+    distances_options_tab3 += [{"label": ensembles.STATISTIC_LABELS[statistic], "value": statistic} for statistic in ["mean", "sd", "min", "max"]]
+
+#Tab 3 genes lists states, updated incrementally when a list is edited (least recently used are dropped)
+LIST_STATES_SIZE = 32
+list_states = collections.OrderedDict()
+list_states_lock = threading.Lock()
+
+#Selections of the dashboard available for download, by selection key (least recently used are dropped)
+EXPORT_SELECTIONS_SIZE = 64
+export_selections = collections.OrderedDict()
+
+#Long computations run in background worker processes, polled by the dashboard
+job_executor = jobs.JobExecutor(os.getenv("JOBS_DIRECTORY") or tempfile.mkdtemp(prefix="3D-Scere_jobs_"),
+                                processes=int(os.getenv("JOB_PROCESSES", 2)),
+                                max_pending=int(os.getenv("JOB_QUEUE_SIZE", 8)))
+
+#Reference data of the API: the selections, then the bundle of the dashboard genome added by load_reference_data
+reference_data = collections.ChainMap({"selections": export_selections})
+
+#Reference data (features, GO membership, 3D segments and distances) loaded in a background thread started at the end of
+#this file, unless BACKGROUND_LOADING=0: the server answers at once, the callbacks and the API wait for the data
+BACKGROUND_LOADING = os.getenv("BACKGROUND_LOADING", "1") == "1"
+READY_TIMEOUT = float(os.getenv("READY_TIMEOUT", 300))
+#Pre-render the figures of the demo genes list once the data is loaded
+WARMUP = os.getenv("WARMUP", "0") == "1"
+reference_loaded = threading.Event()
+startup_status = {"status": "loading", "error": None, "started": time.time(), "loaded": None, "ready": None}
+
+def load_reference_data():
+    """Load the reference data of the dashboard genome into the module globals and share the data of the jobs with their workers."""
+    global plotly_segments, locus_centroids, spatial_index, spatial_weights, crowding_track, all_feature_name, interval_index, go_membership
+    global H2, X, F2, background_chromosome_distances, distance_sgdids, distance_matrix, chromosome_layout, model_ensemble
+
+    bundle = genome_registry.get(GENOME)
+    plotly_segments, locus_centroids = bundle["plotly_segments"], bundle["locus_centroids"]
+    spatial_index, spatial_weights, crowding_track = bundle["spatial_index"], bundle["spatial_weights"], bundle["crowding_track"]
+    all_feature_name, interval_index, go_membership = bundle["feature_name"], bundle["interval_index"], bundle["go_membership"]
+    H2, X, F2 = bundle["H2"], bundle["X"], bundle["F2"]
+    background_chromosome_distances = bundle["background_chromosome_distances"]
+    distance_sgdids, distance_matrix = bundle["distance_sgdids"], bundle["distance_matrix"]
+    chromosome_layout, model_ensemble = bundle["chromosome_layout"], bundle["model_ensemble"]
+
+    #The distance matrix is pickled as the directory of its store
+    for name in ["distance_matrix", "plotly_segments", "feature_name", "locus_centroids", "spatial_weights", "crowding_track"]:
+        job_executor.share_data(name, bundle[name])
+
+    #The API reads the bundle: its items not used by the dashboard (e.g. the genomic distance decay) are computed at their first request
+    reference_data.maps.append(bundle)
+
+# Tab 3 slider filtering runs in the browser unless CLIENTSIDE_THRESHOLD=0
+CLIENTSIDE_THRESHOLD = os.getenv("CLIENTSIDE_THRESHOLD", "1") == "1"
 
 basic_stylesheet = [{"selector": "node", "style": {"background-color": "#BFD7B5"}},
                     {"selector": "node", "style": {"label": "data(label)"}}]
@@ -58,11 +235,48 @@ colors = ["darkred", "red", "darkorange", "orange", "gold", "green",
 "mediumseagreen", "turquoise", "deepskyblue", "dodgerblue",
 "blueviolet", "purple", "magenta", "deeppink", "crimson", "black"]
 
-app = dash.Dash(name=NAME, assets_folder="./assets", external_stylesheets=[dbc.themes.LUX, LITERA])
+#3D figure of the chromosomes (JSON), built once the reference data is loaded
+chromosomes_figure_3D = None
+chromosomes_figure_3D_lock = threading.Lock()
+
+#Compression set up by http_cache: Dash only enables gzip
+app = dash.Dash(name=NAME, assets_folder="./assets", external_stylesheets=[dbc.themes.LUX, LITERA], compress=False)
 app.title = NAME
 app.config.suppress_callback_exceptions = True
 server = app.server
 
+# Brotli or gzip compression above COMPRESS_MIN_SIZE bytes, immutable versioned static files, ETags of the GET responses
+http_cache.instrument_server(server, min_size=int(os.getenv("COMPRESS_MIN_SIZE", 500)))
+
+# Per-callback timings (sql, figure, pandas and serialization stages), response sizes and cache hits at /metrics
+metrics.instrument_app(app)
+
+@server.route("/metrics")
+def get_metrics():
+    return flask.Response(metrics.get_metrics_text(), mimetype="text/plain; version=0.0.4")
+
+# Opt-in profiling of the requests with a X-Profile: 1 header or a ?profile=1 flag (PROFILING=sampling or cprofile)
+if os.getenv("PROFILING"):
+    profiling.instrument_server(server, os.getenv("PROFILING_DIRECTORY", "logs"),
+                                profiler="sampling" if os.getenv("PROFILING") == "1" else os.getenv("PROFILING"),
+                                memory=os.getenv("PROFILING_MEMORY") == "1")
+
+# REST API for programmatic queries (/api/genes, /api/distances, /api/neighbours, /api/coordinates, /api/go, /api/decay)
+server.register_blueprint(api.create_blueprint(reference_data, max_genes=int(os.getenv("API_MAX_GENES", 5000)), genomes=genome_registry))
+
+@server.route("/ready")
+def get_ready():
+    """Readiness: 200 once the reference data is loaded (and the figures pre-rendered with WARMUP=1), 503 before."""
+    status_code = {"ready": 200, "error": 500}.get(startup_status["status"], 503)
+    return flask.jsonify(startup_status), status_code
+
+@server.before_request
+def wait_reference_data():
+    # The callbacks, the figures and the API need the reference data, the layout and the assets do not
+    if flask.request.path.startswith(("/_dash-update-component", "/figures/", "/api/")):
+        if not reference_loaded.wait(READY_TIMEOUT) or startup_status["status"] == "error":
+            return flask.jsonify(startup_status), 503, {"Retry-After": "10"}
+
 ########################
 ############DASHBOARD_LAYOUT############
 ########################
@@ -72,7 +286,7 @@ server = app.server
 header = html.Div(
         [dbc.Row(
             [
-                html.Img(src="./static/yeast_icon.png", height="70px"),
+                html.Img(src=http_cache.get_versioned_url("./static/yeast_icon.png"), height="70px"),
                 html.H1("3D-Scere", style={"padding-left": "2%", "padding-top": "1%"})
             ])
         ],
@@ -94,7 +308,7 @@ input_tab1 = html.Div(
                 dbc.Col(
                 [
                     dbc.Row([html.H3("csv file upload", style={"padding-right" : "2%", "padding-left" : "2%"}),
-                    html.Abbr("\u003f\u20dd", title="Upload a one column .csv file with YORF")]),
+                    html.Abbr("\u003f\u20dd", title="Upload a one column .csv file with YORF, or a .bed file of genomic intervals")]),
                     dcc.Upload(id="upload_data_tab1", children=html.Div(
                     ["Drag and Drop or ",
                      html.A("Select Files")
@@ -108,6 +322,7 @@ input_tab1 = html.Div(
                     "margin": "10px"},
                     multiple=True),
                     dcc.Loading(children=[html.Div(id="output_data_upload_tab1")]),
+                    dcc.Store(id="list_key_tab1"),
                 ]),
                 dbc.Col(
                 [dbc.Row(style={"height" : 63}),
@@ -145,7 +360,8 @@ input_tab1 = html.Div(
                 dbc.Button("Submit", id="Submit_tab1", outline=True, color="primary", className="mr-1", style={"vertical-align": "middle"})
             ],
             justify="end"
-            )
+            ),
+            dbc.Row(html.Div(id="export_links_tab1"), justify="end")
         ],
         className="shadow p-3 mb-5 bg-body rounded", style={"padding-top" : "1%"})
 
@@ -155,7 +371,7 @@ input_tab2 = html.Div(
                 dbc.Col(
                 [
                     dbc.Row([html.H3("csv file upload", style={"padding-right" : "2%", "padding-left" : "2%"}),
-                    html.Abbr("\u003f\u20dd", title="Upload a .csv file with YORF in the first column")]),
+                    html.Abbr("\u003f\u20dd", title="Upload a .csv file with YORF in the first column, or a .bed file of genomic intervals (scored by the 5th column)")]),
                     dcc.Upload(id="upload_data_tab2", children=html.Div(
                     ["Drag and Drop or ",
                      html.A("Select Files")
@@ -169,7 +385,11 @@ input_tab2 = html.Div(
                     "margin": "10px"},
                     multiple=True),
                     dbc.Button("Load demo data", id="demo_tab2", outline=True, color="primary", className="mr-1", style={"vertical-align": "middle"}),
-                    dcc.Loading(children=[html.Div(id="output_data_upload_tab2")]),
+                    # Empty table until a file is uploaded: the crowding tracks can be shown without data
+                    dcc.Loading(children=[html.Div(id="output_data_upload_tab2",
+                                                   children=dash_table.DataTable(id="datatable", data=[], columns=[], selected_columns=[],
+                                                                                 style_table={"display": "none"}))]),
+                    dcc.Store(id="list_key_tab2"),
                 ]),
                 dbc.Col(
                 [
@@ -184,6 +404,24 @@ input_tab2 = html.Div(
                             {"label": "plasma", "value": "Plasma"},
                             {"label": "thermal", "value": "thermal"}],
                             placeholder="select a color scale"),
+                    dbc.Row(style={"height" : 25}),
+                    dbc.Row([html.H3("Values", style={"padding-right" : "2%", "padding-left" : "2%"}),
+                    html.Abbr("\u003f\u20dd", title="Color by the raw values, or by the mean of the values of each locus and its nearest loci in 3D")]),
+                    dcc.RadioItems(
+                        id="smoothing_tab2",
+                        options=[
+                            {"label": "raw values", "value": "raw"},
+                            {"label": "3D neighbourhood mean ({} nearest loci)".format(SMOOTHING_NEIGHBOURS), "value": "smoothed"}],
+                        value="raw",
+                        labelStyle={"display": "block"}),
+                    dbc.Row(style={"height" : 25}),
+                    dbc.Row([html.H3("3D crowding tracks", style={"padding-right" : "2%", "padding-left" : "2%"}),
+                    html.Abbr("\u003f\u20dd", title="Precomputed for each locus: number of other loci within a 3D radius, and distance to the nuclear centroid and periphery of the model. Shown after the uploaded variables, each with its own color scale")]),
+                    dcc.Dropdown(
+                        id="tracks_tab2",
+                        options=[{"label": crowding.get_track_label(track), "value": track} for track in crowding.TRACKS],
+                        multi=True,
+                        placeholder="select crowding tracks"),
                 ])
             ]),
             dbc.Row(style={"height" : 25}),
@@ -202,7 +440,7 @@ input_tab3 = html.Div(
                 dbc.Col(
                 [
                     dbc.Row([html.H3("csv file upload", style={"padding-right" : "2%", "padding-left" : "2%"}),
-                    html.Abbr("\u003f\u20dd", title="Upload a one column .csv file with YORF")]),
+                    html.Abbr("\u003f\u20dd", title="Upload a one column .csv file with YORF, or a .bed file of genomic intervals")]),
                     dcc.Upload(id="upload_data_tab3", children=html.Div(
                     ["Drag and Drop or ",
                      html.A("Select Files")
@@ -216,10 +454,23 @@ input_tab3 = html.Div(
                     "margin": "10px"},
                     multiple=True),
                     dcc.Loading(children=[html.Div(id="output_data_upload_tab3")]),
+                    dcc.Store(id="list_key_tab3"),
                 ]),
                 dbc.Col(
                 [dbc.Row(style={"height" : 63}),
-                dbc.Button("Load demo data", id="demo_tab3", outline=True, color="primary", className="mr-1", style={"vertical-align": "middle"})
+                dbc.Button("Load demo data", id="demo_tab3", outline=True, color="primary", className="mr-1", style={"vertical-align": "middle"}),
+                dbc.Row(style={"height" : 25}),
+                html.Div(
+                [
+                    dbc.Row([html.H3("3D distances", style={"padding-right" : "2%", "padding-left" : "2%"}),
+                    html.Abbr("\u003f\u20dd", title="Distances of the reference 3D model, or per gene pair statistic of the distances across the models of the ensemble. The standard deviation shows the uncertainty of the distances")]),
+                    dcc.RadioItems(
+                        id="distances_tab3",
+                        options=distances_options_tab3,
+                        value="reference",
+                        labelStyle={"display": "block"})
+                ],
+                style={} if ENSEMBLE_AVAILABLE else {"display": "none"})
                 ]),
             ]),
             dbc.Row(style={"height" : 25}),
@@ -246,7 +497,9 @@ slider_tab3 = html.Div(
                                value=5),
                     html.Div(id='output_min_slider'),
                     html.Div(id='output_max_slider'),
-                    html.Div(id='output_value_slider')
+                    html.Div(id='output_value_slider'),
+                    dcc.Store(id="threshold_data"),
+                    dcc.Store(id="hist_axes")
                 ]),
                 dbc.Col(
                 [
@@ -257,6 +510,64 @@ slider_tab3 = html.Div(
 
 ############APP_VISUALIZATIONS_COMPONENTS############
 
+if go_compactness is not None:
+    go_compactness_content = dash_table.DataTable(id="go_compactness_table",
+                                                  columns=[{"name": "GO term", "id": "GO_slim_term"},
+                                                           {"name": "Genes", "id": "genes"},
+                                                           {"name": "Mean distance", "id": "mean_distance"},
+                                                           {"name": "Median distance", "id": "median_distance"},
+                                                           {"name": "Random sets mean", "id": "null_mean"},
+                                                           {"name": "z-score", "id": "z_score"},
+                                                           {"name": "p-value", "id": "p_value"},
+                                                           {"name": "FDR", "id": "FDR"}],
+                                                  data=go_compactness.to_dict("records"),
+                                                  page_size=10,
+                                                  sort_action="native",
+                                                  style_cell={'textAlign': 'left'},
+                                                  style_header={'backgroundColor': 'rgb(230, 230, 230)',
+                                                                'fontWeight': 'bold'})
+else:
+    go_compactness_content = html.Div("The GO terms 3D compactness has not been computed, run: python go_atlas.py")
+
+compactness_tab1 = html.Div(
+        [   dbc.Row(
+            [
+                dbc.Col(
+                [
+                    dbc.Row([html.H3("GO terms 3D compactness", style={"padding-right" : "2%", "padding-left" : "2%"}),
+                    html.Abbr("\u003f\u20dd", title="Mean 3D distance between the genes of each GO slim term, compared with random gene sets of the same size. Negative z-scores indicate terms clustered in 3D")]),
+                    go_compactness_content,
+                ])
+            ])
+        ],
+        className="shadow p-3 mb-5 bg-body rounded", style={"padding-top" : "1%"})
+
+enrichment_tab1 = html.Div(
+        [   dbc.Row(
+            [
+                dbc.Col(
+                [
+                    dbc.Row([html.H3("GO terms enrichment", style={"padding-right" : "2%", "padding-left" : "2%"}),
+                    html.Abbr("\u003f\u20dd", title="Hypergeometric test of the over-representation of each GO slim term in the genes list, FDR = Benjamini-Hochberg adjusted p-value. Click on a GO term to color it")]),
+                    dcc.Loading(children=[dash_table.DataTable(id="go_enrichment_table",
+                                                               columns=[{"name": "GO term", "id": "GO_slim_term"},
+                                                                        {"name": "Targets", "id": "targets"},
+                                                                        {"name": "Term size", "id": "term_size"},
+                                                                        {"name": "Fold enrichment", "id": "fold_enrichment"},
+                                                                        {"name": "p-value", "id": "p_value"},
+                                                                        {"name": "FDR", "id": "FDR"}],
+                                                               data=[],
+                                                               page_size=10,
+                                                               sort_action="native",
+                                                               style_cell={'textAlign': 'left'},
+                                                               style_header={'backgroundColor': 'rgb(230, 230, 230)',
+                                                                             'fontWeight': 'bold'})]),
+                    dcc.Store(id="go_term_click"),
+                ])
+            ])
+        ],
+        className="shadow p-3 mb-5 bg-body rounded", style={"padding-top" : "1%"})
+
 visualization_tab1 = html.Div(
         [   dbc.Row(
             [
@@ -276,19 +587,50 @@ visualization_tab1 = html.Div(
                 ])
             ]),
             dbc.Row(
+            [
+                dbc.Col(
+                [
+                    dbc.Row([html.H3("Target's 3D distances between chromosomes", style={"padding-right" : "2%", "padding-left" : "2%"}),
+                    html.Abbr("\u003f\u20dd", title="log2(mean 3D distance of all genes / mean 3D distance of targets) for each pair of chromosomes, positive values indicate targets closer than expected")]),
+                    dcc.Loading(children=[dcc.Graph(id="Chromosomes_contacts")]),
+                ])
+            ]),
+            dbc.Row(
             [
                 dbc.Col(
                 [
                     dbc.Row([html.H3("3D visualizations", style={"padding-right" : "2%", "padding-left" : "2%"}),
                     html.Abbr("\u003f\u20dd", title="3D representations of the S cerevisiae genome, the size of loci on chromosomes are not to scale")]),
+                    dbc.Progress(id="3D_progress_tab1", value=0, style={"display": "none"}),
+                    html.Div(id="3D_message_tab1"),
+                    dcc.Interval(id="3D_interval_tab1", interval=500, disabled=True),
+                    dcc.Store(id="3D_job_tab1"),
                     dcc.Loading(children=[dcc.Graph(id="3D_representation")]),
                 ])
             ]),
             dbc.Row(
+            [
+                dbc.Col(
+                [
+                    dbc.Row([html.H3("3D neighbourhood", style={"padding-right" : "2%", "padding-left" : "2%"}),
+                    html.Abbr("\u003f\u20dd", title="Click on a locus in the 3D visualization above to highlight the loci within the selected 3D distance")]),
+                    dcc.Slider(id="neighbourhood_radius",
+                               min=1,
+                               max=50,
+                               step=1,
+                               value=10,
+                               marks={r: str(r) for r in range(10, 51, 10)}),
+                    html.Div(id="output_neighbourhood"),
+                    dcc.Loading(children=[dcc.Graph(id="3D_neighbourhood")]),
+                ])
+            ]),
+            dbc.Row(
             [
                 dbc.Col(
                 [
                     dcc.Loading(children=[dcc.Graph(id="3D_representation_chrom")]),
+                    dcc.Store(id="chromosomes_3D_url", data="./figures/chromosomes_3D"),
+                    dcc.Interval(id="chromosomes_3D_interval", interval=250, disabled=True),
                 ])
             ])
         ],
@@ -301,8 +643,30 @@ visualization_tab2 = html.Div(
                 [
                     dbc.Row([html.H3("3D visualization", style={"padding-right" : "2%", "padding-left" : "2%"}),
                     html.Abbr("\u003f\u20dd", title="3D representation of the S cerevisiae genome, the size of loci on chromosomes are not to scale")]),
+                    dbc.Progress(id="3D_progress_tab2", value=0, style={"display": "none"}),
+                    html.Div(id="3D_message_tab2"),
+                    dcc.Interval(id="3D_interval_tab2", interval=500, disabled=True),
+                    dcc.Store(id="3D_job_tab2"),
                     dcc.Loading(children=[dcc.Graph(id="3D_representation_tab2")]),
                 ])
+            ]),
+            dbc.Row(
+            [
+                dbc.Col(
+                [
+                    dbc.Row([html.H3("2D visualization", style={"padding-right" : "2%", "padding-left" : "2%"}),
+                    html.Abbr("\u003f\u20dd", title="Loci colored by the same variables on the chromosomes, the size of loci are not to scale")]),
+                    dcc.Loading(children=[dcc.Graph(id="2D_representation_tab2")]),
+                ])
+            ]),
+            dbc.Row(
+            [
+                dbc.Col(
+                [
+                    dbc.Row([html.H3("3D spatial autocorrelation", style={"padding-right" : "2%", "padding-left" : "2%"}),
+                    html.Abbr("\u003f\u20dd", title="Global Moran's I (> 0) and Geary's C (< 1) indicate that loci close in 3D have similar values. P-values from 999 random permutations of the values")]),
+                    dcc.Loading(children=[html.Div(id="output_autocorrelation_tab2")]),
+                ])
             ])
         ],
         className="shadow p-3 mb-5 bg-body rounded", style={"padding-top" : "1%"})
@@ -315,18 +679,49 @@ visualization_tab3_hist = html.Div(
                 dbc.Row([html.H3("3D distances histogram", style={"padding-right" : "2%", "padding-left" : "2%"}),
                     html.Abbr("\u003f\u20dd", title="The treshold is dynamically represented by the dashed black line. CDF = cumulative distribution function")]),
                 dbc.Row(style={"height" : 10}),
-                dcc.Loading(children=[html.Img(id="hist", src="")])
+                dbc.Progress(id="hist_progress_tab3", value=0, style={"display": "none"}),
+                html.Div(id="hist_message_tab3"),
+                dcc.Interval(id="hist_interval_tab3", interval=500, disabled=True),
+                dcc.Store(id="hist_job_tab3"),
+                dcc.Loading(children=[html.Div([html.Img(id="hist", src=""),
+                                                html.Div(id="hist_threshold_line", style={"display": "none"})],
+                                               style={"position": "relative", "display": "inline-block"})])
                 ]),
             ])
         ],
         className="shadow p-3 mb-5 bg-body rounded", style={"padding-top" : "1%"})
 
+visualization_tab3_lists = html.Div(
+        [   dbc.Row(
+            [
+                dbc.Col(
+                [
+                    dbc.Row([html.H3("Lists comparison", style={"padding-right" : "2%", "padding-left" : "2%"}),
+                    html.Abbr("\u003f\u20dd", title="Select several columns (one genes list per column) before submitting. The diagonal summarizes the 3D distances within each list, the other cells the 3D distances between the genes of two lists")]),
+                    dcc.RadioItems(id="lists_statistic_tab3",
+                                   options=[{"label": "Median", "value": "median"},
+                                            {"label": "Mean", "value": "mean"}],
+                                   value="median",
+                                   labelStyle={"display": "inline-block", "padding-right": "10px"}),
+                    dbc.Progress(id="lists_progress_tab3", value=0, style={"display": "none"}),
+                    html.Div(id="lists_message_tab3"),
+                    dcc.Interval(id="lists_interval_tab3", interval=500, disabled=True),
+                    dcc.Store(id="lists_job_tab3"),
+                    dcc.Store(id="lists_result_tab3"),
+                    dcc.Graph(id="lists_heatmap_tab3"),
+                    dcc.Graph(id="lists_cdf_tab3")
+                ])
+            ])
+        ],
+        className="shadow p-3 mb-5 bg-body rounded", style={"padding-top" : "1%"})
+
 visualization_tab3_network = html.Div(
         [   dbc.Row(
             [
                 dbc.Col(
                 [
                     html.H3("Network visualization"),
+                    html.Div(id="export_links_tab3"),
                     dcc.Loading(children=[cyto.Cytoscape(id="network",
                                                             stylesheet=basic_stylesheet,
                                                             elements=[],
@@ -364,16 +759,19 @@ app.layout = dbc.Container(
             dbc.Row(style={"height" : 45}),
             html.Div("""The projected list of genes can be colored uniformly or according to a selected Gene Ontology (GO) term.
                         Upload the genes list as a one column .csv file containing YORF, then click the submit button.
+                        Genomic intervals (e.g. ChIP-seq peaks) can also be uploaded as a .bed file, the overlapping loci are then used as genes list.
                         Optionally, select a GO term and a color before submitting to color associated genes in the list."""),
             dbc.Row(style={"height" : 45}),
             input_tab1,
-            visualization_tab1
+            enrichment_tab1,
+            visualization_tab1,
+            compactness_tab1
         ]),
         dcc.Tab(label="Quantitative variable projection", children=[
             dbc.Row(style={"height" : 45}),
             html.Div("""The projected list of genes can be colored according to a given quantitative variable.
                         Upload the genes list as a .csv file, with YORF in the first column. Then select the column corresponding to the quantitative variable and a color scale before
-                        clicking on submit."""),
+                        clicking on submit. When several columns are selected (e.g. time points), they are played as an animation with a common color scale."""),
             dbc.Row(style={"height" : 45}),
             input_tab2,
             visualization_tab2
@@ -382,13 +780,16 @@ app.layout = dbc.Container(
             dbc.Row(style={"height" : 45}),
             html.Div("""All the 3D distances between genes in the list are summarized into a histogram and a network.
                         Upload the genes list as a one column .csv file containing YORF, then click the submit button.
-                        The slider determines the threshold under which 3D distances are used to construct the network."""),
+                        Genomic intervals (e.g. ChIP-seq peaks) can also be uploaded as a .bed file, the overlapping loci are then used as genes list.
+                        The slider determines the threshold under which 3D distances are used to construct the network.
+                        When several columns are selected, the 3D distances within and between the lists are compared."""),
             dbc.Row(style={"height" : 45}),
             input_tab3,
             visualization_tab3_hist,
             slider_tab3,
             visualization_tab3_network,
-            visualization_tab3_metrics
+            visualization_tab3_metrics,
+            visualization_tab3_lists
         ]),
         ])
       ])
@@ -397,8 +798,51 @@ app.layout = dbc.Container(
 ############CALLBACKS############
 ########################
 
+############BACKGROUND_JOBS############
+def submit_job(owner, function, *args):
+    """Queue the background job of a callback, after cancelling the unfinished job of the same owner (None: not cancelled).
+
+    Returns
+    -------
+    dict
+        Job store data (id), no update when the queue is full.
+    str
+        Message shown under the progress bar.
+    """
+    try:
+        job_id = job_executor.submit(owner or uuid.uuid4().hex, function, *args)
+    except jobs.JobQueueFull:
+        return dash.no_update, "The server is busy, please submit again in a few moments."
+    except jobs.BrokenProcessPool:
+        #A worker process died (e.g. out of memory): the job is recorded as an error, the next jobs run in a new pool
+        job_executor.restart()
+        return dash.no_update, "The background job failed (a worker process stopped), please submit again."
+
+    return {"id": job_id}, ""
+
+def get_job_progress(job):
+    """Progress bar value, label and style of a background job (job store data) and its status, None without job."""
+    status = job_executor.get_job(job["id"]) if job else None
+    if status is None:
+        return 0, "", {"display": "none"}, None
+
+    percent = int(100 * status["progress"])
+    if status["status"] in ("queued", "running"):
+        label = "queued" if status["status"] == "queued" else "{} %".format(percent)
+        return percent, label, {"display": "flex"}, status["status"]
+    if status["status"] == "done":
+        return 100, "", {"display": "none"}, status["status"]
+
+    return percent, status["error"] or status["status"], {"display": "flex"}, status["status"]
+
+def get_job_result(job, status):
+    """Result of a done background job, no update until then."""
+    result = job_executor.get_result(job["id"]) if status == "done" else None
+    return result if result is not None else dash.no_update
+
 ############TAB1_UPLOAD############
 @app.callback(Output("output_data_upload_tab1", "children"),
+              Output("list_key_tab1", "data"),
               Input("demo_tab1", "n_clicks"),
               Input("upload_data_tab1", "contents"),
               State("upload_data_tab1", "filename"))
@@ -420,8 +864,10 @@ def update_output(n_clicks, list_of_contents, list_of_names):
                                                                         'fontWeight': 'bold'})
     else:
         if list_of_contents is not None:
-            children=[tools.parse_contents(c, n, "datatable_tab1") for c, n in zip(list_of_contents, list_of_names)]
-    return children
+            children=[tools.parse_contents(c, n, "datatable_tab1", all_feature_name, interval_index) for c, n in zip(list_of_contents, list_of_names)]
+
+    # Each loaded table has its own background jobs
+    return children, uuid.uuid4().hex
 
 ############TAB1_UPLOAD_STYLE############
 @app.callback(
@@ -436,11 +882,12 @@ def update_styles_tab1(selected_columns):
 ############TAB1_2D_GRAPH############
 @app.callback(Output("2D_representation", "figure"),
               Input("Submit_tab1", "n_clicks"),
+              Input("go_term_click", "data"),
               State("GoTerm-dropdown", "value"),
               State("color-dropdown", "value"),
               State("datatable_tab1", "derived_virtual_data"),
               State("datatable_tab1", "selected_columns"))
-def update_2D_graphs_tab1(n_clicks, GoTerm, color, data, column):
+def update_2D_graphs_tab1(n_clicks, go_term_click, GoTerm, color, data, column):
 
     sql_query_gobal = \
 """SELECT Primary_SGDID, count(SGDID), Feature_name, Start_coordinate, Stop_coordinate, Chromosome, Strand, GO_slim_term
@@ -457,8 +904,8 @@ AND (GO_slim_term == """ + "'" + str(GoTerm) + "'" + """)
 GROUP BY SGDID
 ORDER BY Start_coordinate
 """
-    all_loci = tools.get_locus_info("./static/SCERE.db", sql_query_gobal)
-    selected_loci = tools.get_locus_info("./static/SCERE.db", sql_query_specific)
+    all_loci = tools.get_locus_info(DATABASE, sql_query_gobal)
+    selected_loci = tools.get_locus_info(DATABASE, sql_query_specific)
 
     loci = pd.concat([all_loci, selected_loci]).drop_duplicates(subset=["Primary_SGDID"], keep="last")
 
@@ -470,12 +917,12 @@ ORDER BY Start_coordinate
         loci.loc[loci.FT_target == True, "colors_parameters"]="Targets"
         loci.loc[(loci.GO_slim_term == str(GoTerm)) & (loci.FT_target == True), "colors_parameters"]=str(GoTerm)
 
-        loci = vis2D.format_coordinates(loci, 6)
-        fig = vis2D.genome_drawing(loci, "colors_parameters", [str(GoTerm), "Targets"], [str(color), "Black"])
+        loci = vis2D.format_coordinates(loci, vis2D.SPACE_BETWEEN_CHROMOSOMES)
+        fig = vis2D.genome_drawing(loci, chromosome_layout, "colors_parameters", [str(GoTerm), "Targets"], [str(color), "Black"])
 
     else :
-        loci = vis2D.format_coordinates(loci, 6)
-        fig = vis2D.genome_drawing(loci, "GO_slim_term", [str(GoTerm)], [str(color)])
+        loci = vis2D.format_coordinates(loci, vis2D.SPACE_BETWEEN_CHROMOSOMES)
+        fig = vis2D.genome_drawing(loci, chromosome_layout, "GO_slim_term", [str(GoTerm)], [str(color)])
 
     return fig
 
@@ -495,90 +942,225 @@ ORDER BY Start_coordinate
         unfiltered_data = pd.DataFrame(data)
         filtered_data = unfiltered_data[str(column[0])]
 
-        loci = tools.get_locus_info("./static/SCERE.db", sql_query_2)
+        loci = tools.get_locus_info(DATABASE, sql_query_2)
         loci = loci.assign(FT_target=loci.Feature_name.isin(filtered_data))
 
         loci = loci[loci.FT_target == True].drop(["FT_target"], axis=1)
         loci.rename(columns = {'Chromosome':'chromosomes'}, inplace = True)
 
-        fig = px.histogram(loci, x="chromosomes", nbins=30, range_x=[0, 17], color_discrete_sequence=["#5767FF"])
-        fig.update_layout(plot_bgcolor="white",
-                          bargap = 0.01,
-                          xaxis_showgrid=False,
-                          yaxis_showgrid=False,
-                          showlegend=True)
-        fig.update_xaxes(dtick = 1)
-        fig.update_traces(marker={"opacity": 0.7})
+        with metrics.stage("figure"):
+            fig = px.histogram(loci, x="chromosomes", nbins=30, range_x=[0, chromosome_layout["chromosome"].max()], color_discrete_sequence=["#5767FF"])
+            fig.update_layout(plot_bgcolor="white",
+                              bargap = 0.01,
+                              xaxis_showgrid=False,
+                              yaxis_showgrid=False,
+                              showlegend=True)
+            fig.update_xaxes(dtick = 1)
+            fig.update_traces(marker={"opacity": 0.7})
+
+        return fig
+
+############TAB1_GO_ENRICHMENT############
+@app.callback(Output("go_enrichment_table", "data"),
+              Input("Submit_tab1", "n_clicks"),
+              State("datatable_tab1", "derived_virtual_data"),
+              State("datatable_tab1", "selected_columns"))
+def update_go_enrichment_tab1(n_clicks, data, column):
+
+    if column != []:
+        genes_list = pd.DataFrame(data)[str(column[0])]
+
+        go_enrichment = enrichment.get_go_enrichment(go_membership, genes_list)
+        go_enrichment = go_enrichment.round({"fold_enrichment": 2})
+        go_enrichment["p_value"] = go_enrichment["p_value"].map("{:.2e}".format).astype(float)
+        go_enrichment["FDR"] = go_enrichment["FDR"].map("{:.2e}".format).astype(float)
+
+        return go_enrichment.to_dict("records")
+
+    return []
+
+############TAB1_GO_ENRICHMENT_CLICK############
+@app.callback(Output("GoTerm-dropdown", "value"),
+              Output("color-dropdown", "value"),
+              Output("go_term_click", "data"),
+              Input("go_enrichment_table", "active_cell"),
+              State("go_enrichment_table", "derived_viewport_data"),
+              State("color-dropdown", "value"))
+def select_go_term_tab1(active_cell, data, color):
+
+    if active_cell is None:
+        return dash.no_update, dash.no_update, dash.no_update
+
+    # Rows of the displayed page, sorted as displayed
+    go_term = data[active_cell["row"]]["GO_slim_term"]
+
+    return go_term, color or "red", go_term
+
+############TAB1_EXPORT############
+def get_export_links(selection_key, genes_list, threshold=None):
+    """Register a genes list for download and build the download links."""
+    sgdids = all_feature_name.loc[all_feature_name["Feature_name"].isin(genes_list), "Primary_SGDID"].unique()
+    with list_states_lock:
+        export_selections[selection_key] = sgdids
+        export_selections.move_to_end(selection_key)
+        while len(export_selections) > EXPORT_SELECTIONS_SIZE:
+            export_selections.popitem(last=False)
+
+    edges = "3D distances" if threshold is None else "3D distances < {}".format(threshold)
+    threshold = "" if threshold is None else "&threshold={}".format(threshold)
+    links = ["Download: "]
+    for label, table, parameters in [(edges, "edges", threshold), ("genes and GO terms", "nodes", ""), ("3D segments", "segments", "")]:
+        links += [label, " (",
+                  html.A("csv", href="/api/export/{}?selection={}&format=csv{}".format(table, selection_key, parameters)), ", ",
+                  html.A("parquet", href="/api/export/{}?selection={}&format=parquet{}".format(table, selection_key, parameters)), ") "]
+
+    return links
+
+@app.callback(Output("export_links_tab1", "children"),
+              Input("Submit_tab1", "n_clicks"),
+              State("datatable_tab1", "derived_virtual_data"),
+              State("datatable_tab1", "selected_columns"))
+def update_export_links_tab1(n_clicks, data, column):
+
+    if column != [] and column is not None:
+        genes_list = pd.DataFrame(data)[str(column[0])].dropna().astype(str)
+        return get_export_links(uuid.uuid4().hex, genes_list)
+
+############TAB1_CHROMOSOME_CONTACTS############
+@app.callback(Output("Chromosomes_contacts", "figure"),
+              Input("Submit_tab1", "n_clicks"),
+              State("datatable_tab1", "derived_virtual_data"),
+              State("datatable_tab1", "selected_columns"))
+def update_chrom_contacts_tab1(n_clicks, data, column):
+
+    if column != []:
+        genes_list = pd.DataFrame(data)[[str(column[0])]]
+
+        positions = distances.get_loci_positions(distance_sgdids, all_feature_name, genes_list[genes_list.columns[0]].dropna().astype(str))
+        selection = chromosomes.get_matrix_chromosome_distances(distance_matrix, distance_sgdids, all_feature_name, chromosome_layout["chromosome"].max(),
+                                                                positions=positions)
+        chromosome_enrichment = chromosomes.get_chromosome_enrichment(selection, background_chromosome_distances)
+
+        hover = np.dstack([selection["count"], selection["mean"], selection["median"],
+                           background_chromosome_distances["mean"], background_chromosome_distances["median"]])
+
+        with metrics.stage("figure"):
+            fig = go.Figure(data=go.Heatmap(z=chromosome_enrichment,
+                                            x=chromosome_layout["label"],
+                                            y=chromosome_layout["label"],
+                                            customdata=hover,
+                                            colorscale="RdBu_r",
+                                            zmid=0,
+                                            colorbar={"title": "log2 enrichment"},
+                                            hovertemplate=("<b>Chromosomes :</b> %{x} - %{y} <br>"
+                                                           "<b>Targets pairs :</b> %{customdata[0]} <br>"
+                                                           "<b>Targets mean / median :</b> %{customdata[1]:.1f} / %{customdata[2]:.1f} <br>"
+                                                           "<b>All genes mean / median :</b> %{customdata[3]:.1f} / %{customdata[4]:.1f}"
+                                                           "<extra></extra>")))
+            fig.update_layout(plot_bgcolor="white",
+                              height=600)
+            fig.update_xaxes(title="Chromosomes", type="category")
+            fig.update_yaxes(title="Chromosomes", type="category", autorange="reversed")
 
         return fig
 
 ############TAB1_3D_GRAPH_FEATURE############
-@app.callback(Output("3D_representation", "figure"),
+@app.callback(Output("3D_job_tab1", "data"),
+              Output("3D_message_tab1", "children"),
               Input("Submit_tab1", "n_clicks"),
+              Input("go_term_click", "data"),
               State("GoTerm-dropdown", "value"),
               State("color-dropdown", "value"),
               State("datatable_tab1", "derived_virtual_data"),
-              State("datatable_tab1", "selected_columns"))
-def update_3D_graph_tab1(n_clicks, GoTerm, color, data, column):
+              State("datatable_tab1", "selected_columns"),
+              State("list_key_tab1", "data"))
+def update_3D_graph_tab1(n_clicks, go_term_click, GoTerm, color, data, column, list_key):
 
-    sql_query_gobal = \
-"""SELECT Primary_SGDID, count(SGDID), Feature_name, Start_coordinate, Stop_coordinate, Chromosome, Strand, GO_slim_term
-FROM SGD_features, go_slim_mapping
-WHERE SGDID == Primary_SGDID
-GROUP BY SGDID
-ORDER BY Start_coordinate
-"""
+    genes = pd.DataFrame(data)[str(column[0])].tolist() if column != [] else None
 
-    sql_query_3 = \
-"""SELECT Primary_SGDID, Feature_name, Start_coordinate, Stop_coordinate, Chromosome, Strand, GO_slim_term
-FROM SGD_features, go_slim_mapping
-WHERE SGDID == Primary_SGDID
-AND (GO_slim_term == """ + "'" + str(GoTerm) + "'" + """)
-GROUP BY SGDID
-ORDER BY Start_coordinate
-"""
-    all_loci = tools.get_locus_info("./static/SCERE.db", sql_query_gobal)
-    selected_loci = tools.get_locus_info("./static/SCERE.db", sql_query_3)
+    # Drawn in a background job, a new submit of the same table cancels the previous drawing
+    return submit_job(list_key and "{}/3D".format(list_key), vis3D.draw_genes_3D, DATABASE, jobs.SharedData("plotly_segments"),
+                      genes, GoTerm, color)
 
-    if column != []:
-        unfiltered_data = pd.DataFrame(data)
-        filtered_data = unfiltered_data[str(column[0])]
-        loci = all_loci.assign(FT_target=all_loci.Feature_name.isin(filtered_data))
-        loci = loci.assign(GoTerm=loci.Primary_SGDID.isin(selected_loci.Primary_SGDID))
+############TAB1_3D_GRAPH_FEATURE_PROGRESS############
+@app.callback(Output("3D_representation", "figure"),
+              Output("3D_progress_tab1", "value"),
+              Output("3D_progress_tab1", "children"),
+              Output("3D_progress_tab1", "style"),
+              Output("3D_interval_tab1", "disabled"),
+              Input("3D_interval_tab1", "n_intervals"),
+              Input("3D_job_tab1", "data"))
+def update_3D_progress_tab1(n_intervals, job):
+
+    value, label, style, status = get_job_progress(job)
+
+    return get_job_result(job, status), value, label, style, status not in ("queued", "running")
+
+############TAB1_3D_NEIGHBOURHOOD############
+@app.callback(Output("3D_neighbourhood", "figure"),
+              Output("output_neighbourhood", "children"),
+              Input("3D_representation", "clickData"),
+              Input("neighbourhood_radius", "value"))
+def update_3D_neighbourhood_tab1(click_data, radius):
+
+    if click_data is None:
+        return dash.no_update, "Click on a locus in the 3D visualization to select it."
+
+    point = click_data["points"][0]
+    center = all_feature_name.loc[all_feature_name["Feature_name"] == point.get("customdata"), "Primary_SGDID"]
+    center = center[center.isin(locus_centroids.index)]
+
+    if len(center) > 0:
+        center = center_sgdid = center.iloc[0]
+        center_name = point["customdata"]
+    else:
+        # Clicked outside an annotated locus: use the clicked point
+        center = [point["x"], point["y"], point["z"]]
+        center_sgdid = None
+        center_name = "({:.1f}, {:.1f}, {:.1f})".format(*center)
 
-        loci.loc[loci.FT_target == True, "colors_parameters"]="Targets"
-        loci.loc[(loci.GoTerm == True) & (loci.FT_target == True), "colors_parameters"]=str(GoTerm)
+    neighbours = spatial.get_neighbours_within(spatial_index, locus_centroids, center, radius)
+    neighbours = neighbours.merge(all_feature_name[["Primary_SGDID", "Feature_name"]], on="Primary_SGDID", how="left")
 
-        loci_segments = plotly_segments.merge(loci, on="Primary_SGDID", how="left", copy=False)
-        loci_segments.index = range(1, len(loci_segments) + 1)
-        loci_segments = vis3D.get_color_discreet_3D(loci_segments, "colors_parameters", [str(GoTerm), "Targets"], [str(color), "blue"])
-        fig = vis3D.genome_drawing(loci_segments)
+    loci_segments = plotly_segments.merge(all_feature_name[["Primary_SGDID", "Feature_name"]], on="Primary_SGDID", how="left", copy=False)
+    loci_segments.index = range(1, len(loci_segments) + 1)
+    loci_segments.loc[loci_segments.Primary_SGDID.isin(neighbours.Primary_SGDID), "neighbourhood"] = "Neighbours"
+    loci_segments.loc[loci_segments.Primary_SGDID == center_sgdid, "neighbourhood"] = "Center"
+    loci_segments = vis3D.get_color_discreet_3D(loci_segments, "neighbourhood", ["Center", "Neighbours"], ["black", "red"])
 
-    else :
-        selected_loci_segments = plotly_segments.merge(selected_loci, on="Primary_SGDID", how="left", copy=False)
-        selected_loci_segments.index = range(1, len(selected_loci_segments) + 1)
-        selected_loci_segments = vis3D.get_color_discreet_3D(selected_loci_segments, "GO_slim_term", [str(GoTerm)], [str(color)])
+    fig = vis3D.genome_drawing(loci_segments)
 
-        fig = vis3D.genome_drawing(selected_loci_segments)
+    names = list(neighbours["Feature_name"].fillna(neighbours["Primary_SGDID"]))
+    text = "{} loci within {} of {} : {}".format(len(neighbours), radius, center_name, ", ".join(names[:100]))
+    if len(names) > 100:
+        text += ", ..."
 
-    return fig
+    return fig, text
 
 ############TAB1_3D_GRAPH_CHROMOSOMES############
-@app.callback(Output("3D_representation_chrom", "figure"),
-              Input("Submit_tab1", "n_clicks"))
-def update_3D_graph_chrom_tab1(n_clicks):
+def get_chromosomes_figure_3D():
+    """3D figure of the chromosomes as JSON, the same for every genes list: built once."""
+    global chromosomes_figure_3D
+
+    with chromosomes_figure_3D_lock:
+        if chromosomes_figure_3D is None:
+            chromosomes_figure_3D = build_chromosomes_figure_3D()
+    return chromosomes_figure_3D
 
+def build_chromosomes_figure_3D():
+    """Build the 3D figure of the chromosomes, colored by chromosome, as JSON."""
     sql_query_4 = \
 """SELECT Primary_SGDID, Start_coordinate, Stop_coordinate, Chromosome, Strand
 FROM SGD_features
 ORDER BY Start_coordinate
 """
-    selected_loci = tools.get_locus_info("./static/SCERE.db", sql_query_4)
+    selected_loci = tools.get_locus_info(DATABASE, sql_query_4)
 
     selected_loci_segments = plotly_segments.merge(selected_loci, on="Primary_SGDID", how="left", copy=False)
     selected_loci_segments.index = range(1, len(selected_loci_segments) + 1)
 
-    selected_loci_segments = vis3D.get_color_discreet_3D(selected_loci_segments, "Chromosome", list(range(1, 17)), colors)
+    selected_loci_segments = vis3D.get_color_discreet_3D(selected_loci_segments, "Chromosome", chromosome_layout["chromosome"].tolist(),
+                                                        [colors[i % len(colors)] for i in range(len(chromosome_layout))])
 
     fig = go.Figure(data=[go.Scatter3d(x = selected_loci_segments.x,
                                        y = selected_loci_segments.y,
@@ -596,9 +1178,24 @@ ORDER BY Start_coordinate
                                  zaxis = dict(showgrid = False, backgroundcolor = "white")))
     fig.update_layout(height=800)
 
-    return fig
+    return fig.to_json().encode()
+
+# Served with a strong ETag: the browsers revalidate their copy (304) instead of downloading the figure at each visit
+@server.route("/figures/chromosomes_3D")
+def serve_chromosomes_figure_3D():
+    return http_cache.make_cached_response(get_chromosomes_figure_3D())
+
+# Requested asynchronously by the browser, the interval polls the request until the figure arrives
+app.clientside_callback(ClientsideFunction(namespace="figures", function_name="load"),
+                        Output("3D_representation_chrom", "figure"),
+                        Output("chromosomes_3D_interval", "disabled"),
+                        Input("Submit_tab1", "n_clicks"),
+                        Input("chromosomes_3D_interval", "n_intervals"),
+                        State("chromosomes_3D_url", "data"))
+
 ############TAB2_UPLOAD############
 @app.callback(Output("output_data_upload_tab2", "children"),
+              Output("list_key_tab2", "data"),
               Input("demo_tab2", "n_clicks"),
               Input("upload_data_tab2", "contents"),
               State("upload_data_tab2", "filename"))
@@ -620,8 +1217,10 @@ def update_output_tab2(n_clicks, list_of_contents, list_of_names):
                                                                         'fontWeight': 'bold'})
     else:
         if list_of_contents is not None:
-            children=[tools.parse_contents(c, n, "datatable") for c, n in zip(list_of_contents, list_of_names)]
-    return children
+            children=[tools.parse_contents(c, n, "datatable", all_feature_name, interval_index) for c, n in zip(list_of_contents, list_of_names)]
+
+    # Each loaded table has its own background jobs
+    return children, uuid.uuid4().hex
 
 ############TAB2_COLUMN_SELECTION_UPLOAD############
 @app.callback(
@@ -633,55 +1232,99 @@ def update_styles_tab2(selected_columns):
         "background_color": "#D2F3FF"
     } for i in selected_columns]
 
+############TAB2_VARIABLES############
+def get_locus_variables(loci, data, selected_columns, smoothing, tracks):
+    """Values of the uploaded variables and of the crowding tracks for loci (see visualization_3D.get_locus_variables)."""
+    return vis3D.get_locus_variables(loci, data, selected_columns, smoothing, tracks,
+                                     all_feature_name, locus_centroids, spatial_weights, crowding_track)
+
 ############TAB2_3D_GRAPH############
+@app.callback(Output("3D_job_tab2", "data"),
+              Output("3D_message_tab2", "children"),
+              Input("Submit_tab2", "n_clicks"),
+              State("datatable", "derived_virtual_data"),
+              State("datatable", "selected_columns"),
+              State("color_scale_dropdown", "value"),
+              State("smoothing_tab2", "value"),
+              State("tracks_tab2", "value"),
+              State("list_key_tab2", "data"))
+def update_3D_graphs_tab2(n_clicks, input1, input2, input3, smoothing, tracks, list_key):
+
+    # First selected column: YORF, following columns and crowding tracks: one animation frame each
+    if len(input2 or []) < 2 and not tracks:
+        return dash.no_update, dash.no_update
+
+    # Drawn in a background job, a new submit of the same table cancels the previous drawing
+    return submit_job(list_key and "{}/3D".format(list_key), vis3D.draw_variables_3D, DATABASE, jobs.SharedData("plotly_segments"),
+                      input1, input2, input3, smoothing, tracks, jobs.SharedData("feature_name"), jobs.SharedData("locus_centroids"),
+                      jobs.SharedData("spatial_weights"), jobs.SharedData("crowding_track"))
+
+############TAB2_3D_GRAPH_PROGRESS############
 @app.callback(Output("3D_representation_tab2", "figure"),
+              Output("3D_progress_tab2", "value"),
+              Output("3D_progress_tab2", "children"),
+              Output("3D_progress_tab2", "style"),
+              Output("3D_interval_tab2", "disabled"),
+              Input("3D_interval_tab2", "n_intervals"),
+              Input("3D_job_tab2", "data"))
+def update_3D_progress_tab2(n_intervals, job):
+
+    value, label, style, status = get_job_progress(job)
+
+    return get_job_result(job, status), value, label, style, status not in ("queued", "running")
+
+############TAB2_2D_GRAPH############
+@app.callback(Output("2D_representation_tab2", "figure"),
               Input("Submit_tab2", "n_clicks"),
               State("datatable", "derived_virtual_data"),
               State("datatable", "selected_columns"),
-              State("color_scale_dropdown", "value"))
-def update_3D_graphs_tab2(n_clicks, input1, input2, input3):
+              State("color_scale_dropdown", "value"),
+              State("smoothing_tab2", "value"),
+              State("tracks_tab2", "value"))
+def update_2D_graph_tab2(n_clicks, input1, input2, input3, smoothing, tracks):
 
-    unfiltered_data = pd.DataFrame(input1)
-    filtered_data = unfiltered_data[[str(input2[0]), str(input2[1])]]
+    if len(input2 or []) < 2 and not tracks:
+        return dash.no_update
 
-    sql_query_5 = \
-"""SELECT Primary_SGDID, Start_coordinate, Stop_coordinate, Chromosome, Feature_name, Strand
-FROM gene_literature, SGD_features
-WHERE SGDID == Primary_SGDID
-GROUP BY SGDID
-ORDER BY Start_coordinate
-"""
+    loci = all_feature_name.drop_duplicates(subset=["Primary_SGDID"])
+    loci = loci[loci["Chromosome"].isin(chromosome_layout["chromosome"])]
+    values, names = get_locus_variables(loci, input1, input2, smoothing, tracks)
 
-    whole_genome = tools.get_locus_info("./static/SCERE.db", sql_query_5)
-
-    whole_genome_segments = plotly_segments.merge(whole_genome, on="Primary_SGDID", how="left", copy=False)
-    whole_genome_segments.index = range(1, len(whole_genome_segments) + 1)
-
-    whole_genome_segments = whole_genome_segments.merge(filtered_data, left_on="Feature_name", right_on="YORF", how="left", copy=False)
-    whole_genome_segments.iloc[: , -1].fillna("whitesmoke", inplace=True)
-
-    fig = go.Figure(data=[go.Scatter3d(x=whole_genome_segments.x,
-                                   y=whole_genome_segments.y,
-                                   z=whole_genome_segments.z,
-                                   mode="lines",
-                                   name="",
-                                   line={"color": whole_genome_segments.iloc[: , -1],
-                                           "colorscale": input3,
-                                           "showscale": True,
-                                           "width": 12},
-                                   customdata=whole_genome_segments.Feature_name,
-                                   hovertemplate=("<b>YORF :</b> %{customdata} <br>"),
-                                   hoverlabel=dict(bgcolor="white", font_size=16))])
-
-    fig.update_layout(scene=dict(xaxis=dict(showgrid=False, backgroundcolor="white"),
-                             yaxis=dict(showgrid=False, backgroundcolor="white"),
-                             zaxis=dict(showgrid=False, backgroundcolor="white")))
-    fig.update_layout(height=800)
+    return vis2D.genome_values_drawing(loci, chromosome_layout, values, names, input3, common_scale=not tracks)
 
-    return fig
+############TAB2_SPATIAL_AUTOCORRELATION############
+@app.callback(Output("output_autocorrelation_tab2", "children"),
+              Input("Submit_tab2", "n_clicks"),
+              State("datatable", "derived_virtual_data"),
+              State("datatable", "selected_columns"),
+              State("tracks_tab2", "value"))
+def update_autocorrelation_tab2(n_clicks, input1, input2, tracks):
+
+    loci = pd.DataFrame({"Primary_SGDID": locus_centroids.index,
+                         "Feature_name": all_feature_name.drop_duplicates(subset=["Primary_SGDID"]).set_index("Primary_SGDID")["Feature_name"].reindex(locus_centroids.index).to_numpy()})
+    locus_values, variables = get_locus_variables(loci, input1, input2, "raw", tracks)
+    if not variables:
+        return dash.no_update
+
+    rows = []
+    for variable, values in zip(variables, locus_values.T):
+        autocorrelation = spatial.get_spatial_autocorrelation(spatial_weights, values)
+        rows.append({"Variable": variable,
+                     "Loci": autocorrelation["n"],
+                     "Moran's I": round(autocorrelation["morans_i"], 4),
+                     "p-value (I)": round(autocorrelation["morans_i_p_value"], 4),
+                     "Geary's C": round(autocorrelation["gearys_c"], 4),
+                     "p-value (C)": round(autocorrelation["gearys_c_p_value"], 4)})
+
+    return dash_table.DataTable(data=rows,
+                                columns=[{"name": i, "id": i} for i in ["Variable", "Loci", "Moran's I", "p-value (I)", "Geary's C", "p-value (C)"]],
+                                style_cell={'textAlign': 'left'},
+                                style_header={'backgroundColor': 'rgb(230, 230, 230)',
+                                              'fontWeight': 'bold'})
 
 ############TAB3_UPLOAD############
 @app.callback(Output("output_data_upload_tab3", "children"),
+              Output("list_key_tab3", "data"),
               Input("demo_tab3", "n_clicks"),
               Input("upload_data_tab3", "contents"),
               State("upload_data_tab3", "filename"))
@@ -703,8 +1346,47 @@ def update_output_tab3(n_clicks, list_of_contents, list_of_names):
                                                                         'fontWeight': 'bold'})
     else:
         if list_of_contents is not None:
-            children=[tools.parse_contents(c, n, "datatable_tab3") for c, n in zip(list_of_contents, list_of_names)]
-    return children
+            children=[tools.parse_contents(c, n, "datatable_tab3", all_feature_name, interval_index) for c, n in zip(list_of_contents, list_of_names)]
+
+    # Each loaded table has its own incrementally updated state
+    return children, uuid.uuid4().hex
+
+############TAB3_LIST_STATE############
+def get_distances_tab3(statistic):
+    """Loci and 3D distance matrix of the Tab 3 distances: the reference model, or a statistic across the models of the ensemble."""
+    if statistic in (None, "reference") or model_ensemble is None:
+        return distance_sgdids, distance_matrix
+    return model_ensemble.sgdids, model_ensemble.get_matrix(statistic)
+
+def get_list_state_tab3(list_key, data, statistic=None):
+    """Get the state of the Tab 3 genes list (first column), updated with the genes added or removed since the last call."""
+    sgdids, matrix = get_distances_tab3(statistic)
+    genes_list = pd.DataFrame(data)
+    positions = distances.get_loci_positions(sgdids, all_feature_name, genes_list[genes_list.columns[0]].dropna().astype(str)) \
+        if len(genes_list.columns) else np.array([], dtype=np.int64)
+
+    # One state per list and distances
+    state_key = (list_key, statistic or "reference")
+    with list_states_lock:
+        state = list_states.get(state_key)
+    metrics.record_cache("list_states", state is not None)
+    if state is None:
+        state = gene_lists.get_empty_list_state(BIN_NUMBER, 200)
+    state = gene_lists.update_list_state(state, matrix, positions)
+
+    with list_states_lock:
+        list_states[state_key] = state
+        list_states.move_to_end(state_key)
+        while len(list_states) > LIST_STATES_SIZE:
+            list_states.popitem(last=False)
+
+    return state
+
+def get_background_histogram_tab3(statistic):
+    """Density and CDF of the Tab 3 distances between all genes, computed at the first use for the ensemble statistics."""
+    if statistic in (None, "reference") or model_ensemble is None:
+        return H2, F2
+    return model_ensemble.get_histogram(statistic, BIN_NUMBER, 200)
 
 ############TAB3_UPLOAD_STYLE############
 @app.callback(
@@ -722,112 +1404,364 @@ def update_styles_tab3(selected_columns):
               Output("treshold_slider", "max"),
               Output("output_min_slider", "children"),
               Output("output_max_slider", "children"),
+              Output("threshold_data", "data"),
               Input("Submit_tab3", "n_clicks"),
-              State("datatable_tab3", "derived_virtual_data"))
-def update_network(n_clicks, input1):
+              State("datatable_tab3", "derived_virtual_data"),
+              State("list_key_tab3", "data"),
+              State("distances_tab3", "value"))
+def update_network(n_clicks, input1, list_key, statistic):
 
     genes_list = pd.DataFrame(input1)
 
-    sql_query_6 = \
-"""SELECT Primary_SGDID, Chromosome, Feature_name, Strand, Stop_coordinate, Start_coordinate
-FROM SGD_features
-"""
-
-    Feature_name = tools.get_locus_info("./static/SCERE.db", sql_query_6)
-    Feature_name = Feature_name.merge(genes_list, left_on="Feature_name", right_on=genes_list.columns[0])
+    Feature_name = all_feature_name.merge(genes_list, left_on="Feature_name", right_on=genes_list.columns[0]) \
+        if len(genes_list.columns) else all_feature_name.iloc[:0]
 
     nodes = [{"data": {"id": Primary_SGDID, "label": Feature_name}}
          for Primary_SGDID, Feature_name in zip(Feature_name["Primary_SGDID"], Feature_name["Feature_name"])
         ]
 
-    edges_list_select = tools.get_edges_list(genes_list, edges_list, all_feature_name)
+    # The edges come from the state of the list, updated with the edited genes only
+    state = get_list_state_tab3(list_key, input1, statistic)
+    sgdids = get_distances_tab3(statistic)[0].to_numpy()
+    source, target, weights = gene_lists.get_list_pairs(state)
 
-    edges = [{"data": {"source": source, "target": target, "weight": float(weight)}}
-             for source, target, weight in zip(edges_list_select["Primary_SGDID_bis"], edges_list_select["Primary_SGDID"], edges_list_select["3D_distances"])
+    edges = [{"data": {"source": source, "target": target, "weight": weight}}
+             for source, target, weight in zip(sgdids[source], sgdids[target], weights.tolist())
             ]
 
     elements = nodes + edges
-    slider_max = max(edges_list_select["3D_distances"])
-    slider_min = min(edges_list_select["3D_distances"])
+    # Less than 2 located genes while the list is being built: the default range of the slider
+    slider_min, slider_max = (float(weights[0]), float(weights[-1])) if len(weights) else (0, 10)
 
-    return elements, slider_min, slider_max, "min {}".format(round(slider_min)), "max {}".format(round(slider_max))
+    if CLIENTSIDE_THRESHOLD:
+        threshold_data = gene_lists.get_threshold_summary(state)
+        threshold_data["stylesheet"] = basic_stylesheet
+    else:
+        threshold_data = dash.no_update
 
-############TAB3_SLIDER_OUTPUT############
-@app.callback(Output("output_value_slider", "children"),
-              Input("treshold_slider", "value"))
-def update_slider_output(value):
-    return "3D distances in network are inferior to {}".format(value)
+    return elements, slider_min, slider_max, "min {}".format(round(slider_min)), "max {}".format(round(slider_max)), threshold_data
 
-############TAB3_HIST############
-@app.callback(Output("hist", component_property="src"),
+############TAB3_EXPORT############
+@app.callback(Output("export_links_tab3", "children"),
               Input("Submit_tab3", "n_clicks"),
               Input("treshold_slider", "value"),
-              State("datatable_tab3", "derived_virtual_data"))
-def update_hist(n_clicks, input1, input2):
-
-    genes_list = pd.DataFrame(input2)
-
-    fig = tools.distri(genes_list, edges_list, all_feature_name, H2, F2, BIN_NUMBER, input1)
-
-    out_url = tools.fig_to_uri(fig)
+              State("datatable_tab3", "derived_virtual_data"),
+              State("list_key_tab3", "data"))
+def update_export_links_tab3(n_clicks, treshold, data, list_key):
 
-    return out_url
+    if data:
+        genes_list = pd.DataFrame(data)
+        return get_export_links(str(list_key), genes_list[genes_list.columns[0]].dropna().astype(str), treshold)
 
-############TAB3_NETWORK_TRESHOLD############
-@app.callback(Output("network", "stylesheet"),
-              Input("treshold_slider", "value"))
-def update_stylesheet_(treshold):
-    new_styles = [{"selector": "[weight >" + str(treshold) + "]", "style": {"opacity": 0}}]
-    stylesheet = basic_stylesheet + new_styles
-
-    return stylesheet
-
-############TAB3_NETWORK_METRICS############
-@app.callback(Output("output_nodes_number_tab3", "children"),
-              Input("treshold_slider", "value"),
-              Input("network", "elements"))
-def update_metrics_1(treshold, elements):
-
-    subgraph_edges = pd.DataFrame(elements)
-    subgraph_edges = pd.json_normalize(subgraph_edges["data"])
-    subgraph_edges = subgraph_edges[subgraph_edges["weight"] < treshold]
-
-    G = nx.from_pandas_edgelist(subgraph_edges, source="source", target="target")
-
-    return "number of connected nodes : " + str(G.number_of_nodes())
-
-@app.callback(Output("output_edges_number_tab3", "children"),
-              Input("treshold_slider", "value"),
-              Input("network", "elements"))
-def update_metrics_2(treshold, elements):
-
-    subgraph_edges = pd.DataFrame(elements)
-    subgraph_edges = pd.json_normalize(subgraph_edges["data"])
-    subgraph_edges = subgraph_edges[subgraph_edges["weight"] < treshold]
-
-    G = nx.from_pandas_edgelist(subgraph_edges, source="source", target="target")
-
-    return "number of edges : " + str(G.number_of_edges())
-
-@app.callback(Output("Degrees_hist", "figure"),
-              Input("treshold_slider", "value"),
-              Input("network", "elements"))
-def update_metrics_3(treshold, elements):
+############TAB3_LISTS_COMPARISON############
+@app.callback(Output("lists_job_tab3", "data"),
+              Output("lists_message_tab3", "children"),
+              Input("Submit_tab3", "n_clicks"),
+              State("datatable_tab3", "derived_virtual_data"),
+              State("datatable_tab3", "selected_columns"),
+              State("list_key_tab3", "data"))
+def submit_lists_comparison_tab3(n_clicks, data, columns, list_key):
+
+    if not columns or len(columns) < 2:
+        return dash.no_update, dash.no_update
+
+    data = pd.DataFrame(data)
+    lists_positions = {str(column): distances.get_loci_positions(distance_sgdids, all_feature_name, data[column].dropna().astype(str))
+                       for column in columns}
+    lists_positions = {name: positions for name, positions in lists_positions.items() if len(positions) > 0}
+
+    # A new submit of the same table cancels the running comparison
+    job, message = submit_job(str(list_key), distances.compare_lists, jobs.SharedData("distance_matrix"), lists_positions)
+    if job is not dash.no_update:
+        job["names"] = list(lists_positions)
+
+    return job, message
+
+############TAB3_LISTS_COMPARISON_PROGRESS############
+@app.callback(Output("lists_progress_tab3", "value"),
+              Output("lists_progress_tab3", "children"),
+              Output("lists_progress_tab3", "style"),
+              Output("lists_result_tab3", "data"),
+              Output("lists_interval_tab3", "disabled"),
+              Input("lists_interval_tab3", "n_intervals"),
+              Input("lists_job_tab3", "data"))
+def update_lists_progress_tab3(n_intervals, job):
+
+    value, label, style, status = get_job_progress(job)
+
+    return value, label, style, job if status == "done" else dash.no_update, status not in ("queued", "running")
+
+############TAB3_LISTS_COMPARISON_FIGURES############
+@app.callback(Output("lists_heatmap_tab3", "figure"),
+              Output("lists_cdf_tab3", "figure"),
+              Input("lists_result_tab3", "data"),
+              Input("lists_statistic_tab3", "value"))
+def update_lists_comparison_tab3(job, statistic):
+
+    result = job_executor.get_result(job["id"]) if job else None
+    if result is None:
+        return dash.no_update, dash.no_update
+
+    summary, histograms = result
+
+    # Symmetric matrix of the summary statistic
+    names = job["names"]
+    matrix = summary.pivot(index="list_1", columns="list_2", values=statistic).reindex(index=names, columns=names)
+    matrix = matrix.combine_first(matrix.T)
+    pairs = summary.pivot(index="list_1", columns="list_2", values="pairs").reindex(index=names, columns=names)
+    pairs = pairs.combine_first(pairs.T)
+
+    with metrics.stage("figure"):
+        heatmap = go.Figure(data=go.Heatmap(z=matrix.to_numpy(),
+                                            x=names,
+                                            y=names,
+                                            customdata=pairs.to_numpy(),
+                                            colorscale="Viridis_r",
+                                            colorbar={"title": "{} 3D distance".format(statistic)},
+                                            hovertemplate=("<b>Lists :</b> %{x} - %{y} <br>"
+                                                           "<b>Pairs :</b> %{customdata} <br>"
+                                                           "<b>" + statistic.capitalize() + " 3D distance :</b> %{z:.1f}"
+                                                           "<extra></extra>")))
+        heatmap.update_layout(plot_bgcolor="white",
+                              height=500)
+        heatmap.update_xaxes(type="category")
+        heatmap.update_yaxes(type="category", autorange="reversed")
+
+        # Cumulative distributions, with the distances between all genes as reference
+        bins = np.arange(1, histograms.shape[1] + 1) * 200 / histograms.shape[1]
+        cdf = go.Figure()
+        cdf.add_trace(go.Scatter(x=X[1:], y=F2, mode="lines", name="All genes",
+                                 line={"color": "black", "dash": "dash"}))
+        for (list_1, list_2), histogram in zip(zip(summary["list_1"], summary["list_2"]), histograms):
+            if histogram.sum() > 0:
+                name = list_1 if list_1 == list_2 else "{} - {}".format(list_1, list_2)
+                cdf.add_trace(go.Scatter(x=bins[::10], y=(np.cumsum(histogram) / histogram.sum())[::10], mode="lines", name=name,
+                                         line={"dash": "solid" if list_1 == list_2 else "dot"}))
+        cdf.update_layout(plot_bgcolor="white",
+                          height=500,
+                          xaxis_title="3D distances",
+                          yaxis_title="CDF")
+
+    return heatmap, cdf
+
+if CLIENTSIDE_THRESHOLD:
+
+    ############TAB3_HIST############
+    @app.callback(Output("hist_job_tab3", "data"),
+                  Output("hist_message_tab3", "children"),
+                  Input("Submit_tab3", "n_clicks"),
+                  State("datatable_tab3", "derived_virtual_data"),
+                  State("list_key_tab3", "data"),
+                  State("distances_tab3", "value"))
+    def update_hist(n_clicks, input2, list_key, statistic):
+
+        state = get_list_state_tab3(list_key, input2, statistic)
+
+        # Rendered in a background job, from the bin counts of the list
+        return submit_job("{}/hist".format(list_key), tools.draw_histogram, state["histogram"], state["pairs"],
+                          *get_background_histogram_tab3(statistic), BIN_NUMBER, None)
+
+    ############TAB3_HIST_PROGRESS############
+    @app.callback(Output("hist", component_property="src"),
+                  Output("hist_axes", "data"),
+                  Output("hist_progress_tab3", "value"),
+                  Output("hist_progress_tab3", "children"),
+                  Output("hist_progress_tab3", "style"),
+                  Output("hist_interval_tab3", "disabled"),
+                  Input("hist_interval_tab3", "n_intervals"),
+                  Input("hist_job_tab3", "data"))
+    def update_hist_progress(n_intervals, job):
+
+        value, label, style, status = get_job_progress(job)
+        result = get_job_result(job, status)
+        # Axes position (figure fraction), used to draw the threshold line in the browser
+        out_url, hist_axes = result if result is not dash.no_update else (dash.no_update, dash.no_update)
+
+        return out_url, hist_axes, value, label, style, status not in ("queued", "running")
+
+    ############TAB3_SLIDER_CLIENTSIDE############
+    app.clientside_callback(ClientsideFunction(namespace="threshold", function_name="slider_output"),
+                            Output("output_value_slider", "children"),
+                            Input("treshold_slider", "value"))
+
+    app.clientside_callback(ClientsideFunction(namespace="threshold", function_name="hist_line"),
+                            Output("hist_threshold_line", "style"),
+                            Input("treshold_slider", "value"),
+                            Input("hist_axes", "data"))
+
+    app.clientside_callback(ClientsideFunction(namespace="threshold", function_name="stylesheet"),
+                            Output("network", "stylesheet"),
+                            Input("treshold_slider", "value"),
+                            Input("threshold_data", "data"))
+
+    app.clientside_callback(ClientsideFunction(namespace="threshold", function_name="metrics"),
+                            Output("output_edges_number_tab3", "children"),
+                            Output("output_nodes_number_tab3", "children"),
+                            Output("Degrees_hist", "figure"),
+                            Input("treshold_slider", "value"),
+                            Input("threshold_data", "data"))
+
+else:
+
+    ############TAB3_SLIDER_OUTPUT############
+    @app.callback(Output("output_value_slider", "children"),
+                  Input("treshold_slider", "value"))
+    def update_slider_output(value):
+        return "3D distances in network are inferior to {}".format(value)
+
+    ############TAB3_HIST############
+    @app.callback(Output("hist_job_tab3", "data"),
+                  Output("hist_message_tab3", "children"),
+                  Input("Submit_tab3", "n_clicks"),
+                  Input("treshold_slider", "value"),
+                  State("datatable_tab3", "derived_virtual_data"),
+                  State("list_key_tab3", "data"),
+                  State("distances_tab3", "value"))
+    def update_hist(n_clicks, input1, input2, list_key, statistic):
+
+        state = get_list_state_tab3(list_key, input2, statistic)
+
+        # Rendered in a background job, a slider move cancels the rendering of the previous threshold
+        return submit_job("{}/hist".format(list_key), tools.draw_histogram, state["histogram"], state["pairs"],
+                          *get_background_histogram_tab3(statistic), BIN_NUMBER, input1)
+
+    ############TAB3_HIST_PROGRESS############
+    @app.callback(Output("hist", component_property="src"),
+                  Output("hist_progress_tab3", "value"),
+                  Output("hist_progress_tab3", "children"),
+                  Output("hist_progress_tab3", "style"),
+                  Output("hist_interval_tab3", "disabled"),
+                  Input("hist_interval_tab3", "n_intervals"),
+                  Input("hist_job_tab3", "data"))
+    def update_hist_progress(n_intervals, job):
+
+        value, label, style, status = get_job_progress(job)
+        result = get_job_result(job, status)
+
+        return result[0] if result is not dash.no_update else dash.no_update, value, label, style, status not in ("queued", "running")
+
+    ############TAB3_NETWORK_TRESHOLD############
+    @app.callback(Output("network", "stylesheet"),
+                  Input("treshold_slider", "value"))
+    def update_stylesheet_(treshold):
+        new_styles = [{"selector": "[weight >" + str(treshold) + "]", "style": {"opacity": 0}}]
+        stylesheet = basic_stylesheet + new_styles
+
+        return stylesheet
+
+    ############TAB3_NETWORK_METRICS############
+    @app.callback(Output("output_nodes_number_tab3", "children"),
+                  Input("treshold_slider", "value"),
+                  Input("network", "elements"))
+    def update_metrics_1(treshold, elements):
+
+        subgraph_edges = pd.DataFrame(elements)
+        subgraph_edges = pd.json_normalize(subgraph_edges["data"])
+        subgraph_edges = subgraph_edges[subgraph_edges["weight"] < treshold]
+
+        import networkx as nx
+        G = nx.from_pandas_edgelist(subgraph_edges, source="source", target="target")
+
+        return "number of connected nodes : " + str(G.number_of_nodes())
+
+    @app.callback(Output("output_edges_number_tab3", "children"),
+                  Input("treshold_slider", "value"),
+                  Input("network", "elements"))
+    def update_metrics_2(treshold, elements):
+
+        subgraph_edges = pd.DataFrame(elements)
+        subgraph_edges = pd.json_normalize(subgraph_edges["data"])
+        subgraph_edges = subgraph_edges[subgraph_edges["weight"] < treshold]
+
+        import networkx as nx
+        G = nx.from_pandas_edgelist(subgraph_edges, source="source", target="target")
+
+        return "number of edges : " + str(G.number_of_edges())
+
+    @app.callback(Output("Degrees_hist", "figure"),
+                  Input("treshold_slider", "value"),
+                  Input("network", "elements"))
+    def update_metrics_3(treshold, elements):
+
+        subgraph_edges = pd.DataFrame(elements)
+        subgraph_edges = pd.json_normalize(subgraph_edges["data"])
+        subgraph_edges = subgraph_edges[subgraph_edges["weight"] < treshold]
+
+        import networkx as nx
+        G = nx.from_pandas_edgelist(subgraph_edges, source="source", target="target")
+
+        degrees = [val for (node, val) in G.degree()]
+        with metrics.stage("figure"):
+            fig = px.histogram(degrees, nbins=70, color_discrete_sequence=["#A0E8AF"], labels={"value": "degrees"})
+            fig.update_layout(plot_bgcolor="white",
+                              xaxis_showgrid=False,
+                              yaxis_showgrid=False,
+                              showlegend=False)
 
-    subgraph_edges = pd.DataFrame(elements)
-    subgraph_edges = pd.json_normalize(subgraph_edges["data"])
-    subgraph_edges = subgraph_edges[subgraph_edges["weight"] < treshold]
+        return fig
 
-    G = nx.from_pandas_edgelist(subgraph_edges, source="source", target="target")
 
-    degrees = [val for (node, val) in G.degree()]
-    fig = px.histogram(degrees, nbins=70, color_discrete_sequence=["#A0E8AF"], labels={"value": "degrees"})
-    fig.update_layout(plot_bgcolor="white",
-                      xaxis_showgrid=False,
-                      yaxis_showgrid=False,
-                      showlegend=False)
+########################
+############STARTUP############
+########################
 
-    return fig
+def post_callback(client, outputs, inputs, state=()):
+    """Call a callback through the Dash endpoint, outputs and properties as "id.property"."""
+    def get_property(name, value=None):
+        component_id, component_property = name.split(".")
+        return {"id": component_id, "property": component_property, "value": value}
+
+    outputs_list = [get_property(output) for output in outputs]
+    for spec in outputs_list:
+        del spec["value"]
+    return client.post("/_dash-update-component",
+                       json={"output": outputs[0] if len(outputs) == 1 else ".." + "...".join(outputs) + "..",
+                             "outputs": outputs_list[0] if len(outputs) == 1 else outputs_list,
+                             "inputs": [get_property(name, value) for name, value in inputs],
+                             "state": [get_property(name, value) for name, value in state],
+                             "changedPropIds": [inputs[0][0]]})
+
+def warm_up():
+    """Pre-render the figures of the demo genes list, through the callbacks (imports, plotly validators, caches).
+
+    The 3D figure and the histogram are queued as background jobs: they warm up the worker process running them.
+    """
+    client = server.test_client()
+    table = demo_1.to_dict("records")
+    tab1_state = [("GoTerm-dropdown.value", None), ("color-dropdown.value", None),
+                  ("datatable_tab1.derived_virtual_data", table), ("datatable_tab1.selected_columns", [demo_1.columns[0]])]
+    tab3_state = [("datatable_tab3.derived_virtual_data", table), ("list_key_tab3.data", "warm_up"), ("distances_tab3.value", "reference")]
+
+    post_callback(client, ["2D_representation.figure"], [("Submit_tab1.n_clicks", 1), ("go_term_click.data", None)], tab1_state)
+    post_callback(client, ["3D_job_tab1.data", "3D_message_tab1.children"], [("Submit_tab1.n_clicks", 1), ("go_term_click.data", None)],
+                  tab1_state + [("list_key_tab1.data", "warm_up")])
+    post_callback(client, ["Chromosomes_repartition.figure"], [("Submit_tab1.n_clicks", 1)], tab1_state[2:])
+    if CLIENTSIDE_THRESHOLD:
+        post_callback(client, ["hist_job_tab3.data", "hist_message_tab3.children"], [("Submit_tab3.n_clicks", 1)], tab3_state)
+    else:
+        post_callback(client, ["hist_job_tab3.data", "hist_message_tab3.children"], [("Submit_tab3.n_clicks", 1), ("treshold_slider.value", 50)], tab3_state)
+
+def prepare_server():
+    """Load the reference data, then optionally pre-render the figures, recording the startup times for /ready."""
+    try:
+        load_reference_data()
+    except Exception as exception:
+        startup_status.update(status="error", error="{}: {}".format(type(exception).__name__, exception))
+        reference_loaded.set()
+        raise
+    startup_status["loaded"] = time.time() - startup_status["started"]
+    reference_loaded.set()
+
+    # Requested by the browsers on the first visit (assets/figures.js): built before it, not while they poll
+    get_chromosomes_figure_3D()
+    if WARMUP:
+        warm_up()
+    startup_status.update(status="ready", ready=time.time() - startup_status["started"])
+
+if BACKGROUND_LOADING:
+    threading.Thread(target=prepare_server, name="prepare_server", daemon=True).start()
+else:
+    prepare_server()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,51 @@
+// Figures served by the server routes (/figures/...) instead of the callbacks.
+// They are GET requests: the browser cache keeps them and revalidates them with their ETag.
+// Dash 1.x clientside callbacks cannot return a promise: the figure is requested asynchronously
+// and an interval polls the request until the figure can be shown, without blocking the page.
+
+// url: {figure, failed, shown}
+var figure_requests = {};
+
+function request_figure(url) {
+    var request = {"figure": null, "failed": false, "shown": false};
+    figure_requests[url] = request;
+    fetch(url, {"credentials": "same-origin"})
+        .then(function(response) {
+            if (!response.ok) {
+                throw new Error(response.status);
+            }
+            return response.json();
+        })
+        .then(function(figure) {
+            request.figure = figure;
+        })
+        .catch(function() {
+            request.failed = true;
+        });
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    figures: {
+        load: function(n_clicks, n_intervals, url) {
+            // Outputs: the figure, and whether the polling interval is disabled
+            var request = figure_requests[url];
+            if (!request) {
+                request_figure(url);
+                return [window.dash_clientside.no_update, false];
+            }
+            if (request.failed) {
+                // Requested again at the next submit
+                delete figure_requests[url];
+                return [window.dash_clientside.no_update, true];
+            }
+            if (request.figure === null) {
+                return [window.dash_clientside.no_update, false];
+            }
+            if (request.shown) {
+                return [window.dash_clientside.no_update, true];
+            }
+            request.shown = true;
+            return [request.figure, true];
+        }
+    }
+});
@@ -0,0 +1,77 @@
+// Client-side threshold filtering for the 3D distances network (Tab 3).
+// The edges sorted by 3D distance are sent once after submit (threshold_data store),
+// so the slider moves are handled in the browser without server round trips.
+
+function edges_under(weights, treshold) {
+    // Number of edges with a weight strictly inferior to the treshold (binary search).
+    var low = 0;
+    var high = weights.length;
+    while (low < high) {
+        var middle = (low + high) >>> 1;
+        if (weights[middle] < treshold) {
+            low = middle + 1;
+        } else {
+            high = middle;
+        }
+    }
+    return low;
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    threshold: {
+        slider_output: function(value) {
+            return "3D distances in network are inferior to " + value;
+        },
+
+        hist_line: function(value, axes) {
+            if (!axes || value === undefined || value === null) {
+                return {"display": "none"};
+            }
+            var position = axes.x0 + (axes.x1 - axes.x0) * Math.min(Math.max(value / axes.xmax, 0), 1);
+            return {"position": "absolute",
+                    "left": (100 * position) + "%",
+                    "top": (100 * (1 - axes.y1)) + "%",
+                    "height": (100 * (axes.y1 - axes.y0)) + "%",
+                    "borderLeft": "2px dashed black"};
+        },
+
+        stylesheet: function(treshold, data) {
+            var stylesheet = data ? data.stylesheet.slice() : [];
+            stylesheet.push({"selector": "[weight >" + treshold + "]", "style": {"opacity": 0}});
+            return stylesheet;
+        },
+
+        metrics: function(treshold, data) {
+            if (!data) {
+                return [window.dash_clientside.no_update,
+                        window.dash_clientside.no_update,
+                        window.dash_clientside.no_update];
+            }
+            var edges_number = edges_under(data.weights, treshold);
+
+            // Degrees of the nodes connected by the edges under the treshold
+            var degrees_by_node = new Map();
+            for (var i = 0; i < edges_number; i++) {
+                degrees_by_node.set(data.source[i], (degrees_by_node.get(data.source[i]) || 0) + 1);
+                degrees_by_node.set(data.target[i], (degrees_by_node.get(data.target[i]) || 0) + 1);
+            }
+            var degrees = Array.from(degrees_by_node.values());
+
+            var figure = {
+                "data": [{"type": "histogram",
+                          "x": degrees,
+                          "nbinsx": 70,
+                          "name": "degrees",
+                          "marker": {"color": "#A0E8AF"}}],
+                "layout": {"plot_bgcolor": "white",
+                           "xaxis": {"showgrid": false, "title": {"text": "degrees"}},
+                           "yaxis": {"showgrid": false, "title": {"text": "count"}},
+                           "showlegend": false}
+            };
+
+            return ["number of edges : " + edges_number,
+                    "number of connected nodes : " + edges_under(data.first_weights, treshold),
+                    figure];
+        }
+    }
+});
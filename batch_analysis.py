@@ -0,0 +1,335 @@
+"""
+Run the 3D-Scere analyses on a directory of gene lists, without the dashboard.
+
+Each list (.csv or .xls with the YORF in the first column, .txt with one YORF per
+line, or .bed genomic intervals) is analysed as in the dashboard: chromosome
+distribution, 3D distances histogram, network metrics at the given thresholds,
+3D compactness statistics (size-matched random gene sets, as go_atlas.py) and 3D
+crowding and periphery bias (crowding tracks, size-matched random gene sets).
+
+Lists are processed in parallel, the results of each list are written as soon as
+they are computed: an interrupted run resumes from the completed lists. The results
+of all the lists are then gathered in one Parquet file per table.
+"""
+
+import argparse
+import base64
+import os
+import shutil
+import tempfile
+import time
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+
+import lib.crowding as crowding
+import lib.distances as distances
+import lib.gene_lists as gene_lists
+import lib.genomes as genomes
+import lib.intervals as intervals
+import lib.spatial as spatial
+import lib.tools as tools
+import lib.visualization_2D as vis2D
+
+TABLES = ["summary", "chromosomes", "histogram", "network", "crowding"]
+LIST_EXTENSIONS = (".csv", ".txt", ".xls", ".xlsx", ".bed")
+
+BIN_NUMBER = 50
+MAX_DISTANCE = 200
+
+SQL_QUERY = \
+"""SELECT Primary_SGDID, Feature_name, Start_coordinate, Stop_coordinate, Chromosome, Strand
+FROM SGD_features
+ORDER BY Start_coordinate
+"""
+
+# Reference data shared with the worker processes
+_matrix = None
+_reference = None
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("lists",
+                        help="directory of gene lists")
+    parser.add_argument("--output", default="./batch_results",
+                        help="output directory, also used to resume (default: %(default)s)")
+    parser.add_argument("--database", default="./static/SCERE.db",
+                        help="SQLite database (default: %(default)s)")
+    parser.add_argument("--distances", default="./static/3D_distances.parquet.gzip",
+                        help="3D distances Parquet file, computed from --segments if missing (default: %(default)s)")
+    parser.add_argument("--segments", default="./static/plotly_segments.csv",
+                        help="3D segments coordinates (default: %(default)s)")
+    parser.add_argument("--cache", default=genomes.DISTANCES_CACHE,
+                        help="directory of the 3D distance stores, shared with the dashboard (default: %(default)s)")
+    parser.add_argument("--thresholds", type=float, nargs="+", default=[20, 40, 60],
+                        help="3D distance thresholds of the networks (default: %(default)s)")
+    parser.add_argument("--null-samples", type=int, default=100,
+                        help="number of random gene sets per list (default: %(default)s)")
+    parser.add_argument("--figures", choices=["none", "json", "html"], default="none",
+                        help="also write the plotly figures of each list, and its 3D distances histogram as png (default: %(default)s)")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(),
+                        help="number of worker processes (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="random generator seed (default: %(default)s)")
+    return parser.parse_args()
+
+def _init_worker(matrix, reference):
+    global _matrix, _reference
+    # Memory-mapped store: the worker processes share the pages of the matrix
+    _matrix = matrix
+    _reference = reference
+
+def read_genes_list(path, feature_name, interval_index):
+    """Read a genes list file.
+
+    Parameters
+    ----------
+    path : str
+        .csv or .xls (YORF in the first column, with a header), .txt (one YORF per line)
+        or .bed file (genomic intervals, converted to the overlapping loci).
+    feature_name : Pandas dataframe
+        Loci used to build interval_index.
+    interval_index : dict
+        Output of intervals.build_interval_index.
+
+    Returns
+    -------
+    list
+        Feature_name of the genes.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".bed":
+        with open(path) as bed_file:
+            genes = intervals.get_bed_loci(intervals.read_bed(bed_file.read()), feature_name, interval_index)["YORF"]
+    elif extension == ".txt":
+        genes = pd.read_csv(path, header=None, comment="#")[0]
+    elif extension in (".xls", ".xlsx"):
+        genes = pd.read_excel(path).iloc[:, 0]
+    else:
+        genes = pd.read_csv(path).iloc[:, 0]
+
+    return genes.dropna().astype(str).str.strip().drop_duplicates().tolist()
+
+def get_network_metrics(state, thresholds):
+    """Compute the network metrics of a genes list at several 3D distance thresholds.
+
+    Parameters
+    ----------
+    state : dict
+        Output of gene_lists.update_list_state.
+    thresholds : list
+        Edges are the 3D distances strictly inferior to the threshold (as the dashboard slider).
+
+    Returns
+    -------
+    Pandas dataframe
+        threshold, edges, connected_nodes, mean_degree, max_degree, components and
+        largest_component (connected nodes only).
+    """
+    source, target, weights = gene_lists.get_list_pairs(state)
+    forest_source, forest_target, forest_weights = state["forest"]
+    rows = []
+    for threshold in thresholds:
+        edges_number = int(np.searchsorted(weights, threshold, side="left"))
+        nodes, codes = np.unique(np.concatenate([source[:edges_number], target[:edges_number]]), return_inverse=True)
+        degrees = np.bincount(codes, minlength=len(nodes))
+
+        # The minimum spanning forest under the threshold has the same components, with less edges
+        forest_number = int(np.searchsorted(forest_weights, threshold, side="left"))
+        forest_codes = np.searchsorted(nodes, np.concatenate([forest_source[:forest_number], forest_target[:forest_number]]))
+        adjacency = sparse.coo_matrix((np.ones(forest_number), (forest_codes[:forest_number], forest_codes[forest_number:])),
+                                      shape=(len(nodes), len(nodes)))
+        components_number, labels = connected_components(adjacency, directed=False)
+
+        rows.append({"threshold": threshold,
+                     "edges": edges_number,
+                     "connected_nodes": len(nodes),
+                     "mean_degree": degrees.mean() if len(nodes) else 0.0,
+                     "max_degree": int(degrees.max()) if len(nodes) else 0,
+                     "components": components_number,
+                     "largest_component": int(np.bincount(labels).max()) if len(nodes) else 0})
+
+    return pd.DataFrame(rows)
+
+def get_figures(genes, chromosomes, state):
+    """Build the figures of a genes list.
+
+    Returns
+    -------
+    dict
+        2D genome representation and chromosomes distribution (plotly figures), and 3D distances
+        histogram (PNG bytes of the dashboard image, tools.distri_counts), if the list has pairs.
+    """
+    genome_2D = _reference["genome_2D"]
+    genome_2D = genome_2D.assign(colors_parameters=np.where(genome_2D["Feature_name"].isin(genes), "Targets", "Other"))
+    figures = {"2D_representation": vis2D.genome_drawing(genome_2D, _reference["chromosome_layout"], "colors_parameters", ["Targets"], ["red"])}
+
+    figures["chromosomes"] = go.Figure(go.Bar(x=chromosomes["chromosome"], y=chromosomes["genes"], marker_color="#5767FF"))
+    figures["chromosomes"].update_layout(plot_bgcolor="white", xaxis_title="chromosomes", yaxis_title="genes")
+    figures["chromosomes"].update_xaxes(dtick=1)
+
+    if state["pairs"] > 0:
+        # PNG image of the dashboard, bytes can be sent back from the worker processes
+        figure = tools.distri_counts(state["histogram"], state["pairs"], _reference["H2"], _reference["F2"], BIN_NUMBER, None)
+        figures["histogram"] = base64.b64decode(tools.fig_to_uri(figure).split(",", 1)[1])
+
+    return figures
+
+def analyse_list(task):
+    """Run the analyses of one genes list.
+
+    Parameters
+    ----------
+    task : tuple
+        List name, list file path, thresholds, number of random sets, seed, figures format.
+
+    Returns
+    -------
+    tuple
+        List name, dict of result tables (one row per list for summary) and dict of figures.
+    """
+    name, path, thresholds, null_samples, seed, figures_format = task
+    feature_name = _reference["feature_name"]
+
+    genes = read_genes_list(path, feature_name, _reference["interval_index"])
+    positions = distances.get_loci_positions(_reference["sgdids"], feature_name, genes)
+    state = gene_lists.update_list_state(gene_lists.get_empty_list_state(BIN_NUMBER, MAX_DISTANCE), _matrix, positions)
+
+    # Chromosome distribution
+    selected = feature_name[feature_name["Feature_name"].isin(genes)]
+    chromosome_ids = _reference["chromosome_layout"]["chromosome"].to_numpy()
+    counts = np.bincount(selected["Chromosome"].to_numpy(dtype=int), minlength=chromosome_ids.max() + 1)[chromosome_ids]
+    chromosomes = pd.DataFrame({"chromosome": chromosome_ids, "genes": counts})
+
+    # 3D distances histogram
+    pairs = state["pairs"]
+    bin_edges = np.linspace(0, MAX_DISTANCE, BIN_NUMBER + 1)
+    histogram = pd.DataFrame({"bin_start": bin_edges[:-1],
+                              "bin_end": bin_edges[1:],
+                              "count": state["histogram"],
+                              "density": state["histogram"] / pairs if pairs else np.nan,
+                              "cdf": np.cumsum(state["histogram"]) / pairs if pairs else np.nan})
+
+    network = get_network_metrics(state, thresholds)
+
+    # 3D crowding and periphery bias
+    track_positions = _reference["crowding_track"].index.get_indexer(selected["Primary_SGDID"])
+    crowding_bias = crowding.test_track_bias(_reference["crowding_track"], track_positions[track_positions >= 0], null_samples, seed)
+
+    # 3D compactness statistics
+    summary = {"list": name, "genes": len(genes), "genes_with_distances": len(positions), "pairs": pairs,
+               "mean_distance": np.nan, "median_distance": np.nan, "null_mean": np.nan, "null_sd": np.nan,
+               "z_score": np.nan, "p_value": np.nan, "cdf_max_difference": np.nan}
+    if pairs > 0:
+        weights = gene_lists.get_list_pairs(state)[2]
+        mean = float(weights.mean(dtype=np.float64))
+        summary.update({"mean_distance": mean,
+                        "median_distance": float(np.median(weights)),
+                        # Kolmogorov-Smirnov like distance to all the genes, positive when the list is closer
+                        "cdf_max_difference": float(np.max(histogram["cdf"].to_numpy() - _reference["F2"]))})
+        if len(positions) < len(_reference["sgdids"]):
+            null = distances.get_random_set_means(_matrix, np.arange(len(_reference["sgdids"])), len(positions), null_samples, seed)
+            null_sd = np.nanstd(null)
+            summary.update({"null_mean": np.nanmean(null),
+                            "null_sd": null_sd,
+                            "z_score": (mean - np.nanmean(null)) / null_sd if null_sd > 0 else np.nan,
+                            # Compact lists have smaller distances than the random sets
+                            "p_value": ((null <= mean).sum() + 1) / (null_samples + 1)})
+
+    tables = {"summary": pd.DataFrame([summary]),
+              "chromosomes": chromosomes,
+              "histogram": histogram,
+              "network": network,
+              "crowding": crowding_bias}
+    figures = get_figures(genes, chromosomes, state) if figures_format != "none" else {}
+
+    return name, tables, figures
+
+def write_list_results(output, name, tables, figures, figures_format):
+    """Write the results of one list, the list directory appears only once complete."""
+    list_directory = os.path.join(output, "lists", name)
+    temporary_directory = tempfile.mkdtemp(dir=os.path.join(output, "lists"), prefix=".tmp_")
+
+    for table, data in tables.items():
+        if "list" not in data.columns:
+            data.insert(0, "list", name)
+        data.to_parquet(os.path.join(temporary_directory, table + ".parquet"), engine="pyarrow", index=False)
+    for figure_name, figure in figures.items():
+        if isinstance(figure, bytes):
+            with open(os.path.join(temporary_directory, figure_name + ".png"), "wb") as image_file:
+                image_file.write(figure)
+        elif figures_format == "json":
+            figure.write_json(os.path.join(temporary_directory, figure_name + ".json"))
+        else:
+            figure.write_html(os.path.join(temporary_directory, figure_name + ".html"), include_plotlyjs="cdn")
+
+    if os.path.exists(list_directory):
+        shutil.rmtree(list_directory)
+    os.rename(temporary_directory, list_directory)
+
+def gather_results(output):
+    """Concatenate the results of all the lists in one Parquet file per table."""
+    lists_directory = os.path.join(output, "lists")
+    names = sorted(name for name in os.listdir(lists_directory) if not name.startswith("."))
+
+    for table in TABLES:
+        paths = [os.path.join(lists_directory, name, table + ".parquet") for name in names]
+        data = pd.concat([pd.read_parquet(path, engine="pyarrow") for path in paths], ignore_index=True) if paths else pd.DataFrame()
+        data.to_parquet(os.path.join(output, table + ".parquet"), engine="pyarrow", index=False)
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    feature_name = tools.get_locus_info(args.database, SQL_QUERY)
+
+    sgdids, matrix = genomes.open_distance_matrix(args.distances, args.segments, feature_name, args.cache)
+    counts, _, pairs_number = distances.get_distance_histogram(matrix, bin_number=BIN_NUMBER, max_distance=MAX_DISTANCE)
+    H2 = counts / pairs_number
+    F2 = np.cumsum(H2) / H2.sum()
+
+    # Crowding track of the bundle (crowding_track.py), or computed from the segments
+    crowding_file = os.path.join(os.path.dirname(args.database), genomes.CROWDING_FILE)
+    if os.path.exists(crowding_file):
+        crowding_track = pd.read_parquet(crowding_file, engine="pyarrow").set_index("Primary_SGDID")
+    else:
+        centroids = spatial.get_locus_centroids(pd.read_csv(args.segments))
+        crowding_track = crowding.compute_crowding_track(centroids, spatial.build_spatial_index(centroids))
+
+    reference = {"feature_name": feature_name,
+                 "interval_index": intervals.build_interval_index(feature_name),
+                 "sgdids": sgdids,
+                 "H2": H2,
+                 "F2": F2,
+                 "crowding_track": crowding_track,
+                 # Chromosome labels from the genome.json manifest next to the database, if any
+                 "chromosome_layout": vis2D.get_chromosome_layout(args.database, labels=genomes.read_manifest(os.path.dirname(args.database)).get("chromosome_labels")),
+                 # The 2D coordinates are the same for all the lists
+                 "genome_2D": vis2D.format_coordinates(feature_name, vis2D.SPACE_BETWEEN_CHROMOSOMES) if args.figures != "none" else None}
+
+    # Resume from the completed lists
+    os.makedirs(os.path.join(args.output, "lists"), exist_ok=True)
+    completed = set(name for name in os.listdir(os.path.join(args.output, "lists")) if not name.startswith("."))
+    files = sorted(file for file in os.listdir(args.lists) if file.lower().endswith(LIST_EXTENSIONS))
+    tasks = [(os.path.splitext(file)[0], os.path.join(args.lists, file), args.thresholds, args.null_samples, args.seed + i, args.figures)
+             for i, file in enumerate(files) if os.path.splitext(file)[0] not in completed]
+    print("lists: {} ({} completed, {} to compute)".format(len(files), len(files) - len(tasks), len(tasks)))
+
+    start = time.perf_counter()
+    pairs_number = 0
+    with multiprocessing.Pool(args.processes, initializer=_init_worker, initargs=(matrix, reference)) as pool:
+        for done, (name, tables, figures) in enumerate(pool.imap_unordered(analyse_list, tasks), start=1):
+            write_list_results(args.output, name, tables, figures, args.figures)
+            pairs_number += int(tables["summary"]["pairs"].iloc[0])
+
+            elapsed = time.perf_counter() - start
+            print("{}/{} {} ({:.2f} lists/s, {:.0f} pairs/s)".format(done, len(tasks), name,
+                                                                     done / elapsed, pairs_number / elapsed))
+
+    gather_results(args.output)
+    print("results written to {}".format(args.output))
@@ -0,0 +1,422 @@
+"""
+Time the hot paths of the dashboard on reference data (e.g. from make_synthetic_data.py).
+
+The library functions are timed directly, the dashboard callbacks through the Dash
+HTTP endpoint (including the JSON serialization of their outputs). The startup of a
+dashboard server is timed too (listening, first callback answered, ready). The results are
+written as a JSON file named after the current git commit; --compare prints the
+ratio of the timings with a previous results file.
+"""
+
+import argparse
+import json
+import os
+import platform
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+import numpy as np
+import pandas as pd
+
+REPOSITORY = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, REPOSITORY)
+
+import lib.chromosomes as chromosomes
+import lib.crowding as crowding
+import lib.distance_decay as distance_decay
+import lib.gene_lists as gene_lists
+import lib.tools as tools
+import lib.visualization_2D as vis2D
+import lib.visualization_3D as vis3D
+
+SQL_QUERY_GLOBAL = \
+"""SELECT Primary_SGDID, count(SGDID), Feature_name, Start_coordinate, Stop_coordinate, Chromosome, Strand, GO_slim_term
+FROM SGD_features, go_slim_mapping
+WHERE SGDID == Primary_SGDID
+GROUP BY SGDID
+ORDER BY Start_coordinate
+"""
+
+# name: function(context) returning the function to time, None if the data lacks what it needs
+BENCHMARKS = {}
+
+# Dashboard server started by measure_startup
+SERVER_SCRIPT = "import sys; sys.path.insert(0, {!r}); import app; app.app.run_server(port={})"
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data", default="./synthetic_data/static",
+                        help="directory with SCERE.db, plotly_segments.csv, 3D_distances.parquet.gzip and GO_terms.csv (default: %(default)s)")
+    parser.add_argument("--list-size", type=int, default=500,
+                        help="number of genes of the benchmarked genes list (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="number of timed runs of each benchmark, the first one is run once before (default: %(default)s)")
+    parser.add_argument("--only", default=None,
+                        help="regular expression selecting the benchmarks to run")
+    parser.add_argument("--output", default="./benchmark_results",
+                        help="output directory (default: %(default)s)")
+    parser.add_argument("--compare", default=None,
+                        help="previous results file to compare with")
+    return parser.parse_args()
+
+def benchmark(name):
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+def call_callback(client, outputs, inputs, state=()):
+    """Call a Dash callback through the HTTP endpoint, as the browser does."""
+    if len(outputs) == 1:
+        output = "{}.{}".format(*outputs[0])
+        outputs_spec = {"id": outputs[0][0], "property": outputs[0][1]}
+    else:
+        output = ".." + "...".join("{}.{}".format(*o) for o in outputs) + ".."
+        outputs_spec = [{"id": i, "property": p} for i, p in outputs]
+    body = {"output": output,
+            "outputs": outputs_spec,
+            "inputs": [{"id": i, "property": p, "value": v} for i, p, v in inputs],
+            "state": [{"id": i, "property": p, "value": v} for i, p, v in state],
+            "changedPropIds": ["{}.{}".format(*inputs[0][:2])]}
+    response = client.post("/_dash-update-component", json=body)
+    if response.status_code not in (200, 204):
+        raise RuntimeError("callback {} failed ({})".format(output, response.status_code))
+    return response.data
+
+def call_job_callback(client, outputs, inputs, state, poll_outputs, interval):
+    """Call a callback queuing a background job, then its progress callback as the browser does (dcc.Interval)
+    until the job is finished."""
+    job = json.loads(call_callback(client, outputs, inputs, state))["response"][outputs[0][0]][outputs[0][1]]
+    n_intervals = 0
+    while True:
+        data = call_callback(client, poll_outputs, [(interval, "n_intervals", n_intervals), (outputs[0][0], outputs[0][1], job)])
+        if json.loads(data)["response"][interval]["disabled"]:
+            return data
+        n_intervals += 1
+        time.sleep(0.01)
+
+def get_context(list_size):
+    # The dashboard reads ./static and ./example_data, the callbacks are computed on the server
+    os.environ["CLIENTSIDE_THRESHOLD"] = "0"
+    import app
+    app.reference_loaded.wait()
+
+    all_loci = tools.get_locus_info("./static/SCERE.db", SQL_QUERY_GLOBAL)
+    genes = app.all_feature_name["Feature_name"].sample(min(list_size, len(app.all_feature_name)), random_state=0).tolist()
+    go_term = all_loci["GO_slim_term"].value_counts().index[0]
+
+    context = {"app": app,
+               "client": app.server.test_client(),
+               "genes": genes,
+               "genes_list": pd.DataFrame({"TG": genes}),
+               "table": [{"TG": gene} for gene in genes],
+               "go_term": go_term,
+               "all_loci": all_loci,
+               "genome_2D": vis2D.format_coordinates(all_loci, vis2D.SPACE_BETWEEN_CHROMOSOMES),
+               "positions": app.distance_sgdids.get_indexer(app.all_feature_name.loc[app.all_feature_name["Feature_name"].isin(genes), "Primary_SGDID"])}
+    context["positions"] = context["positions"][context["positions"] >= 0]
+
+    loci = all_loci.assign(colors_parameters=np.where(all_loci["Feature_name"].isin(genes), "Targets", None))
+    loci_segments = app.plotly_segments.merge(loci, on="Primary_SGDID", how="left", copy=False)
+    loci_segments.index = range(1, len(loci_segments) + 1)
+    context["loci_segments"] = loci_segments
+    context["figure_3D"] = vis3D.genome_drawing(vis3D.get_color_discreet_3D(loci_segments.copy(), "colors_parameters", ["Targets"], ["blue"]))
+
+    # Network elements of the genes list, as after submit
+    context["elements"] = json.loads(call_callback(context["client"], [("network", "elements"), ("treshold_slider", "min"), ("treshold_slider", "max"),
+                                                                       ("output_min_slider", "children"), ("output_max_slider", "children"),
+                                                                       ("threshold_data", "data")],
+                                                   [("Submit_tab3", "n_clicks", 1)],
+                                                   [("datatable_tab3", "derived_virtual_data", context["table"]), ("list_key_tab3", "data", "benchmark"), ("distances_tab3", "value", "reference")]))["response"]["network"]["elements"]
+    return context
+
+############LIBRARY############
+
+@benchmark("get_locus_info")
+def _(context):
+    return lambda: tools.get_locus_info("./static/SCERE.db", SQL_QUERY_GLOBAL)
+
+@benchmark("format_coordinates")
+def _(context):
+    return lambda: vis2D.format_coordinates(context["all_loci"], vis2D.SPACE_BETWEEN_CHROMOSOMES)
+
+@benchmark("format_chromosomes")
+def _(context):
+    return lambda: vis2D.format_chromosomes(vis2D.get_chromosome_layout("./static/SCERE.db"))
+
+@benchmark("genome_drawing_2D")
+def _(context):
+    return lambda: vis2D.genome_drawing(context["genome_2D"].copy(), context["app"].chromosome_layout, "GO_slim_term", [context["go_term"]], ["red"])
+
+@benchmark("list_chromosome_distances")
+def _(context):
+    app = context["app"]
+    return lambda: chromosomes.get_matrix_chromosome_distances(app.distance_matrix, app.distance_sgdids, app.all_feature_name,
+                                                               app.chromosome_layout["chromosome"].max(), positions=context["positions"])
+
+@benchmark("update_list_state")
+def _(context):
+    app = context["app"]
+    return lambda: gene_lists.update_list_state(gene_lists.get_empty_list_state(), app.distance_matrix, context["positions"])
+
+@benchmark("update_list_state_edit")
+def _(context):
+    app = context["app"]
+    state = gene_lists.update_list_state(gene_lists.get_empty_list_state(), app.distance_matrix, context["positions"])
+    edited = np.concatenate([context["positions"][10:], np.setdiff1d(np.arange(len(app.distance_sgdids)), context["positions"])[:10]])
+    return lambda: gene_lists.update_list_state(state, app.distance_matrix, edited)
+
+@benchmark("ensemble_list_state")
+def _(context):
+    # Only with an ensemble of 3D models (make_synthetic_data.py --models)
+    app = context["app"]
+    if app.model_ensemble is None:
+        return None
+    positions = app.model_ensemble.sgdids.get_indexer(app.distance_sgdids[context["positions"]])
+    matrix = app.model_ensemble.get_matrix("mean")
+    return lambda: gene_lists.update_list_state(gene_lists.get_empty_list_state(), matrix, positions[positions >= 0])
+
+@benchmark("compute_crowding_track")
+def _(context):
+    app = context["app"]
+    return lambda: crowding.compute_crowding_track(app.locus_centroids, app.spatial_index)
+
+@benchmark("get_decay_bins")
+def _(context):
+    app = context["app"]
+    return lambda: distance_decay.get_decay_bins(distance_decay.iter_cis_pairs(app.distance_matrix, app.reference_data["distance_chromosomes"],
+                                                                               app.reference_data["distance_midpoints"]))
+
+@benchmark("get_threshold_summary")
+def _(context):
+    app = context["app"]
+    state = gene_lists.update_list_state(gene_lists.get_empty_list_state(), app.distance_matrix, context["positions"])
+    return lambda: gene_lists.get_threshold_summary(state)
+
+@benchmark("distri_fig_to_uri")
+def _(context):
+    app = context["app"]
+    state = gene_lists.update_list_state(gene_lists.get_empty_list_state(), app.distance_matrix, context["positions"])
+    return lambda: tools.fig_to_uri(tools.distri_counts(state["histogram"], state["pairs"], app.H2, app.F2, app.BIN_NUMBER, 50))
+
+@benchmark("color_3D")
+def _(context):
+    return lambda: vis3D.get_color_discreet_3D(context["loci_segments"].copy(), "colors_parameters", ["Targets"], ["blue"])
+
+@benchmark("genome_drawing_3D")
+def _(context):
+    colored = vis3D.get_color_discreet_3D(context["loci_segments"].copy(), "colors_parameters", ["Targets"], ["blue"])
+    return lambda: vis3D.genome_drawing(colored)
+
+@benchmark("figure_serialization_3D")
+def _(context):
+    import plotly
+    return lambda: json.dumps(context["figure_3D"], cls=plotly.utils.PlotlyJSONEncoder)
+
+############CALLBACKS############
+
+@benchmark("callback_2D_graph_tab1")
+def _(context):
+    return lambda: call_callback(context["client"], [("2D_representation", "figure")],
+                                 [("Submit_tab1", "n_clicks", 1), ("go_term_click", "data", None)],
+                                 [("GoTerm-dropdown", "value", context["go_term"]), ("color-dropdown", "value", "red"),
+                                  ("datatable_tab1", "derived_virtual_data", context["table"]), ("datatable_tab1", "selected_columns", ["TG"])])
+
+@benchmark("callback_3D_graph_tab1")
+def _(context):
+    return lambda: call_job_callback(context["client"], [("3D_job_tab1", "data"), ("3D_message_tab1", "children")],
+                                     [("Submit_tab1", "n_clicks", 1), ("go_term_click", "data", None)],
+                                     [("GoTerm-dropdown", "value", context["go_term"]), ("color-dropdown", "value", "red"),
+                                      ("datatable_tab1", "derived_virtual_data", context["table"]), ("datatable_tab1", "selected_columns", ["TG"]),
+                                      ("list_key_tab1", "data", "benchmark")],
+                                     [("3D_representation", "figure"), ("3D_progress_tab1", "value"), ("3D_progress_tab1", "children"),
+                                      ("3D_progress_tab1", "style"), ("3D_interval_tab1", "disabled")], "3D_interval_tab1")
+
+@benchmark("callback_network_tab3")
+def _(context):
+    return lambda: call_callback(context["client"], [("network", "elements"), ("treshold_slider", "min"), ("treshold_slider", "max"),
+                                                     ("output_min_slider", "children"), ("output_max_slider", "children"), ("threshold_data", "data")],
+                                 [("Submit_tab3", "n_clicks", 1)],
+                                 [("datatable_tab3", "derived_virtual_data", context["table"]), ("list_key_tab3", "data", "benchmark"), ("distances_tab3", "value", "reference")])
+
+@benchmark("callback_hist_tab3")
+def _(context):
+    return lambda: call_job_callback(context["client"], [("hist_job_tab3", "data"), ("hist_message_tab3", "children")],
+                                     [("Submit_tab3", "n_clicks", 1), ("treshold_slider", "value", 50)],
+                                     [("datatable_tab3", "derived_virtual_data", context["table"]), ("list_key_tab3", "data", "benchmark"),
+                                      ("distances_tab3", "value", "reference")],
+                                     [("hist", "src"), ("hist_progress_tab3", "value"), ("hist_progress_tab3", "children"),
+                                      ("hist_progress_tab3", "style"), ("hist_interval_tab3", "disabled")], "hist_interval_tab3")
+
+@benchmark("callback_metrics_nodes_tab3")
+def _(context):
+    return lambda: call_callback(context["client"], [("output_nodes_number_tab3", "children")],
+                                 [("treshold_slider", "value", 50), ("network", "elements", context["elements"])])
+
+@benchmark("callback_metrics_degrees_tab3")
+def _(context):
+    return lambda: call_callback(context["client"], [("Degrees_hist", "figure")],
+                                 [("treshold_slider", "value", 50), ("network", "elements", context["elements"])])
+
+############RUN############
+
+def measure_startup(genes, timeout=600):
+    """Start a dashboard server and time its startup: listening, first callback answered (sent as soon as
+    the server listens) and ready (/ready).
+
+    Returns
+    -------
+    dict
+        Durations in seconds from the server process start, by step.
+    """
+    with socket.socket() as free_socket:
+        free_socket.bind(("127.0.0.1", 0))
+        port = free_socket.getsockname()[1]
+    url = "http://127.0.0.1:{}".format(port)
+    body = {"output": "..network.elements...treshold_slider.min...treshold_slider.max...output_min_slider.children..."
+                      "output_max_slider.children...threshold_data.data..",
+            "outputs": [{"id": i, "property": p} for i, p in [("network", "elements"), ("treshold_slider", "min"), ("treshold_slider", "max"),
+                                                             ("output_min_slider", "children"), ("output_max_slider", "children"),
+                                                             ("threshold_data", "data")]],
+            "inputs": [{"id": "Submit_tab3", "property": "n_clicks", "value": 1}],
+            "state": [{"id": "datatable_tab3", "property": "derived_virtual_data", "value": [{"TG": gene} for gene in genes]},
+                      {"id": "list_key_tab3", "property": "data", "value": "startup"},
+                      {"id": "distances_tab3", "property": "value", "value": "reference"}],
+            "changedPropIds": ["Submit_tab3.n_clicks"]}
+
+    def get_status(path, data=None):
+        request = urllib.request.Request(url + path, data=data, headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as reply:
+                return reply.status
+        except urllib.error.HTTPError as exception:
+            return exception.code
+        except (urllib.error.URLError, ConnectionError):
+            return None
+
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, "-c", SERVER_SCRIPT.format(REPOSITORY, port)],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    durations = {}
+    try:
+        while get_status("/ready") is None:
+            if server.poll() is not None or time.perf_counter() - start > timeout:
+                raise RuntimeError("the dashboard server did not start")
+            time.sleep(0.05)
+        durations["startup_listening"] = time.perf_counter() - start
+        get_status("/_dash-update-component", json.dumps(body).encode())
+        durations["startup_first_callback"] = time.perf_counter() - start
+        while get_status("/ready") != 200 and time.perf_counter() - start < timeout:
+            time.sleep(0.05)
+        durations["startup_ready"] = time.perf_counter() - start
+    finally:
+        server.terminate()
+        server.wait()
+
+    return durations
+
+def run_benchmark(function, repeat):
+    """Run a function once (warm up), then time repeat runs.
+
+    Returns
+    -------
+    dict
+        min, median and mean duration (seconds) of the timed runs.
+    """
+    function()
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+
+    return {"runs": repeat,
+            "min": min(durations),
+            "median": float(np.median(durations)),
+            "mean": float(np.mean(durations))}
+
+def get_metadata(data, list_size):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPOSITORY,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPOSITORY,
+                               capture_output=True, text=True, check=True).stdout.strip() != ""
+    except (OSError, subprocess.CalledProcessError):
+        commit, dirty = "unknown", False
+
+    return {"commit": commit,
+            "dirty": dirty,
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "data": os.path.abspath(data),
+            "list_size": list_size,
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count()}
+
+def compare_results(previous, current):
+    """Ratio of the median durations (current / previous) of the benchmarks in both results."""
+    rows = []
+    for name, result in current["benchmarks"].items():
+        if name in previous["benchmarks"]:
+            before = previous["benchmarks"][name]["median"]
+            rows.append({"benchmark": name,
+                         "before ({})".format(previous["metadata"]["commit"]): before,
+                         "after ({})".format(current["metadata"]["commit"]): result["median"],
+                         "ratio": result["median"] / before if before > 0 else np.nan})
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    data = os.path.abspath(args.data)
+    output = os.path.abspath(args.output)
+    previous = None
+    if args.compare is not None:
+        # Read before the run: the results of the same commit overwrite the file
+        with open(args.compare) as previous_file:
+            previous = json.load(previous_file)
+
+    with tempfile.TemporaryDirectory() as working_directory:
+        # The dashboard paths are relative: static -> data, example_data -> repository
+        os.symlink(data, os.path.join(working_directory, "static"))
+        os.symlink(os.path.join(REPOSITORY, "example_data"), os.path.join(working_directory, "example_data"))
+        os.chdir(working_directory)
+
+        results = {"metadata": get_metadata(data, args.list_size), "benchmarks": {}}
+        if args.only is None or re.search(args.only, "startup"):
+            genes = pd.read_csv(os.path.join(REPOSITORY, "example_data", "gene_list_example_UPC2_38_targets.csv"))["TG"].tolist()
+            for name, duration in measure_startup(genes).items():
+                results["benchmarks"][name] = {"runs": 1, "min": duration, "median": duration, "mean": duration}
+                print("{:<32} {:>10.4f} s".format(name, duration))
+
+        start = time.perf_counter()
+        context = get_context(args.list_size)
+        print("setup: {:.1f} s".format(time.perf_counter() - start))
+
+        for name, setup in BENCHMARKS.items():
+            if args.only is not None and not re.search(args.only, name):
+                continue
+            function = setup(context)
+            if function is None:
+                continue
+            results["benchmarks"][name] = run_benchmark(function, args.repeat)
+            print("{:<32} {:>10.4f} s (median of {})".format(name, results["benchmarks"][name]["median"], args.repeat))
+
+    os.makedirs(output, exist_ok=True)
+    path = os.path.join(output, "benchmark_{}{}.json".format(results["metadata"]["commit"], "_dirty" if results["metadata"]["dirty"] else ""))
+    with open(path, "w") as results_file:
+        json.dump(results, results_file, indent=2)
+    print("results written to {}".format(path))
+
+    if previous is not None:
+        print(compare_results(previous, results).to_string(index=False, float_format="{:.4f}".format))
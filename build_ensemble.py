@@ -0,0 +1,67 @@
+"""
+Build an ensemble of 3D models of a genome bundle.
+
+Each --segments file (same layout as plotly_segments.csv) is one model of the ensemble.
+Its locus centroids and dense 3D distance matrix are written, a block of rows at a time,
+as .npy files in a subdirectory of --output named after the file. The models share the
+loci of the database with coordinates in at least one model (loci.csv). The dashboard
+memory-maps the models on first use and shows the per-pair mean, standard deviation,
+minimum or maximum across the models in Tab 3.
+"""
+
+import argparse
+import os
+import time
+
+import pandas as pd
+
+import lib.distances as distances
+import lib.ensembles as ensembles
+import lib.tools as tools
+
+SQL_QUERY = \
+"""SELECT Primary_SGDID, Feature_name, Chromosome, Strand
+FROM SGD_features
+"""
+
+
+def get_model_name(path):
+    """Name of the model of a segments file: the file name without extension."""
+    return os.path.splitext(os.path.basename(path))[0]
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("segments", nargs="+",
+                        help="3D segments coordinates of each model")
+    parser.add_argument("--database", default="./static/SCERE.db",
+                        help="SQLite database (default: %(default)s)")
+    parser.add_argument("--output", default="./static/models",
+                        help="output ensemble directory (default: %(default)s)")
+    parser.add_argument("--method", choices=distances.DISTANCE_METHODS, default="centroid",
+                        help="3D distance between two loci (default: %(default)s)")
+    parser.add_argument("--chunk-size", type=int, default=256,
+                        help="matrix rows computed at a time (default: %(default)s)")
+    args = parser.parse_args()
+    # The files name the models
+    names = [get_model_name(path) for path in args.segments]
+    if len(set(names)) < len(names):
+        parser.error("the segments files must have different names")
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    # Loci of the database with coordinates in at least one model
+    database_sgdids = pd.Index(tools.get_locus_info(args.database, SQL_QUERY)["Primary_SGDID"].unique())
+    model_sgdids = pd.Index(pd.concat([pd.read_csv(path, usecols=["Primary_SGDID"])["Primary_SGDID"] for path in args.segments]).unique())
+    sgdids = database_sgdids[database_sgdids.isin(model_sgdids)]
+    ensembles.write_ensemble_loci(args.output, sgdids)
+    print("{} loci".format(len(sgdids)))
+
+    for path in args.segments:
+        start = time.perf_counter()
+        name = get_model_name(path)
+        geometry = distances.get_locus_geometry(pd.read_csv(path), sgdids)
+        ensembles.write_model(os.path.join(args.output, name), geometry, sgdids, method=args.method, chunk_size=args.chunk_size)
+        print("{}: {} loci with coordinates ({:.1f} s)".format(name, len(geometry["sgdids"]), time.perf_counter() - start))
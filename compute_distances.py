@@ -0,0 +1,68 @@
+"""
+Compute the 3D distances between loci from the segments of the 3D model.
+
+The output has the same columns as static/3D_distances.parquet.gzip
+(Primary_SGDID, Primary_SGDID_bis, 3D_distances) and can replace it,
+or be compared with it.
+"""
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+import lib.distances as distances
+import lib.genomes as genomes
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--segments", default="./static/plotly_segments.csv",
+                        help="3D segments coordinates (default: %(default)s)")
+    parser.add_argument("--loci", default=None,
+                        help="csv file with the Primary_SGDID of the loci in its first column (default: all loci with 3D coordinates)")
+    parser.add_argument("--method", default="centroid", choices=distances.DISTANCE_METHODS,
+                        help="distance between loci centroids or minimum distance between loci segments (default: %(default)s)")
+    parser.add_argument("--chunk-size", type=int, default=256,
+                        help="number of loci per chunk, bounds memory (default: %(default)s)")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="number of worker processes (default: %(default)s)")
+    parser.add_argument("--output", default=None,
+                        help="output Parquet file")
+    parser.add_argument("--compare", default=None,
+                        help="Parquet file of 3D distances to compare with the computed distances")
+    parser.add_argument("--cache", default=genomes.DISTANCES_CACHE,
+                        help="directory of the 3D distance stores of --compare, shared with the dashboard (default: %(default)s)")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    plotly_segments = pd.read_csv(args.segments)
+    sgdids = None
+    if args.loci is not None:
+        loci = pd.read_csv(args.loci)
+        sgdids = loci[loci.columns[0]].drop_duplicates()
+    geometry = distances.get_locus_geometry(plotly_segments, sgdids)
+    print("loci:", len(geometry["sgdids"]))
+
+    start = time.perf_counter()
+    if args.output is not None:
+        pairs_number = distances.write_distance_edges(args.output, geometry, args.method, args.chunk_size, args.processes)
+    else:
+        computed = distances.get_distance_edges(geometry, args.method, args.chunk_size, args.processes)
+        pairs_number = len(computed)
+    elapsed = time.perf_counter() - start
+    print("pairs: {} in {:.1f} s ({:.0f} pairs/s)".format(pairs_number, elapsed, pairs_number / max(elapsed, 1e-9)))
+
+    if args.compare is not None:
+        # Both sides are read from their store a block of rows at a time: the written --output, or the
+        # distances of the geometry computed block by block, against the --compare file
+        loci = pd.DataFrame({"Primary_SGDID": geometry["sgdids"], "Chromosome": np.nan})
+        computed_sgdids, computed = genomes.open_distance_matrix(args.output, args.segments, loci, args.cache, method=args.method,
+                                                                 get_geometry=lambda: geometry)
+        reference_sgdids, reference = genomes.open_distance_matrix(args.compare, args.segments, loci, args.cache)
+        for key, value in distances.compare_distance_matrices(reference, reference_sgdids, computed, computed_sgdids).items():
+            print("{}: {}".format(key, value))
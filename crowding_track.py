@@ -0,0 +1,40 @@
+"""
+Compute the 3D crowding track of a genome bundle.
+
+For each locus of the 3D model: the number of other loci within several 3D radii, and
+the distance of its centroid to the nuclear centroid and to the nuclear periphery
+(estimated from the most distant loci). The track is written next to the other files
+of the bundle, where the dashboard reads it instead of computing it at startup.
+"""
+
+import argparse
+import time
+
+import pandas as pd
+
+import lib.crowding as crowding
+import lib.spatial as spatial
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--segments", default="./static/plotly_segments.csv",
+                        help="3D segments coordinates (default: %(default)s)")
+    parser.add_argument("--output", default="./static/crowding_track.parquet",
+                        help="output Parquet file (default: %(default)s)")
+    parser.add_argument("--periphery-quantile", type=float, default=crowding.PERIPHERY_QUANTILE,
+                        help="quantile of the distances to the nuclear centroid taken as the nuclear radius (default: %(default)s)")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    start = time.perf_counter()
+    centroids = spatial.get_locus_centroids(pd.read_csv(args.segments))
+    track = crowding.compute_crowding_track(centroids, spatial.build_spatial_index(centroids),
+                                            periphery_quantile=args.periphery_quantile)
+    track.reset_index().to_parquet(args.output, engine="pyarrow", index=False)
+
+    print("{} loci ({:.1f} s)".format(len(track), time.perf_counter() - start))
+    print(track.describe().loc[["mean", "min", "50%", "max"]].round(2).to_string())
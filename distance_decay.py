@@ -0,0 +1,91 @@
+"""
+Relate the genomic distance of the same-chromosome gene pairs to their 3D distance.
+
+All the same-chromosome pairs are read from the 3D distance matrix a block of rows at a
+time: their 3D distances are summarized by chromosome and genomic distance bin (written to
+--bins, where the dashboard reads them instead of computing them at startup) and a power
+law decay curve is fitted per chromosome. The pairs much closer in 3D than expected from
+their genomic distance (z-score <= --max-z), among all the genes or a genes list, are then
+streamed to a Parquet file.
+"""
+
+import argparse
+import time
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import lib.distance_decay as distance_decay
+import lib.distances as distances
+import lib.genomes as genomes
+import lib.tools as tools
+
+SQL_QUERY = \
+"""SELECT Primary_SGDID, Feature_name, Chromosome, Strand, Start_coordinate, Stop_coordinate
+FROM SGD_features
+"""
+
+PAIRS_COLUMNS = ["gene_1", "gene_2", "chromosome", "genomic_distance", "3D_distance"] + distance_decay.SCORES_COLUMNS
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database", default="./static/SCERE.db",
+                        help="SQLite database (default: %(default)s)")
+    parser.add_argument("--distances", default="./static/3D_distances.parquet.gzip",
+                        help="3D distances Parquet file, computed from --segments if missing (default: %(default)s)")
+    parser.add_argument("--segments", default="./static/plotly_segments.csv",
+                        help="3D segments coordinates (default: %(default)s)")
+    parser.add_argument("--cache", default=genomes.DISTANCES_CACHE,
+                        help="directory of the 3D distance stores, shared with the dashboard (default: %(default)s)")
+    parser.add_argument("--bins", default="./static/distance_decay_bins.csv",
+                        help="output csv file of the genomic distance bins (default: %(default)s)")
+    parser.add_argument("--pairs", default="./distance_decay_pairs.parquet",
+                        help="output Parquet file of the pairs closer in 3D than expected (default: %(default)s)")
+    parser.add_argument("--genes", default=None,
+                        help="csv file with the Feature_name of a genes list in its first column, all the genes if missing")
+    parser.add_argument("--max-z", type=float, default=-3,
+                        help="z-score threshold of the written pairs (default: %(default)s)")
+    parser.add_argument("--max-cells", type=int, default=2**22,
+                        help="matrix cells read per chunk, bounds memory (default: %(default)s)")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    feature_name = tools.get_locus_info(args.database, SQL_QUERY)
+    sgdids, matrix = genomes.open_distance_matrix(args.distances, args.segments, feature_name, args.cache)
+    chromosome, midpoint = distance_decay.get_locus_midpoints(feature_name, sgdids)
+    names = feature_name.drop_duplicates(subset=["Primary_SGDID"]).set_index("Primary_SGDID")["Feature_name"].reindex(sgdids).to_numpy()
+
+    # Decay of all the same-chromosome pairs
+    start = time.perf_counter()
+    decay_bins = distance_decay.get_decay_bins(distance_decay.iter_cis_pairs(matrix, chromosome, midpoint, max_cells=args.max_cells))
+    decay_curves = distance_decay.fit_decay_curves(decay_bins)
+    decay_bins.to_csv(args.bins, index=False)
+    print("{} pairs in {} bins ({:.1f} s)".format(decay_bins["pairs"].sum(), len(decay_bins), time.perf_counter() - start))
+    print(decay_curves.round({"exponent": 3, "prefactor": 3}).to_string(index=False))
+
+    positions = None
+    if args.genes is not None:
+        positions = distances.get_loci_positions(sgdids, feature_name, pd.read_csv(args.genes).iloc[:, 0].tolist())
+        print("genes list: {} genes with 3D distances, {} same-chromosome pairs".format(len(positions), distance_decay.count_cis_pairs(chromosome, positions)))
+
+    # Pairs closer than expected, written as they are found
+    start = time.perf_counter()
+    pairs_number = 0
+    writer = None
+    pairs = distance_decay.iter_cis_pairs(matrix, chromosome, midpoint, positions, max_cells=args.max_cells)
+    for chunk in distance_decay.iter_scored_pairs(pairs, decay_bins, decay_curves, args.max_z):
+        chunk = chunk.assign(gene_1=names[chunk["position_1"]], gene_2=names[chunk["position_2"]])
+        table = pa.Table.from_pandas(chunk[PAIRS_COLUMNS], preserve_index=False)
+        if writer is None:
+            writer = pq.ParquetWriter(args.pairs, table.schema)
+        if len(chunk):
+            writer.write_table(table)
+            pairs_number += len(chunk)
+    if writer is not None:
+        writer.close()
+    print("{} pairs with a z-score <= {} written to {} ({:.1f} s)".format(pairs_number, args.max_z, args.pairs, time.perf_counter() - start))
@@ -0,0 +1,130 @@
+"""
+Compute the 3D compactness of every GO slim term.
+
+For each term, the 3D distances between its genes are compared with the distances
+within random gene sets of the same size (size-matched null). Terms are processed
+in parallel and each result is appended to the output file as soon as it is
+computed: an interrupted run resumes from the completed terms.
+"""
+
+import argparse
+import os
+import time
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+import lib.distances as distances
+import lib.enrichment as enrichment
+import lib.genomes as genomes
+import lib.tools as tools
+
+SQL_QUERY = \
+"""SELECT Primary_SGDID, Chromosome, Strand
+FROM SGD_features
+"""
+
+OUTPUT_COLUMNS = ["GO_slim_term", "genes", "pairs", "mean_distance", "median_distance",
+                  "null_mean", "null_sd", "z_score", "p_value"]
+
+# Distance matrix and universe shared with the worker processes
+_matrix = None
+_universe = None
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database", default="./static/SCERE.db",
+                        help="SQLite database (default: %(default)s)")
+    parser.add_argument("--distances", default="./static/3D_distances.parquet.gzip",
+                        help="3D distances Parquet file, computed from --segments if missing (default: %(default)s)")
+    parser.add_argument("--segments", default="./static/plotly_segments.csv",
+                        help="3D segments coordinates (default: %(default)s)")
+    parser.add_argument("--cache", default=genomes.DISTANCES_CACHE,
+                        help="directory of the 3D distance stores, shared with the dashboard (default: %(default)s)")
+    parser.add_argument("--output", default="./static/GO_compactness.csv",
+                        help="output csv file, also used to resume (default: %(default)s)")
+    parser.add_argument("--null-samples", type=int, default=100,
+                        help="number of random gene sets per term (default: %(default)s)")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(),
+                        help="number of worker processes (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="random generator seed (default: %(default)s)")
+    return parser.parse_args()
+
+def _init_worker(matrix, universe):
+    global _matrix, _universe
+    # Memory-mapped store: the worker processes share the pages of the matrix
+    _matrix = matrix
+    _universe = universe
+
+def get_term_compactness(task):
+    """Compare the within-term 3D distances with size-matched random gene sets.
+
+    Parameters
+    ----------
+    task : tuple
+        GO term, positions of its genes in the distance matrix, number of random sets, seed.
+
+    Returns
+    -------
+    dict
+        One row of the output table.
+    """
+    term, positions, null_samples, seed = task
+    row = dict.fromkeys(OUTPUT_COLUMNS, np.nan)
+    row.update({"GO_slim_term": term, "genes": len(positions)})
+
+    if len(positions) >= 2:
+        within = distances.get_within_distances(_matrix, positions)
+        null = distances.get_random_set_means(_matrix, _universe, len(positions), null_samples, seed)
+        null_sd = np.nanstd(null)
+
+        row.update({"pairs": len(within),
+                    "mean_distance": within.mean(),
+                    "median_distance": np.median(within),
+                    "null_mean": np.nanmean(null),
+                    "null_sd": null_sd,
+                    "z_score": (within.mean() - np.nanmean(null)) / null_sd if null_sd > 0 else np.nan,
+                    # Compact terms have smaller distances than the random sets
+                    "p_value": ((null <= within.mean()).sum() + 1) / (null_samples + 1)})
+
+    return row
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    go_mapping = tools.get_locus_info(args.database, enrichment.SQL_QUERY_GO)
+
+    sgdids, matrix = genomes.open_distance_matrix(args.distances, args.segments, tools.get_locus_info(args.database, SQL_QUERY), args.cache)
+
+    # Genes with GO annotation and 3D distances
+    go_mapping = go_mapping.assign(position=sgdids.get_indexer(go_mapping["Primary_SGDID"]))
+    go_mapping = go_mapping[go_mapping["position"] >= 0].drop_duplicates(subset=["position", "GO_slim_term"])
+    universe = np.unique(go_mapping["position"].to_numpy())
+    terms = go_mapping.groupby("GO_slim_term")["position"].apply(np.asarray)
+
+    # Resume from the completed terms
+    completed = set()
+    if os.path.exists(args.output):
+        completed = set(pd.read_csv(args.output)["GO_slim_term"])
+    tasks = [(term, positions, args.null_samples, args.seed + i)
+             for i, (term, positions) in enumerate(terms.items()) if term not in completed]
+    print("terms: {} ({} completed, {} to compute)".format(len(terms), len(completed), len(tasks)))
+
+    start = time.perf_counter()
+    pairs_number = 0
+    write_header = not os.path.exists(args.output)
+    with open(args.output, "a") as output, \
+         multiprocessing.Pool(args.processes, initializer=_init_worker, initargs=(matrix, universe)) as pool:
+        for done, row in enumerate(pool.imap_unordered(get_term_compactness, tasks), start=1):
+            pd.DataFrame([row], columns=OUTPUT_COLUMNS).to_csv(output, header=write_header, index=False)
+            output.flush()
+            write_header = False
+            pairs_number += 0 if np.isnan(row["pairs"]) else int(row["pairs"])
+
+            elapsed = time.perf_counter() - start
+            print("{}/{} {} ({:.2f} terms/s, {:.0f} pairs/s)".format(done, len(tasks), row["GO_slim_term"],
+                                                                     done / elapsed, pairs_number / elapsed))
@@ -6,8 +6,8 @@ import os
 # http://docs.gunicorn.org/en/stable/settings.html
 
 bind = "0.0.0.0:{}".format(int(os.getenv("PORT", 8000)))
-workers = 1
-threads = 4
+workers = int(os.getenv("GUNICORN_WORKERS", 1))
+threads = int(os.getenv("GUNICORN_THREADS", 4))
 errorlog = "logs/gunicorn-error.log"
 accesslog = "logs/gunicorn-access.log"
 loglevel = os.getenv("GUNICORN_LOG_LEVEL", "info")
@@ -0,0 +1,443 @@
+import io
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+from flask import Blueprint, Response, jsonify, request
+
+import lib.crowding as crowding
+import lib.distance_decay as distance_decay
+import lib.metrics as metrics
+import lib.spatial as spatial
+
+# Streamed response formats
+FORMATS = {"json": "application/json",
+           "ndjson": "application/x-ndjson",
+           "arrow": "application/vnd.apache.arrow.stream",
+           "csv": "text/csv",
+           "parquet": "application/vnd.apache.parquet"}
+
+EXPORT_TABLES = ["edges", "nodes", "segments"]
+
+# Arrow types of the columns of the streamed tables, the other columns are strings
+COLUMN_TYPES = {"3D_distance": pa.float32(),
+                "3D_distances": pa.float32(),
+                **{axis: pa.float64() for axis in ["x", "y", "z"]},
+                **{track: pa.int32() if track.startswith("loci_within_") else pa.float32() for track in crowding.TRACKS},
+                **{column: pa.int64() for column in ["Chromosome", "Start_coordinate", "Stop_coordinate", "chromosome", "bin", "pairs", "bins", "genes",
+                                                     "rank"]},
+                **{column: pa.float64() for column in ["genomic_start", "genomic_end", "mean_3D_distance", "sd_3D_distance", "exponent", "prefactor",
+                                                       "mean", "null_mean", "null_sd", "z_score", "p_value", "genomic_distance",
+                                                       "expected_3D_distance", "fitted_3D_distance"]}}
+
+
+class APIError(Exception):
+    """Error returned to the API client as a JSON message."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def resolve_genes(feature_name, ids):
+    """Resolve gene identifiers (systematic name, standard name or SGDID, case insensitive).
+
+    Parameters
+    ----------
+    feature_name : Pandas dataframe
+        Primary_SGDID, Feature_name and Standard_gene_name of the loci.
+    ids : list
+        Gene identifiers.
+
+    Returns
+    -------
+    Pandas dataframe
+        query, found, Primary_SGDID, Feature_name, Standard_gene_name and Chromosome, in the order of ids.
+    """
+    loci = feature_name.drop_duplicates(subset=["Primary_SGDID"])
+    # Missing names are not keys: they would resolve the queries "none" or "nan"
+    lookup = pd.concat([pd.Series(np.arange(len(loci)), index=loci[column].astype(str).str.upper())[loci[column].notna().to_numpy()]
+                        for column in ["Feature_name", "Standard_gene_name", "Primary_SGDID"]])
+    lookup = lookup[~lookup.index.duplicated(keep="first")]
+
+    queries = pd.Index([str(gene).strip().upper() for gene in ids])
+    rows = lookup.reindex(queries).to_numpy()
+    found = ~np.isnan(rows)
+
+    resolved = loci.iloc[rows[found].astype(int)][["Primary_SGDID", "Feature_name", "Standard_gene_name", "Chromosome"]]
+    resolved = resolved.set_axis(np.flatnonzero(found)).reindex(range(len(ids)))
+    resolved["Chromosome"] = resolved["Chromosome"].astype("Int64")
+    resolved.insert(0, "found", found)
+    resolved.insert(0, "query", [str(gene) for gene in ids])
+
+    return resolved
+
+def iter_distance_pairs(matrix, positions, names, threshold=None, chunk_size=256):
+    """Iterate over the 3D distances between all the pairs of a loci set, a few rows of the submatrix at a time.
+
+    Parameters
+    ----------
+    matrix : (loci, loci) array
+        3D distances (output of genomes.open_distance_matrix).
+    positions : numpy array
+        Positions of the loci in the matrix.
+    names : numpy array
+        Name of each locus, in the order of positions.
+    threshold : float, optional
+        Only the 3D distances strictly inferior to threshold are kept.
+    chunk_size : int
+        Number of submatrix rows per chunk, bounds memory.
+
+    Returns
+    -------
+    generator
+        Pandas dataframes with gene_1, gene_2 and 3D_distance columns (pairs i < j).
+    """
+    for start in range(0, len(positions), chunk_size):
+        block = matrix[np.ix_(positions[start:start + chunk_size], positions)]
+        row, column = np.nonzero(np.arange(start, start + len(block))[:, None] < np.arange(len(positions))[None, :])
+        values = block[row, column]
+        kept = ~np.isnan(values) if threshold is None else values < threshold
+        yield pd.DataFrame({"gene_1": names[start + row[kept]],
+                            "gene_2": names[column[kept]],
+                            "3D_distance": values[kept]})
+
+def get_schema(columns):
+    """Arrow schema of a streamed table: the types of COLUMN_TYPES, strings for the other columns."""
+    return pa.schema([(column, COLUMN_TYPES.get(column, pa.string())) for column in columns])
+
+def stream_table(chunks, columns, output_format):
+    """Stream dataframe chunks as NDJSON lines, CSV, an Arrow IPC stream or a Parquet file.
+
+    Every chunk is cast to the schema of the columns (see get_schema): the chunks match
+    even when the first ones are empty, and an empty table is still a valid file.
+
+    Parameters
+    ----------
+    chunks : iterable
+        Pandas dataframes with the given columns.
+    columns : list
+    output_format : str
+        "ndjson", "csv", "arrow" or "parquet".
+
+    Returns
+    -------
+    generator
+        Response body parts, one or a few per chunk.
+    """
+    if output_format == "ndjson":
+        for chunk in chunks:
+            if len(chunk):
+                yield chunk[columns].to_json(orient="records", lines=True).rstrip("\n") + "\n"
+        return
+
+    schema = get_schema(columns)
+    sink = io.BytesIO()
+    if output_format == "arrow":
+        writer = pa.ipc.new_stream(sink, schema)
+    elif output_format == "csv":
+        writer = pa_csv.CSVWriter(sink, schema)
+    else:
+        writer = pq.ParquetWriter(sink, schema)
+    try:
+        for chunk in chunks:
+            if not len(chunk):
+                continue
+            # One record batch or row group per chunk
+            writer.write_table(pa.Table.from_pandas(chunk[columns], schema=schema, preserve_index=False))
+            yield sink.getvalue()
+            sink.seek(0)
+            sink.truncate()
+    finally:
+        writer.close()
+    yield sink.getvalue()
+
+def create_blueprint(reference, max_genes=5000, max_json_rows=100000, max_request_bytes=1000000, genomes=None):
+    """Create the REST API of the dashboard server.
+
+    Parameters
+    ----------
+    reference : mapping
+        feature_name, distance_sgdids and distance_matrix (output of genomes.open_distance_matrix),
+        locus_centroids, spatial_index, go_membership (output of enrichment.build_membership_matrix),
+        plotly_segments, distance_chromosomes and distance_midpoints (output of distance_decay.get_locus_midpoints),
+        decay_bins and decay_curves (outputs of distance_decay.get_decay_bins and fit_decay_curves),
+        crowding_track (output of crowding.compute_crowding_track, indexed as locus_centroids) and selections (Primary_SGDID of the loci selected in the dashboard, by selection key).
+        Read at each request: the dictionary can be filled after the blueprint is created.
+    max_genes : int
+        Maximum number of genes per request.
+    max_json_rows : int
+        Maximum number of rows of a JSON response, larger responses must be streamed (ndjson or arrow).
+    max_request_bytes : int
+        Maximum size of a request body.
+    genomes : genomes.GenomeRegistry, optional
+        Other genomes, queried with the genome parameter (same keys as reference, without selections).
+
+    Returns
+    -------
+    flask.Blueprint
+        Routes under /api.
+    """
+    api = Blueprint("api", __name__, url_prefix="/api")
+
+    @api.errorhandler(APIError)
+    def handle_api_error(error):
+        return jsonify({"error": error.message}), error.status
+
+    @api.before_request
+    def check_request_size():
+        if request.content_length is not None and request.content_length > max_request_bytes:
+            raise APIError("request body larger than {} bytes".format(max_request_bytes), 413)
+
+    def get_parameter(name, default=None):
+        # Query string, or JSON body for long lists
+        body = request.get_json(silent=True) or {}
+        return body.get(name, request.args.get(name, default))
+
+    def get_genome():
+        name = get_parameter("genome")
+        if name is None:
+            return reference
+        try:
+            return genomes.get(name)
+        except (AttributeError, KeyError):
+            raise APIError("unknown genome {}".format(name), 404)
+
+    def get_genes(genome):
+        genes = get_parameter("genes")
+        if genes is None:
+            raise APIError("missing genes parameter")
+        if isinstance(genes, str):
+            genes = [gene for gene in genes.split(",") if gene.strip()]
+        if len(genes) > max_genes:
+            raise APIError("more than {} genes".format(max_genes), 413)
+        return resolve_genes(genome["feature_name"], genes)
+
+    def get_format():
+        output_format = get_parameter("format")
+        if output_format is None:
+            accepted = request.accept_mimetypes.best_match(list(FORMATS.values()), default=FORMATS["json"])
+            output_format = {mimetype: name for name, mimetype in FORMATS.items()}[accepted]
+        if output_format not in FORMATS:
+            raise APIError("unknown format {}, use one of {}".format(output_format, ", ".join(FORMATS)))
+        return output_format
+
+    def respond(chunks, columns, rows_number, output_format):
+        if output_format == "json":
+            if rows_number > max_json_rows:
+                raise APIError("{} rows, use format=ndjson or format=arrow above {} rows".format(rows_number, max_json_rows), 413)
+            table = pd.concat(list(chunks), ignore_index=True) if rows_number else pd.DataFrame(columns=columns)
+            return Response(table[columns].to_json(orient="records"), mimetype=FORMATS["json"])
+        return Response(stream_table(chunks, columns, output_format), mimetype=FORMATS[output_format])
+
+    @api.route("/genomes")
+    def genome_list():
+        return jsonify(genomes.get_info() if genomes is not None else [])
+
+    @api.route("/genes", methods=["GET", "POST"])
+    def genes():
+        resolved = get_genes(get_genome())
+        return Response(resolved.to_json(orient="records"), mimetype=FORMATS["json"])
+
+    @api.route("/distances", methods=["GET", "POST"])
+    def distances():
+        genome = get_genome()
+        sgdids, matrix = genome["distance_sgdids"], genome["distance_matrix"]
+        resolved = get_genes(genome)
+        output_format = get_format()
+
+        loci = resolved.dropna(subset=["Primary_SGDID"]).drop_duplicates(subset=["Primary_SGDID"])
+        positions = sgdids.get_indexer(loci["Primary_SGDID"])
+        loci = loci[positions >= 0]
+        positions = positions[positions >= 0]
+        names = loci["Feature_name"].to_numpy()
+        rows_number = len(positions) * (len(positions) - 1) // 2
+
+        return respond(iter_distance_pairs(matrix, positions, names), ["gene_1", "gene_2", "3D_distance"], rows_number, output_format)
+
+    @api.route("/neighbours", methods=["GET", "POST"])
+    def neighbours():
+        gene = get_parameter("gene")
+        try:
+            radius = float(get_parameter("radius", 20))
+        except (TypeError, ValueError):
+            raise APIError("radius must be a number")
+        if gene is None:
+            raise APIError("missing gene parameter")
+
+        genome = get_genome()
+        feature_name, centroids = genome["feature_name"], genome["locus_centroids"]
+        resolved = resolve_genes(feature_name, [gene])
+        if not resolved["found"].iloc[0] or resolved["Primary_SGDID"].iloc[0] not in centroids.index:
+            raise APIError("no 3D coordinates for {}".format(gene), 404)
+
+        result = spatial.get_neighbours_within(genome["spatial_index"], centroids, resolved["Primary_SGDID"].iloc[0], radius)
+        result = result.merge(feature_name[["Primary_SGDID", "Feature_name"]].drop_duplicates(subset=["Primary_SGDID"]), how="left")
+        return respond(iter([result]), ["Primary_SGDID", "Feature_name", "3D_distances"], len(result), get_format())
+
+    @api.route("/nearest", methods=["GET", "POST"])
+    def nearest():
+        """k nearest loci of each gene, by 3D distance between the loci centroids."""
+        try:
+            k = int(get_parameter("k", 10))
+        except (TypeError, ValueError):
+            raise APIError("k must be an integer")
+        if not 0 < k <= 1000:
+            raise APIError("k must be between 1 and 1000")
+        genome = get_genome()
+        feature_name = genome["feature_name"].drop_duplicates(subset=["Primary_SGDID"]).set_index("Primary_SGDID")["Feature_name"]
+        sgdids = get_genes(genome)["Primary_SGDID"].dropna().drop_duplicates()
+        result = spatial.get_nearest_neighbours(genome["spatial_index"], genome["locus_centroids"], sgdids, k)
+        result = result.assign(Feature_name=feature_name.reindex(result["Primary_SGDID"]).to_numpy(),
+                               Feature_name_bis=feature_name.reindex(result["Primary_SGDID_bis"]).to_numpy())
+        return respond(iter([result]), ["Primary_SGDID", "Feature_name", "rank", "Primary_SGDID_bis", "Feature_name_bis", "3D_distances"],
+                       len(result), get_format())
+
+    @api.route("/coordinates", methods=["GET", "POST"])
+    def coordinates():
+        genome = get_genome()
+        centroids = genome["locus_centroids"]
+        resolved = get_genes(genome)
+        result = resolved.dropna(subset=["Primary_SGDID"])
+        result = result[result["Primary_SGDID"].isin(centroids.index)]
+        result = result.assign(**{axis: centroids.loc[result["Primary_SGDID"], axis].to_numpy() for axis in ["x", "y", "z"]})
+        return respond(iter([result]), ["query", "Primary_SGDID", "Feature_name", "x", "y", "z"], len(result), get_format())
+
+    @api.route("/go", methods=["GET", "POST"])
+    def go_membership():
+        genome = get_genome()
+        membership = genome["go_membership"]
+        term = get_parameter("term")
+        if term is not None:
+            if term not in membership["terms"]:
+                raise APIError("unknown GO slim term {}".format(term), 404)
+            rows = membership["matrix"][:, membership["terms"].get_loc(term)].nonzero()[0]
+            result = pd.DataFrame({"Primary_SGDID": membership["genes"][rows],
+                                   "Feature_name": membership["names"][rows],
+                                   "GO_slim_term": term})
+        else:
+            resolved = get_genes(genome)
+            rows = membership["genes"].get_indexer(resolved["Primary_SGDID"].dropna())
+            rows = rows[rows >= 0]
+            genes_terms = membership["matrix"][rows].tocoo()
+            result = pd.DataFrame({"Primary_SGDID": membership["genes"][rows[genes_terms.row]],
+                                   "Feature_name": membership["names"][rows[genes_terms.row]],
+                                   "GO_slim_term": membership["terms"][genes_terms.col]})
+        return respond(iter([result]), ["Primary_SGDID", "Feature_name", "GO_slim_term"], len(result), get_format())
+
+    @api.route("/crowding", methods=["GET", "POST"])
+    def crowding_values():
+        """Precomputed 3D crowding and radial position of genes."""
+        genome = get_genome()
+        track = genome["crowding_track"]
+        result = get_genes(genome).dropna(subset=["Primary_SGDID"])
+        result = result[result["Primary_SGDID"].isin(track.index)]
+        result = pd.concat([result.reset_index(drop=True), track.loc[result["Primary_SGDID"]].reset_index(drop=True)], axis=1)
+        return respond(iter([result]), ["query", "Primary_SGDID", "Feature_name"] + list(track.columns), len(result), get_format())
+
+    @api.route("/crowding/bias", methods=["GET", "POST"])
+    def crowding_bias():
+        """Crowding and periphery bias of a genes list: mean of each track compared with random gene sets of the same size."""
+        try:
+            samples = int(get_parameter("samples", 1000))
+        except (TypeError, ValueError):
+            raise APIError("samples must be an integer")
+        if not 0 < samples <= 100000:
+            raise APIError("samples must be between 1 and 100000")
+        genome = get_genome()
+        track = genome["crowding_track"]
+        positions = track.index.get_indexer(get_genes(genome)["Primary_SGDID"].dropna())
+        result = crowding.test_track_bias(track, positions[positions >= 0], samples)
+        return respond(iter([result]), crowding.BIAS_COLUMNS, len(result), get_format())
+
+    @api.route("/decay/bins")
+    def decay_bins():
+        """3D distances of the same-chromosome gene pairs by chromosome and genomic distance bin."""
+        bins = get_genome()["decay_bins"]
+        return respond(iter([bins]), distance_decay.BINS_COLUMNS, len(bins), get_format())
+
+    @api.route("/decay/curves")
+    def decay_curves():
+        """Power law fits of the 3D distance against the genomic distance, per chromosome."""
+        curves = get_genome()["decay_curves"]
+        return respond(iter([curves]), distance_decay.CURVES_COLUMNS, len(curves), get_format())
+
+    @api.route("/decay/pairs", methods=["GET", "POST"])
+    def decay_pairs():
+        """Genomic and 3D distances of the same-chromosome pairs of a genes list (all the genes without genes parameter),
+        compared with the decay of the genome. With max_z, only the pairs with a z-score <= max_z (e.g. -2) are returned."""
+        genome = get_genome()
+        sgdids, chromosome = genome["distance_sgdids"], genome["distance_chromosomes"]
+        output_format = get_format()
+        try:
+            max_z = get_parameter("max_z")
+            max_z = None if max_z is None else float(max_z)
+        except (TypeError, ValueError):
+            raise APIError("max_z must be a number")
+
+        positions = None
+        if get_parameter("genes") is not None:
+            positions = sgdids.get_indexer(get_genes(genome)["Primary_SGDID"].dropna().drop_duplicates())
+            positions = positions[positions >= 0]
+        names = genome["feature_name"].drop_duplicates(subset=["Primary_SGDID"]).set_index("Primary_SGDID")["Feature_name"].reindex(sgdids).to_numpy()
+
+        pairs = distance_decay.iter_cis_pairs(genome["distance_matrix"], chromosome, genome["distance_midpoints"], positions)
+        chunks = (chunk.assign(gene_1=names[chunk["position_1"]], gene_2=names[chunk["position_2"]])
+                  for chunk in distance_decay.iter_scored_pairs(pairs, genome["decay_bins"], genome["decay_curves"], max_z))
+        columns = ["gene_1", "gene_2", "chromosome", "genomic_distance", "3D_distance"] + distance_decay.SCORES_COLUMNS
+        return respond(chunks, columns, distance_decay.count_cis_pairs(chromosome, positions), output_format)
+
+    @api.route("/export/<table>")
+    def export(table):
+        """Download the edges (under a 3D distance threshold), nodes (with GO slim terms) or 3D segments of a dashboard selection."""
+        feature_name, sgdids, matrix = reference["feature_name"], reference["distance_sgdids"], reference["distance_matrix"]
+        membership, segments = reference["go_membership"], reference["plotly_segments"]
+        selection = reference["selections"].get(request.args.get("selection", ""))
+        metrics.record_cache("export_selections", selection is not None)
+        if selection is None:
+            raise APIError("unknown or expired selection, submit the genes list again", 404)
+        if table not in EXPORT_TABLES:
+            raise APIError("unknown table {}, use one of {}".format(table, ", ".join(EXPORT_TABLES)), 404)
+        output_format = request.args.get("format", "csv")
+        if output_format not in ("csv", "parquet"):
+            raise APIError("unknown format {}, use csv or parquet".format(output_format))
+
+        loci = feature_name.drop_duplicates(subset=["Primary_SGDID"]).set_index("Primary_SGDID").reindex(selection)
+
+        if table == "edges":
+            try:
+                threshold = float(request.args["threshold"]) if "threshold" in request.args else None
+            except ValueError:
+                raise APIError("threshold must be a number")
+            positions = sgdids.get_indexer(selection)
+            names = loci["Feature_name"].to_numpy()[positions >= 0]
+            chunks = iter_distance_pairs(matrix, positions[positions >= 0], names, threshold)
+            columns = ["gene_1", "gene_2", "3D_distance"]
+
+        elif table == "nodes":
+            def chunks(chunk_size=1000):
+                for start in range(0, len(loci), chunk_size):
+                    chunk = loci.iloc[start:start + chunk_size]
+                    # GO slim terms of each gene, separated by |
+                    rows = membership["genes"].get_indexer(chunk.index)
+                    genes_terms = membership["matrix"][np.where(rows >= 0, rows, 0)].tolil().rows
+                    terms = ["|".join(membership["terms"][genes_terms[i]]) if rows[i] >= 0 else "" for i in range(len(chunk))]
+                    yield chunk.reset_index().assign(GO_slim_terms=terms)
+            chunks = chunks()
+            columns = ["Primary_SGDID", "Feature_name", "Standard_gene_name", "Chromosome", "Start_coordinate", "Stop_coordinate",
+                       "Strand", "GO_slim_terms"]
+
+        else:
+            rows = np.flatnonzero(segments["Primary_SGDID"].isin(selection).to_numpy())
+            chunks = (segments.iloc[rows[start:start + 100000]].merge(loci["Feature_name"], left_on="Primary_SGDID", right_index=True, how="left")
+                      for start in range(0, max(len(rows), 1), 100000))
+            columns = ["Primary_SGDID", "Feature_name", "x", "y", "z"]
+
+        response = Response(stream_table(chunks, columns, output_format), mimetype=FORMATS[output_format])
+        response.headers["Content-Disposition"] = "attachment; filename=3D-Scere_{}.{}".format(table, output_format)
+        return response
+
+    return api
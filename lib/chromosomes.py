@@ -0,0 +1,126 @@
+import numpy as np
+import pandas as pd
+
+CHROMOSOME_LABELS = ["1", "2", "3", "4", "5", "6", "7", "8", "9",
+                     "10", "11", "12", "13", "14", "15", "16", "mitochondrial"]
+
+
+def get_matrix_chromosome_distances(matrix, sgdids, feature_name, chromosome_number=17, median=True, positions=None,
+                                    max_distance=200, resolution=0.1, max_cells=2**22):
+    """Summarize the 3D distances of a distance matrix by chromosome pair.
+
+    The pairs i < j of the loci are read from the matrix a block of rows at a time, and
+    each block is summarized by one bincount over the chromosome pair codes of its pairs:
+    memory is bounded by max_cells whatever the number of loci, and the matrix can be
+    memory-mapped. The medians are exact when the pairs are read at once (e.g. a genes
+    list), interpolated in fine histograms of the distances otherwise.
+
+    Parameters
+    ----------
+    matrix : (loci, loci) array
+        3D distances, NaN for missing pairs (output of genomes.open_distance_matrix).
+    sgdids : Pandas index
+        Loci of the matrix rows and columns.
+    feature_name : Pandas dataframe
+        Primary_SGDID and Chromosome (1 to chromosome_number) of the loci.
+    chromosome_number : int
+    median : bool
+        Also compute the median distances.
+    positions : numpy array, optional
+        Positions in the matrix of the loci to summarize (e.g. of a genes list), all the loci if None.
+    max_distance : float
+        Upper bound of the histograms of the medians, larger distances are counted in the last bin.
+    resolution : float
+        Histogram bin width, the median is interpolated within a bin.
+    max_cells : int
+        Maximum number of matrix cells read at a time, bounds memory.
+
+    Returns
+    -------
+    dict
+        count, mean and median: symmetric (chromosome_number, chromosome_number) arrays.
+        Mean and median are NaN for chromosome pairs without distances.
+    """
+    positions = np.arange(len(sgdids)) if positions is None else np.unique(positions)
+    chromosomes = np.append(feature_name["Chromosome"].to_numpy(dtype=int) - 1, -1)
+    chromosomes = chromosomes[pd.Index(feature_name["Primary_SGDID"]).get_indexer(sgdids[positions])]
+    positions = positions[chromosomes >= 0]
+    chromosomes = chromosomes[chromosomes >= 0]
+
+    size = chromosome_number * chromosome_number
+    bins_number = int(round(max_distance / resolution))
+    count = np.zeros(size)
+    total = np.zeros(size)
+    rows_number = max(1, max_cells // max(len(positions), 1))
+    exact = rows_number >= len(positions) - 1
+    histograms = np.zeros(size * bins_number if median and not exact else 0)
+    codes, distances = np.zeros(0, dtype=np.int32), np.zeros(0)
+    # low * chromosome_number + high, where low <= high are the chromosomes of the two loci
+    pair_codes = (np.minimum.outer(np.arange(chromosome_number), np.arange(chromosome_number)) * chromosome_number
+                  + np.maximum.outer(np.arange(chromosome_number), np.arange(chromosome_number))).astype(np.int32)
+    for start in range(0, len(positions) - 1, rows_number):
+        stop = min(start + rows_number, len(positions) - 1)
+        block = np.asarray(matrix[np.ix_(positions[start:stop], positions[start + 1:])])
+        block_codes = pair_codes[chromosomes[start:stop, None], chromosomes[None, start + 1:]]
+        # Row k is the locus start + k, column l the locus start + 1 + l: pairs i < j for k <= l,
+        # only the first stop - start columns are not all kept
+        upper = np.arange(stop - start)[:, None] <= np.arange(stop - start)[None, :]
+        codes = np.concatenate([block_codes[:, :stop - start][upper], block_codes[:, stop - start:].ravel()])
+        distances = np.concatenate([block[:, :stop - start][upper], block[:, stop - start:].ravel()])
+        observed = ~np.isnan(distances)
+        if not observed.all():
+            codes, distances = codes[observed], distances[observed]
+
+        total += np.bincount(codes, weights=distances, minlength=size)
+        if median and not exact:
+            # 32-bit codes and bins: the keys are read faster by bincount
+            bins = np.minimum(distances * (1 / resolution), bins_number - 1).astype(np.int32)
+            histograms += np.bincount(codes * np.int32(bins_number) + bins, minlength=size * bins_number)
+        else:
+            count += np.bincount(codes, minlength=size)
+
+    if median and not exact:
+        histograms = histograms.reshape(size, bins_number)
+        cumulative = np.cumsum(histograms, axis=1)
+        # The histograms also count the distances
+        count = cumulative[:, -1]
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        summary = {"count": count, "mean": total / count}
+        if median and exact:
+            # Sort by code then distance, the median of each code is in the middle of its run
+            sorted_distances = distances[np.lexsort((distances, codes))].astype(float)
+            starts = (np.cumsum(count) - count).astype(int)
+            low = starts + (count.astype(int) - 1) // 2
+            high = starts + count.astype(int) // 2
+            summary["median"] = np.full(size, np.nan)
+            summary["median"][count > 0] = (sorted_distances[low[count > 0]] + sorted_distances[high[count > 0]]) / 2
+        elif median:
+            # First bin reaching half of the distances of each chromosome pair, interpolated within the bin
+            median_bin = np.minimum((cumulative < count[:, None] / 2).sum(axis=1), bins_number - 1)
+            in_bin = histograms[np.arange(size), median_bin]
+            before = cumulative[np.arange(size), median_bin] - in_bin
+            summary["median"] = np.where(count > 0, (median_bin + (count / 2 - before) / in_bin) * resolution, np.nan)
+
+    for key, values in summary.items():
+        values = values.reshape(chromosome_number, chromosome_number)
+        # Only low <= high codes are filled: mirror the upper triangle
+        summary[key] = np.triu(values) + np.triu(values, k=1).T
+
+    return summary
+
+def get_chromosome_enrichment(selection, background):
+    """Compare the chromosome pairs 3D distances of a selection with the background.
+
+    Parameters
+    ----------
+    selection, background : dict
+        Output of get_matrix_chromosome_distances.
+
+    Returns
+    -------
+    (chromosome_number, chromosome_number) array
+        log2(background mean / selection mean): positive when the selected loci are closer than expected.
+    """
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.log2(background["mean"] / selection["mean"])
@@ -0,0 +1,108 @@
+import numpy as np
+import pandas as pd
+
+# 3D radii of the crowding counts, in the unit of the 3D coordinates
+CROWDING_RADII = (10, 20, 40)
+# The nuclear periphery is estimated at this quantile of the distances of the loci to the nuclear centroid
+PERIPHERY_QUANTILE = 0.99
+TRACK_LABELS = {"centroid_distance": "Distance to the nuclear centroid",
+                "periphery_distance": "Distance to the nuclear periphery"}
+# Columns of compute_crowding_track with the default radii
+TRACKS = ["loci_within_{:g}".format(radius) for radius in CROWDING_RADII] + list(TRACK_LABELS)
+BIAS_COLUMNS = ["track", "genes", "mean", "null_mean", "null_sd", "z_score", "p_value"]
+
+
+def get_track_label(track):
+    """Readable name of a track (column of compute_crowding_track)."""
+    if track.startswith("loci_within_"):
+        return "Loci within {} (3D crowding)".format(track[len("loci_within_"):])
+    return TRACK_LABELS.get(track, track)
+
+def compute_crowding_track(centroids, spatial_index, radii=CROWDING_RADII, periphery_quantile=PERIPHERY_QUANTILE):
+    """Compute the 3D crowding and the radial position of every locus.
+
+    Parameters
+    ----------
+    centroids : Pandas dataframe
+        x, y, z coordinates indexed by Primary_SGDID (output of spatial.get_locus_centroids).
+    spatial_index : scipy.spatial.cKDTree
+        KD-tree over the centroids (output of spatial.build_spatial_index).
+    radii : tuple
+        3D radii of the crowding counts.
+    periphery_quantile : float
+        The model has no nuclear envelope: its radius is this quantile of the distances to the nuclear centroid.
+
+    Returns
+    -------
+    Pandas dataframe
+        Indexed by Primary_SGDID in the order of centroids: loci_within_<radius> (number of other
+        loci within each radius, int32), centroid_distance (to the centroid of all the loci) and
+        periphery_distance (to the estimated nuclear periphery, 0 outside of it), float32.
+    """
+    points = centroids[["x", "y", "z"]].to_numpy(dtype=float)
+    track = pd.DataFrame(index=centroids.index)
+    for radius in radii:
+        # The locus itself is within the radius
+        track["loci_within_{:g}".format(radius)] = (spatial_index.query_ball_point(points, radius, return_length=True) - 1).astype(np.int32)
+
+    centroid_distance = np.linalg.norm(points - points.mean(axis=0), axis=1)
+    nucleus_radius = np.quantile(centroid_distance, periphery_quantile) if len(points) else 0
+    track["centroid_distance"] = centroid_distance.astype(np.float32)
+    track["periphery_distance"] = np.maximum(nucleus_radius - centroid_distance, 0).astype(np.float32)
+
+    return track
+
+def test_track_bias(track, positions, samples=1000, seed=0, max_values=2**22):
+    """Compare the track values of a genes list with random loci sets of the same size (size-matched null).
+
+    All the tracks and a batch of random sets are drawn at once.
+
+    Parameters
+    ----------
+    track : Pandas dataframe
+        Output of compute_crowding_track, without missing values.
+    positions : numpy array
+        Rows of the genes of the list in track.
+    samples : int
+        Number of random sets.
+    seed : int
+        Random generator seed.
+    max_values : int
+        Maximum number of values drawn per batch of random sets, bounds memory.
+
+    Returns
+    -------
+    Pandas dataframe
+        track, genes, mean (of the list), null_mean, null_sd, z_score and two-sided p_value, one row per
+        track. A negative z-score of periphery_distance means that the list is closer to the periphery.
+    """
+    values = track.to_numpy(dtype=float)
+    positions = np.unique(positions)
+    size = len(positions)
+    mean = values[positions].mean(axis=0) if size else np.full(values.shape[1], np.nan)
+    null_mean, null_sd, p_value = (np.full(values.shape[1], np.nan) for _ in range(3))
+
+    if 0 < size < len(values):
+        rng = np.random.default_rng(seed)
+        null = np.empty((samples, values.shape[1]))
+        batch_size = max(1, max_values // max(len(values), size * values.shape[1]))
+        for start in range(0, samples, batch_size):
+            batch = min(batch_size, samples - start)
+            # Random sets without replacement: the size smallest of random keys
+            random_sets = np.argpartition(rng.random((batch, len(values))), size - 1, axis=1)[:, :size]
+            null[start:start + batch] = values[random_sets].mean(axis=1)
+        null_mean, null_sd = null.mean(axis=0), null.std(axis=0)
+        lower = ((null <= mean).sum(axis=0) + 1) / (samples + 1)
+        higher = ((null >= mean).sum(axis=0) + 1) / (samples + 1)
+        p_value = np.minimum(2 * np.minimum(lower, higher), 1)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        z_score = np.where(null_sd > 0, (mean - null_mean) / null_sd, np.nan)
+
+    return pd.DataFrame({"track": track.columns,
+                         "genes": size,
+                         "mean": mean,
+                         "null_mean": null_mean,
+                         "null_sd": null_sd,
+                         "z_score": z_score,
+                         "p_value": p_value}, columns=BIAS_COLUMNS)
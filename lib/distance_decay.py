@@ -0,0 +1,209 @@
+import numpy as np
+import pandas as pd
+
+# Genomic distance bins (bp): 10 log bins per decade from 100 bp to 10 Mb, the first and last ones are open
+GENOMIC_BINS = np.logspace(2, 7, 51)
+BINS_COLUMNS = ["chromosome", "bin", "genomic_start", "genomic_end", "pairs", "mean_3D_distance", "sd_3D_distance"]
+CURVES_COLUMNS = ["chromosome", "exponent", "prefactor", "pairs", "bins"]
+SCORES_COLUMNS = ["expected_3D_distance", "fitted_3D_distance", "z_score"]
+
+
+def get_locus_midpoints(feature_name, sgdids):
+    """Get the chromosome and genomic midpoint of the loci of a distance matrix.
+
+    Parameters
+    ----------
+    feature_name : Pandas dataframe
+        Primary_SGDID, Chromosome, Start_coordinate and Stop_coordinate of the loci.
+    sgdids : Pandas index
+        Loci of the matrix rows and columns (output of genomes.open_distance_matrix).
+
+    Returns
+    -------
+    chromosome : int array
+        Chromosome of each locus, 0 if unknown.
+    midpoint : float array
+        Middle of each locus (bp), NaN if unknown.
+    """
+    loci = feature_name.drop_duplicates(subset=["Primary_SGDID"]).set_index("Primary_SGDID").reindex(sgdids)
+    chromosome = pd.to_numeric(loci["Chromosome"], errors="coerce")
+    midpoint = (pd.to_numeric(loci["Start_coordinate"], errors="coerce") + pd.to_numeric(loci["Stop_coordinate"], errors="coerce")) / 2
+    unknown = chromosome.isna() | midpoint.isna()
+    return np.where(unknown, 0, chromosome.fillna(0)).astype(int), np.where(unknown, np.nan, midpoint)
+
+def count_cis_pairs(chromosome, positions=None):
+    """Number of same-chromosome pairs of a loci set (all the loci if positions is None)."""
+    chromosome = chromosome if positions is None else chromosome[positions]
+    counts = np.bincount(chromosome[chromosome > 0])
+    return int(np.sum(counts * (counts - 1) // 2))
+
+def iter_cis_pairs(matrix, chromosome, midpoint, positions=None, max_cells=2**22):
+    """Iterate over the same-chromosome pairs of a loci set with their genomic and 3D distances, a block of rows at a time.
+
+    Parameters
+    ----------
+    matrix : (loci, loci) array
+        3D distances (output of genomes.open_distance_matrix).
+    chromosome, midpoint : numpy arrays
+        Chromosome and genomic midpoint of the matrix loci (output of get_locus_midpoints).
+    positions : numpy array, optional
+        Positions of the loci in the matrix, all the loci if None.
+    max_cells : int
+        Maximum number of matrix cells read per chunk, bounds memory.
+
+    Returns
+    -------
+    generator
+        Pandas dataframes with position_1, position_2, chromosome, genomic_distance and 3D_distance
+        columns (position_1 < position_2 in the order of positions, pairs without 3D distance are skipped),
+        one chromosome per dataframe.
+    """
+    positions = np.arange(len(chromosome)) if positions is None else np.asarray(positions)
+    positions = positions[chromosome[positions] > 0]
+
+    for number in np.unique(chromosome[positions]):
+        members = positions[chromosome[positions] == number]
+        rows_number = max(1, max_cells // len(members))
+        for start in range(0, len(members) - 1, rows_number):
+            rows = members[start:start + rows_number]
+            columns = members[start + 1:]
+            block = matrix[np.ix_(rows, columns)]
+            # Row k is the locus start + k, column l the locus start + 1 + l: pairs i < j for k <= l
+            row, column = np.nonzero(np.arange(len(rows))[:, None] <= np.arange(len(columns))[None, :])
+            values = block[row, column]
+            kept = ~np.isnan(values)
+            row, column = rows[row[kept]], columns[column[kept]]
+            yield pd.DataFrame({"position_1": row,
+                                "position_2": column,
+                                "chromosome": number,
+                                "genomic_distance": np.abs(midpoint[row] - midpoint[column]),
+                                "3D_distance": values[kept].astype(float)})
+
+def _get_bin_index(genomic_distance, genomic_bins):
+    return np.clip(np.searchsorted(genomic_bins, genomic_distance, side="right") - 1, 0, len(genomic_bins) - 2)
+
+def get_decay_bins(chunks, genomic_bins=GENOMIC_BINS):
+    """Summarize the 3D distances of gene pairs by chromosome and genomic distance bin.
+
+    Only the count, sum and sum of squares of each bin are kept: memory does not depend
+    on the number of pairs.
+
+    Parameters
+    ----------
+    chunks : iterable
+        Pandas dataframes with chromosome, genomic_distance and 3D_distance columns (output of iter_cis_pairs).
+    genomic_bins : numpy array
+        Bin edges (bp), increasing. Shorter and longer distances are counted in the first and last bins.
+
+    Returns
+    -------
+    Pandas dataframe
+        chromosome, bin, genomic_start, genomic_end, pairs, mean_3D_distance and sd_3D_distance of the bins with pairs.
+    """
+    bins_number = len(genomic_bins) - 1
+    count = np.zeros(0)
+    total = np.zeros(0)
+    squares = np.zeros(0)
+
+    for chunk in chunks:
+        if not len(chunk):
+            continue
+        distances = chunk["3D_distance"].to_numpy(dtype=float)
+        codes = chunk["chromosome"].to_numpy(dtype=int) * bins_number + _get_bin_index(chunk["genomic_distance"].to_numpy(), genomic_bins)
+        size = max(len(count), codes.max() + 1)
+        count = np.pad(count, (0, size - len(count)))
+        total = np.pad(total, (0, size - len(total)))
+        squares = np.pad(squares, (0, size - len(squares)))
+        count += np.bincount(codes, minlength=size)
+        total += np.bincount(codes, weights=distances, minlength=size)
+        squares += np.bincount(codes, weights=distances ** 2, minlength=size)
+
+    codes = np.flatnonzero(count)
+    count, total, squares = count[codes], total[codes], squares[codes]
+    mean = total / count
+    with np.errstate(invalid="ignore", divide="ignore"):
+        sd = np.sqrt(np.maximum(squares - count * mean ** 2, 0) / (count - 1))
+    bin_index = codes % bins_number
+
+    return pd.DataFrame({"chromosome": codes // bins_number,
+                         "bin": bin_index,
+                         "genomic_start": genomic_bins[bin_index],
+                         "genomic_end": genomic_bins[bin_index + 1],
+                         "pairs": count.astype(int),
+                         "mean_3D_distance": mean,
+                         "sd_3D_distance": sd}, columns=BINS_COLUMNS)
+
+def fit_decay_curves(decay_bins, min_pairs=10):
+    """Fit a power law 3D distance = prefactor * genomic distance ** exponent per chromosome.
+
+    Least squares in log-log space on the mean 3D distance of the bins with at least
+    min_pairs pairs, weighted by the square root of their number of pairs.
+
+    Parameters
+    ----------
+    decay_bins : Pandas dataframe
+        Output of get_decay_bins.
+    min_pairs : int
+
+    Returns
+    -------
+    Pandas dataframe
+        chromosome, exponent, prefactor, pairs and bins (number of fitted bins). Exponent and
+        prefactor are NaN for the chromosomes with less than 2 fitted bins.
+    """
+    rows = []
+    for number, chromosome_bins in decay_bins.groupby("chromosome"):
+        fitted = chromosome_bins[(chromosome_bins["pairs"] >= min_pairs) & (chromosome_bins["mean_3D_distance"] > 0)]
+        exponent = prefactor = np.nan
+        if len(fitted) >= 2:
+            center = np.sqrt(fitted["genomic_start"] * fitted["genomic_end"])
+            exponent, intercept = np.polyfit(np.log10(center), np.log10(fitted["mean_3D_distance"]), 1,
+                                             w=np.sqrt(fitted["pairs"]))
+            prefactor = 10 ** intercept
+        rows.append([number, exponent, prefactor, int(chromosome_bins["pairs"].sum()), len(fitted)])
+    return pd.DataFrame(rows, columns=CURVES_COLUMNS)
+
+def score_pairs(pairs, decay_bins, decay_curves, min_pairs=10, genomic_bins=GENOMIC_BINS):
+    """Compare the 3D distances of gene pairs with the distances expected from their genomic distance.
+
+    Parameters
+    ----------
+    pairs : Pandas dataframe
+        chromosome, genomic_distance and 3D_distance columns (a chunk of iter_cis_pairs).
+    decay_bins, decay_curves : Pandas dataframes
+        Outputs of get_decay_bins and fit_decay_curves, usually for all the pairs of the genome.
+    min_pairs : int
+        Bins with less pairs give no expected distance.
+    genomic_bins : numpy array
+        Bin edges of decay_bins.
+
+    Returns
+    -------
+    Pandas dataframe
+        pairs with expected_3D_distance (mean of the bin), fitted_3D_distance (decay curve) and
+        z_score ((3D_distance - expected) / sd of the bin) columns. Strongly negative z-scores
+        flag the pairs much closer in 3D than their genomic distance predicts.
+    """
+    bins_number = len(genomic_bins) - 1
+    reliable = decay_bins[decay_bins["pairs"] >= min_pairs]
+    size = (max(np.max(decay_bins["chromosome"].to_numpy(), initial=0), np.max(pairs["chromosome"].to_numpy(), initial=0)) + 1) * bins_number
+    mean = np.full(size, np.nan)
+    sd = np.full(size, np.nan)
+    codes = reliable["chromosome"].to_numpy() * bins_number + reliable["bin"].to_numpy()
+    mean[codes] = reliable["mean_3D_distance"].to_numpy()
+    sd[codes] = reliable["sd_3D_distance"].to_numpy()
+
+    genomic_distance = pairs["genomic_distance"].to_numpy()
+    codes = pairs["chromosome"].to_numpy(dtype=int) * bins_number + _get_bin_index(genomic_distance, genomic_bins)
+    curves = decay_curves.set_index("chromosome").reindex(pairs["chromosome"])
+    with np.errstate(invalid="ignore", divide="ignore"):
+        z_score = (pairs["3D_distance"].to_numpy() - mean[codes]) / np.where(sd[codes] > 0, sd[codes], np.nan)
+        fitted = curves["prefactor"].to_numpy() * np.maximum(genomic_distance, genomic_bins[0]) ** curves["exponent"].to_numpy()
+
+    return pairs.assign(expected_3D_distance=mean[codes], fitted_3D_distance=fitted, z_score=z_score)
+
+def iter_scored_pairs(chunks, decay_bins, decay_curves, max_z=None, min_pairs=10):
+    """Score chunks of pairs with score_pairs, keeping the pairs with a z-score lower than or equal to max_z (all if None)."""
+    for chunk in chunks:
+        scored = score_pairs(chunk, decay_bins, decay_curves, min_pairs)
+        yield scored if max_z is None else scored[scored["z_score"] <= max_z]
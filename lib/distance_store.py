@@ -0,0 +1,316 @@
+import collections
+import json
+import os
+import tempfile
+import threading
+
+import numpy as np
+import pandas as pd
+
+import lib.distances as distances
+
+# Files of a distance store directory: its layout, the loci of the matrix rows and columns (in this order),
+# one .npy file per pair of blocks of loci and, for the stores computed from the 3D model, the loci geometry
+STORE_FILE = "store.json"
+LOCI_FILE = "loci.csv"
+BLOCK_FILE = "block_{}_{}.npy"
+GEOMETRY_ARRAYS = ["centroids", "starts", "ends", "offsets"]
+# A block is at most 4096 loci: a pair of blocks is at most 64 MB
+MAX_BLOCK_LOCI = 4096
+
+
+def get_loci_blocks(chromosomes, max_loci=MAX_BLOCK_LOCI):
+    """Split loci sorted by chromosome in blocks of consecutive loci.
+
+    Consecutive chromosomes share a block up to max_loci loci, longer chromosomes are
+    split: a list of genes reads a few blocks, and a block is computed or written at once.
+
+    Parameters
+    ----------
+    chromosomes : numpy array
+        Chromosome of each locus, NaN if unknown.
+    max_loci : int
+        Maximum number of loci per block.
+
+    Returns
+    -------
+    order : numpy array
+        Loci sorted by chromosome (unknown last), in their order within a chromosome.
+    sizes : list
+        Number of loci of each block, the blocks are consecutive in order.
+    """
+    codes, uniques = pd.factorize(pd.to_numeric(pd.Series(chromosomes), errors="coerce"), sort=True)
+    codes = np.where(codes < 0, len(uniques), codes)
+    order = np.argsort(codes, kind="stable")
+
+    sizes = [0]
+    for count in np.bincount(codes).tolist():
+        while count:
+            if sizes[-1] == max_loci or (sizes[-1] and sizes[-1] + count > max_loci and count <= max_loci):
+                sizes.append(0)
+            added = min(count, max_loci - sizes[-1])
+            sizes[-1] += added
+            count -= added
+    return order, [size for size in sizes if size]
+
+def _write_layout(directory, sgdids, sizes, method):
+    with open(os.path.join(directory, STORE_FILE), "w") as store_file:
+        json.dump({"blocks": sizes, "method": method}, store_file)
+    # Written last: the store is complete
+    pd.DataFrame({"Primary_SGDID": pd.Index(sgdids)}).to_csv(os.path.join(directory, LOCI_FILE), index=False)
+
+def write_edges_store(directory, edges_file, locus_chromosomes, max_loci=MAX_BLOCK_LOCI, batch_size=2**20):
+    """Write a Parquet 3D distances table as a distance store, a batch of pairs at a time.
+
+    Every pair of blocks is written: the store holds all the pairs of the table, without
+    loading it (memory is bounded by batch_size pairs).
+
+    Parameters
+    ----------
+    directory : str
+        Store directory, created if missing.
+    edges_file : str
+        Parquet file with Primary_SGDID, Primary_SGDID_bis and 3D_distances columns.
+    locus_chromosomes : Pandas series
+        Chromosome of the loci, indexed by Primary_SGDID. The other loci are in the last blocks.
+    max_loci : int
+        Maximum number of loci per block.
+    batch_size : int
+        Number of pairs read at a time.
+    """
+    import pyarrow.parquet as pq
+
+    os.makedirs(directory, exist_ok=True)
+    edges = pq.ParquetFile(edges_file)
+    columns = ["Primary_SGDID", "Primary_SGDID_bis"]
+
+    # Loci in order of first appearance in the first column, then in the second one
+    firsts, seconds = [], []
+    for batch in edges.iter_batches(batch_size=batch_size, columns=columns):
+        batch = batch.to_pandas()
+        firsts.append(pd.unique(batch["Primary_SGDID"].astype(object)))
+        seconds.append(pd.unique(batch["Primary_SGDID_bis"].astype(object)))
+    sgdids = pd.Index(pd.unique(np.concatenate(firsts + seconds) if firsts else np.empty(0, dtype=object)), dtype=object)
+
+    order, sizes = get_loci_blocks(locus_chromosomes.reindex(sgdids).to_numpy(), max_loci)
+    sgdids = sgdids[order]
+    bounds = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+    locus_block = np.repeat(np.arange(len(sizes)), sizes)
+
+    for low in range(len(sizes)):
+        for high in range(low, len(sizes)):
+            block = np.lib.format.open_memmap(os.path.join(directory, BLOCK_FILE.format(low, high)), mode="w+",
+                                              dtype=np.float32, shape=(sizes[low], sizes[high]))
+            block[:] = np.nan
+            if low == high:
+                np.fill_diagonal(block, 0)
+            block.flush()
+            del block
+
+    for batch in edges.iter_batches(batch_size=batch_size, columns=columns + ["3D_distances"]):
+        batch = batch.to_pandas()
+        first = sgdids.get_indexer(batch["Primary_SGDID"].astype(object))
+        second = sgdids.get_indexer(batch["Primary_SGDID_bis"].astype(object))
+        values = batch["3D_distances"].to_numpy(dtype=np.float32)
+        # Each pair in the block of the lower block of its loci first
+        swap = locus_block[first] > locus_block[second]
+        first, second = np.where(swap, second, first), np.where(swap, first, second)
+
+        codes = locus_block[first] * len(sizes) + locus_block[second]
+        pairs_order = np.argsort(codes, kind="stable")
+        block_codes, starts = np.unique(codes[pairs_order], return_index=True)
+        for code, pairs in zip(block_codes, np.split(pairs_order, starts[1:])):
+            low, high = divmod(int(code), len(sizes))
+            # Opened per batch: the number of open files does not depend on the number of blocks
+            block = np.load(os.path.join(directory, BLOCK_FILE.format(low, high)), mmap_mode="r+")
+            block_rows, block_columns = first[pairs] - bounds[low], second[pairs] - bounds[high]
+            block[block_rows, block_columns] = values[pairs]
+            if low == high:
+                block[block_columns, block_rows] = values[pairs]
+            block.flush()
+            del block
+
+    _write_layout(directory, sgdids, sizes, None)
+
+def write_geometry_store(directory, geometry, locus_chromosomes, method="centroid", max_loci=MAX_BLOCK_LOCI):
+    """Write a distance store of the 3D distances of a loci geometry, computed when its blocks are first read.
+
+    Only the geometry is written (memory-mapped by BlockMatrix): memory and disk space
+    grow with the number of loci, not of pairs, until the blocks are read.
+
+    Parameters
+    ----------
+    directory : str
+        Store directory, created if missing.
+    geometry : dict
+        Loci geometry (output of distances.get_locus_geometry).
+    locus_chromosomes : Pandas series
+        Chromosome of the loci, indexed by Primary_SGDID. The other loci are in the last blocks.
+    method : str
+        3D distance method, see distances.get_distance_block.
+    max_loci : int
+        Maximum number of loci per block.
+    """
+    if method not in distances.DISTANCE_METHODS:
+        raise ValueError("Unknown distance method: {} (expected one of {})".format(method, distances.DISTANCE_METHODS))
+
+    os.makedirs(directory, exist_ok=True)
+    order, sizes = get_loci_blocks(locus_chromosomes.reindex(geometry["sgdids"]).to_numpy(), max_loci)
+
+    # Segments of the loci in the order of the store
+    offsets = geometry["offsets"]
+    lengths = np.diff(offsets)[order]
+    segments = np.repeat(offsets[order] - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths) + np.arange(lengths.sum())
+    arrays = {"centroids": geometry["centroids"][order],
+              "starts": geometry["starts"][segments],
+              "ends": geometry["ends"][segments],
+              "offsets": np.concatenate([[0], np.cumsum(lengths)])}
+    for name in GEOMETRY_ARRAYS:
+        np.save(os.path.join(directory, name + ".npy"), arrays[name])
+
+    _write_layout(directory, geometry["sgdids"][order], sizes, method)
+
+def read_store_loci(directory):
+    """Read the loci of the matrix rows and columns of a distance store."""
+    return pd.Index(pd.read_csv(os.path.join(directory, LOCI_FILE))["Primary_SGDID"].astype(str), dtype=object)
+
+def _as_index(positions):
+    # Consecutive positions are read as a slice, faster than fancy indexing
+    if len(positions) and positions[-1] - positions[0] == len(positions) - 1 and np.all(np.diff(positions) == 1):
+        return slice(int(positions[0]), int(positions[-1]) + 1)
+    return positions
+
+def _read_block(block, rows, columns):
+    if isinstance(rows, slice) or isinstance(columns, slice):
+        return block[rows][:, columns]
+    return block[rows[:, None], columns]
+
+
+class BlockMatrix:
+    """Read-only (loci, loci) 3D distance matrix of a distance store, memory-mapped a pair of blocks at a time.
+
+    Stands for a distance matrix (e.g. in gene_lists.update_list_state): 0 on the diagonal and
+    NaN for missing pairs. The blocks of a store written from the loci geometry are computed
+    and written at their first read. Only the directory is pickled, e.g. for the job workers.
+    Indexes: a slice or an array of rows, a tuple of two of them, or the output of np.ix_.
+
+    Parameters
+    ----------
+    directory : str
+        Store directory (see write_edges_store and write_geometry_store).
+    max_open : int
+        Maximum number of blocks kept memory-mapped (least recently read are closed).
+    chunk_size : int
+        Number of block rows computed at a time.
+    """
+
+    def __init__(self, directory, max_open=256, chunk_size=256):
+        self.directory = directory
+        self.max_open = max_open
+        self.chunk_size = chunk_size
+        with open(os.path.join(directory, STORE_FILE)) as store_file:
+            layout = json.load(store_file)
+        self.method = layout["method"]
+        self.bounds = np.concatenate([[0], np.cumsum(layout["blocks"])]).astype(np.int64)
+        self.shape = (int(self.bounds[-1]), int(self.bounds[-1]))
+        self.dtype = np.dtype(np.float32)
+        self.blocks = collections.OrderedDict()
+        self.geometry = None
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        return {"directory": self.directory, "max_open": self.max_open, "chunk_size": self.chunk_size}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def nbytes(self):
+        """Size of the blocks currently memory-mapped."""
+        with self.lock:
+            return sum(block.nbytes for block in self.blocks.values())
+
+    def _get_geometry(self):
+        with self.lock:
+            if self.geometry is None:
+                self.geometry = {name: np.load(os.path.join(self.directory, name + ".npy"), mmap_mode="r") for name in GEOMETRY_ARRAYS}
+            return self.geometry
+
+    def _write_block(self, low, high, path):
+        geometry = self._get_geometry()
+        rows = slice(int(self.bounds[low]), int(self.bounds[low + 1]))
+        columns = slice(int(self.bounds[high]), int(self.bounds[high + 1]))
+        # Written then renamed: a concurrent reader never maps a partial block
+        handle, temporary = tempfile.mkstemp(prefix=".tmp", suffix=".npy", dir=self.directory)
+        os.close(handle)
+        try:
+            block = np.lib.format.open_memmap(temporary, mode="w+", dtype=np.float32, shape=(rows.stop - rows.start, columns.stop - columns.start))
+            for start in range(rows.start, rows.stop, self.chunk_size):
+                stop = min(start + self.chunk_size, rows.stop)
+                block[start - rows.start:stop - rows.start] = distances.get_distance_block(geometry, slice(start, stop), columns, self.method)
+            block.flush()
+            del block
+            os.replace(temporary, path)
+        finally:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+
+    def get_block(self, low, high):
+        """Memory-mapped (block low loci, block high loci) distances, for low <= high."""
+        key = (low, high)
+        with self.lock:
+            if key in self.blocks:
+                self.blocks.move_to_end(key)
+                return self.blocks[key]
+
+        path = os.path.join(self.directory, BLOCK_FILE.format(low, high))
+        if not os.path.exists(path):
+            self._write_block(low, high, path)
+        # Read as an array: np.memmap adds an overhead to each read of a few cells
+        block = np.load(path, mmap_mode="r").view(np.ndarray)
+
+        with self.lock:
+            self.blocks[key] = block
+            while len(self.blocks) > self.max_open:
+                self.blocks.popitem(last=False)
+        return block
+
+    def _positions(self, key):
+        if isinstance(key, slice):
+            return np.arange(*key.indices(self.shape[0]))
+        return np.asarray(key).ravel()
+
+    def _split(self, positions):
+        # Block, positions in the output and positions in the block of the loci of each block
+        blocks = np.searchsorted(self.bounds, positions, side="right") - 1
+        if len(blocks) and blocks[0] == blocks[-1] and np.all(blocks == blocks[0]):
+            return [(int(blocks[0]), slice(0, len(positions)), _as_index(positions - self.bounds[blocks[0]]))]
+        order = np.argsort(blocks, kind="stable")
+        numbers, starts = np.unique(blocks[order], return_index=True)
+        return [(int(number), _as_index(selected), _as_index(positions[selected] - self.bounds[number]))
+                for number, selected in zip(numbers, np.split(order, starts[1:]))]
+
+    def __getitem__(self, key):
+        rows, columns = key if isinstance(key, tuple) else (key, slice(None))
+        rows = self._positions(rows)
+        columns = self._positions(columns)
+
+        values = np.empty((len(rows), len(columns)), dtype=np.float32)
+        column_blocks = self._split(columns)
+        # Within a set of loci (e.g. np.ix_(positions, positions)) the rows are split once
+        row_blocks = column_blocks if len(rows) == len(columns) and np.array_equal(rows, columns) else self._split(rows)
+        for row_block, row_output, row_local in row_blocks:
+            for column_block, column_output, column_local in column_blocks:
+                # Only the blocks low <= high are stored, the others are their transpose
+                if row_block <= column_block:
+                    block = _read_block(self.get_block(row_block, column_block), row_local, column_local)
+                else:
+                    block = _read_block(self.get_block(column_block, row_block), column_local, row_local).T
+                if isinstance(row_output, slice) or isinstance(column_output, slice):
+                    values[row_output, column_output] = block
+                else:
+                    values[row_output[:, None], column_output] = block
+        return values
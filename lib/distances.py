@@ -0,0 +1,542 @@
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+from scipy.spatial.distance import cdist
+
+import lib.spatial as spatial
+
+DISTANCE_METHODS = ["centroid", "segment"]
+
+# Locus geometry shared with the worker processes
+_geometry = None
+
+
+def get_locus_geometry(plotly_segments, sgdids=None):
+    """Extract the 3D segments of each locus as numpy arrays.
+
+    Parameters
+    ----------
+    plotly_segments : Pandas dataframe
+        3D segments coordinates (x, y, z) and their associated locus (Primary_SGDID).
+        Consecutive rows of the same locus are the ends of a segment, rows with missing
+        coordinates separate the segments.
+    sgdids : list, optional
+        Primary_SGDID of the loci to keep, in this order. Loci without 3D coordinates are ignored.
+        By default, all the loci with 3D coordinates.
+
+    Returns
+    -------
+    dict
+        sgdids : Pandas index of the loci.
+        centroids : (loci, 3) array, mean of the segments ends of each locus.
+        starts, ends : (segments, 3) arrays, segments ends sorted by locus.
+        offsets : (loci + 1) array, the segments of locus i are starts[offsets[i]:offsets[i+1]].
+    """
+    xyz = plotly_segments[["x", "y", "z"]].to_numpy(dtype=float)
+    locus = plotly_segments["Primary_SGDID"].to_numpy()
+
+    valid = ~np.isnan(xyz).any(axis=1) & pd.notna(locus)
+    is_segment = valid[:-1] & valid[1:] & (locus[:-1] == locus[1:])
+    segment_rows = np.flatnonzero(is_segment)
+
+    segment_locus = pd.Index(locus[segment_rows])
+    if sgdids is None:
+        sgdids = segment_locus.unique()
+    sgdids = pd.Index(sgdids)
+    sgdids = sgdids[sgdids.isin(segment_locus)]
+
+    # Sort the segments by locus, in the order of sgdids
+    segment_code = sgdids.get_indexer(segment_locus)
+    kept = segment_code >= 0
+    order = np.argsort(segment_code[kept], kind="stable")
+    segment_rows = segment_rows[kept][order]
+    segment_code = segment_code[kept][order]
+
+    starts = xyz[segment_rows]
+    ends = xyz[segment_rows + 1]
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(segment_code, minlength=len(sgdids)))])
+
+    centroids = spatial.get_locus_centroids(plotly_segments).reindex(sgdids).to_numpy(dtype=float)
+
+    return {"sgdids": sgdids,
+            "centroids": centroids,
+            "starts": starts,
+            "ends": ends,
+            "offsets": offsets}
+
+def segment_distances(starts_1, ends_1, starts_2, ends_2):
+    """Compute the minimum distances between two sets of 3D segments.
+
+    Closest points computation from Ericson, Real-Time Collision Detection (2005),
+    vectorized with matrix products over all the segment pairs.
+
+    Parameters
+    ----------
+    starts_1, ends_1 : (m, 3) arrays
+        Ends of the first segments.
+    starts_2, ends_2 : (n, 3) arrays
+        Ends of the second segments.
+
+    Returns
+    -------
+    (m, n) array
+    """
+    d1 = ends_1 - starts_1
+    d2 = ends_2 - starts_2
+
+    a = (d1 * d1).sum(axis=1)[:, None]
+    e = (d2 * d2).sum(axis=1)[None, :]
+    b = d1 @ d2.T
+    # r = starts_1 - starts_2
+    c = (d1 * starts_1).sum(axis=1)[:, None] - d1 @ starts_2.T
+    f = starts_1 @ d2.T - (d2 * starts_2).sum(axis=1)[None, :]
+    rr = (starts_1 * starts_1).sum(axis=1)[:, None] + (starts_2 * starts_2).sum(axis=1)[None, :] - 2 * starts_1 @ starts_2.T
+
+    eps = 1e-12
+    a_ok = a > eps
+    e_ok = e > eps
+    safe_a = np.where(a_ok, a, 1)
+    safe_e = np.where(e_ok, e, 1)
+
+    # Closest point on the first segment for non parallel segments
+    denom = a * e - b * b
+    not_parallel = denom > eps * a * e
+    s = np.where(not_parallel, (b * f - c * e) / np.where(not_parallel, denom, 1), 0)
+    s = np.clip(s, 0, 1)
+    t = np.where(e_ok, (b * s + f) / safe_e, 0)
+
+    # Clamp t to the second segment and recompute s
+    s = np.where(t < 0, np.clip(-c / safe_a, 0, 1), np.where(t > 1, np.clip((b - c) / safe_a, 0, 1), s))
+    t = np.clip(t, 0, 1)
+
+    # Degenerate segments (points)
+    s = np.where(e_ok, s, np.clip(-c / safe_a, 0, 1))
+    t = np.where(e_ok, t, 0)
+    s = np.where(a_ok, s, 0)
+    t = np.where(a_ok, t, np.where(e_ok, np.clip(f / safe_e, 0, 1), 0))
+
+    squared = rr + s * s * a + t * t * e + 2 * s * c - 2 * t * f - 2 * s * t * b
+
+    return np.sqrt(np.maximum(squared, 0))
+
+def get_distance_block(geometry, rows, columns, method="centroid"):
+    """Compute the 3D distances between two ranges of loci.
+
+    Parameters
+    ----------
+    geometry : dict
+        Loci geometry (output of get_locus_geometry).
+    rows, columns : slice
+        Ranges of loci in geometry["sgdids"].
+    method : str
+        "centroid": distance between the loci centroids.
+        "segment": minimum distance between the segments of the loci.
+
+    Returns
+    -------
+    (rows, columns) array
+    """
+    if method == "centroid":
+        return cdist(geometry["centroids"][rows], geometry["centroids"][columns])
+
+    if method == "segment":
+        offsets = geometry["offsets"]
+        row_offsets = offsets[rows.start:rows.stop + 1]
+        column_offsets = offsets[columns.start:columns.stop + 1]
+        row_segments = slice(row_offsets[0], row_offsets[-1])
+        column_segments = slice(column_offsets[0], column_offsets[-1])
+
+        distances = segment_distances(geometry["starts"][row_segments], geometry["ends"][row_segments],
+                                      geometry["starts"][column_segments], geometry["ends"][column_segments])
+
+        # Minimum over the segments of each locus
+        distances = np.minimum.reduceat(distances, row_offsets[:-1] - row_offsets[0], axis=0)
+        distances = np.minimum.reduceat(distances, column_offsets[:-1] - column_offsets[0], axis=1)
+        return distances
+
+    raise ValueError("Unknown distance method: {} (expected one of {})".format(method, DISTANCE_METHODS))
+
+def _init_worker(geometry):
+    global _geometry
+    _geometry = geometry
+
+def _upper_block(args):
+    start, stop, method = args
+    return start, get_distance_block(_geometry, slice(start, stop), slice(start, len(_geometry["sgdids"])), method)
+
+def iter_distance_edges(geometry, method="centroid", chunk_size=256, processes=1):
+    """Compute the 3D distances between all pairs of loci, by chunks.
+
+    Each chunk holds the pairs of chunk_size loci with all the following loci,
+    so that memory is bounded by chunk_size x loci distances.
+
+    Parameters
+    ----------
+    geometry : dict
+        Loci geometry (output of get_locus_geometry).
+    method : str
+        "centroid" or "segment" (see get_distance_block).
+    chunk_size : int
+        Number of loci per chunk.
+    processes : int
+        Number of worker processes. Chunks are yielded in order.
+
+    Yields
+    ------
+    Pandas dataframe
+        Primary_SGDID, Primary_SGDID_bis and 3D_distances columns, as in 3D_distances.parquet.gzip.
+    """
+    if method not in DISTANCE_METHODS:
+        raise ValueError("Unknown distance method: {} (expected one of {})".format(method, DISTANCE_METHODS))
+
+    loci_number = len(geometry["sgdids"])
+    sgdids = geometry["sgdids"].to_numpy()
+    tasks = [(start, min(start + chunk_size, loci_number), method) for start in range(0, loci_number, chunk_size)]
+
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(geometry,))
+        blocks = pool.imap(_upper_block, tasks)
+    else:
+        pool = None
+        _init_worker(geometry)
+        blocks = map(_upper_block, tasks)
+
+    try:
+        for start, block in blocks:
+            # Keep the pairs (i, j) with i < j
+            i, j = np.nonzero(np.triu(np.ones(block.shape, dtype=bool), k=1))
+            yield pd.DataFrame({"Primary_SGDID": sgdids[start + i],
+                                "Primary_SGDID_bis": sgdids[start + j],
+                                "3D_distances": block[i, j]})
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+def get_distance_edges(geometry, method="centroid", chunk_size=256, processes=1):
+    """Compute the 3D distances between all pairs of loci.
+
+    Parameters
+    ----------
+    geometry : dict
+        Loci geometry (output of get_locus_geometry).
+    method : str
+        "centroid" or "segment" (see get_distance_block).
+    chunk_size : int
+        Number of loci per chunk.
+    processes : int
+        Number of worker processes.
+
+    Returns
+    -------
+    Pandas dataframe
+        Primary_SGDID, Primary_SGDID_bis and 3D_distances columns. Loci identifiers are categorical.
+    """
+    categories = geometry["sgdids"]
+    chunks = [chunk.astype({"Primary_SGDID": pd.CategoricalDtype(categories),
+                            "Primary_SGDID_bis": pd.CategoricalDtype(categories),
+                            "3D_distances": "float32"})
+              for chunk in iter_distance_edges(geometry, method, chunk_size, processes)]
+    if not chunks:
+        return pd.DataFrame(columns=["Primary_SGDID", "Primary_SGDID_bis", "3D_distances"])
+
+    edges = pd.concat(chunks, ignore_index=True)
+    edges.index = range(1, len(edges) + 1)
+
+    return edges
+
+def write_distance_edges(path, geometry, method="centroid", chunk_size=256, processes=1):
+    """Compute the 3D distances between all pairs of loci and write them as a Parquet file.
+
+    Chunks are written as row groups, so that memory stays bounded.
+
+    Parameters
+    ----------
+    path : str
+        Output Parquet file.
+    geometry : dict
+        Loci geometry (output of get_locus_geometry).
+    method : str
+        "centroid" or "segment" (see get_distance_block).
+    chunk_size : int
+        Number of loci per chunk.
+    processes : int
+        Number of worker processes.
+
+    Returns
+    -------
+    int
+        Number of pairs written.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    writer = None
+    pairs_number = 0
+    try:
+        for chunk in iter_distance_edges(geometry, method, chunk_size, processes):
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(path, table.schema, compression="gzip")
+            writer.write_table(table)
+            pairs_number += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return pairs_number
+
+def get_distance_histogram(matrix, bin_number=50, max_distance=200, max_cells=2**22):
+    """Histogram of the 3D distances between all the pairs of loci of a distance matrix.
+
+    The upper triangle is read a block of rows at a time: the matrix can be memory-mapped.
+
+    Parameters
+    ----------
+    matrix : (loci, loci) array
+        3D distances, NaN for missing pairs (output of genomes.open_distance_matrix).
+    bin_number : int
+        Number of bins of the [0, max_distance] range.
+    max_distance : float
+    max_cells : int
+        Maximum number of matrix cells read at a time, bounds memory.
+
+    Returns
+    -------
+    counts, bin_edges : numpy arrays
+        Same as np.histogram.
+    pairs_number : int
+        Number of pairs with a 3D distance, including the ones out of the histogram range.
+    """
+    size = len(matrix)
+    counts = np.zeros(bin_number, dtype=np.int64)
+    pairs_number = 0
+    rows_number = max(1, max_cells // max(size, 1))
+    for start in range(0, size - 1, rows_number):
+        stop = min(start + rows_number, size - 1)
+        # Row k is the locus start + k, column l the locus start + 1 + l: pairs i < j for k <= l
+        block = np.asarray(matrix[start:stop, start + 1:size])
+        values = block[np.arange(stop - start)[:, None] <= np.arange(size - start - 1)[None, :]]
+        values = values[~np.isnan(values)]
+        pairs_number += len(values)
+        counts += np.histogram(values, bins=bin_number, range=(0, max_distance))[0]
+
+    return counts, np.linspace(0, max_distance, bin_number + 1), pairs_number
+
+def get_within_distances(matrix, positions):
+    """Get the 3D distances between all pairs of a loci set.
+
+    Parameters
+    ----------
+    matrix : (loci, loci) array
+        3D distances (output of genomes.open_distance_matrix).
+    positions : numpy array
+        Positions of the loci in the matrix.
+
+    Returns
+    -------
+    numpy array
+        Distances of the pairs (i < j), without missing distances.
+    """
+    block = matrix[np.ix_(positions, positions)]
+    within = block[np.triu_indices(len(positions), k=1)]
+
+    return within[~np.isnan(within)]
+
+def get_random_set_means(matrix, universe, size, samples, seed=0):
+    """Compute the mean 3D distance within random loci sets (size-matched null).
+
+    Parameters
+    ----------
+    matrix : (loci, loci) array
+        3D distances (output of genomes.open_distance_matrix).
+    universe : numpy array
+        Positions of the loci the random sets are drawn from.
+    size : int
+        Number of loci of each random set.
+    samples : int
+        Number of random sets.
+    seed : int
+        Random generator seed.
+
+    Returns
+    -------
+    numpy array
+        Mean within-set 3D distance of each random set, NaN for sets without distances.
+    """
+    rng = np.random.default_rng(seed)
+    means = np.full(samples, np.nan)
+    for sample in range(samples):
+        positions = rng.choice(universe, size, replace=False)
+        block = np.asarray(matrix[np.ix_(positions, positions)], dtype=float)
+        # The diagonal is 0, each pair is counted twice
+        pairs = (np.isfinite(block).sum() - size) / 2
+        if pairs > 0:
+            means[sample] = np.nansum(block) / 2 / pairs
+
+    return means
+
+def get_loci_positions(sgdids, feature_name, genes_list):
+    """Get the positions of a genes list in the distance matrix.
+
+    Parameters
+    ----------
+    sgdids : Pandas index
+        Loci of the distance matrix (output of genomes.open_distance_matrix).
+    feature_name : Pandas dataframe
+        Primary_SGDID and Feature_name of the loci.
+    genes_list : list
+        Feature_name of the genes.
+
+    Returns
+    -------
+    numpy array
+        Sorted positions of the genes with 3D distances.
+    """
+    selected = feature_name.loc[feature_name["Feature_name"].isin(genes_list), "Primary_SGDID"]
+    positions = sgdids.get_indexer(selected)
+
+    return np.unique(positions[positions >= 0])
+
+def compare_lists(matrix, lists_positions, max_distance=200, resolution=0.1, progress=None):
+    """Summarize the 3D distances within and between several loci lists.
+
+    The k_i x k_j blocks are extracted from the distance matrix one pair of lists at a time
+    and summarized by a fine histogram: memory does not depend on the number of lists.
+
+    Parameters
+    ----------
+    matrix : (loci, loci) array
+        3D distances (output of genomes.open_distance_matrix).
+    lists_positions : dict
+        Positions of the loci of each list in the matrix.
+    max_distance : float
+        Upper bound of the histogram, larger distances are counted in the last bin.
+    resolution : float
+        Histogram bin width, the median is interpolated within a bin.
+    progress : callable, optional
+        Called with the fraction of the pairs of lists done.
+
+    Returns
+    -------
+    summary : Pandas dataframe
+        list_1, list_2, pairs, mean and median distances for each pair of lists (list_1 == list_2 for within-list distances).
+    histograms : numpy array
+        (pairs of lists, bins) distances counts, in the order of summary.
+    """
+    names = list(lists_positions)
+    bins_number = int(round(max_distance / resolution))
+    rows = []
+    histograms = []
+
+    for i, name_1 in enumerate(names):
+        positions_1 = lists_positions[name_1]
+
+        for name_2 in names[i:]:
+            positions_2 = lists_positions[name_2]
+            if name_1 == name_2:
+                values = get_within_distances(matrix, positions_1)
+            else:
+                values = matrix[np.ix_(positions_1, positions_2)]
+                # Loci in both lists are not paired with themselves
+                if np.intersect1d(positions_1, positions_2, assume_unique=True).size:
+                    values = values[positions_1[:, None] != positions_2[None, :]]
+                values = values.ravel()
+                if np.isnan(values).any():
+                    values = values[~np.isnan(values)]
+
+            bins = np.minimum((values * (1 / resolution)).astype(np.int64), bins_number - 1)
+            histogram = np.bincount(bins, minlength=bins_number)
+
+            median = np.nan
+            if len(values):
+                cumulative = np.cumsum(histogram)
+                median_bin = np.searchsorted(cumulative, len(values) / 2)
+                before = cumulative[median_bin] - histogram[median_bin]
+                median = (median_bin + (len(values) / 2 - before) / histogram[median_bin]) * resolution
+
+            rows.append({"list_1": name_1,
+                         "list_2": name_2,
+                         "pairs": len(values),
+                         "mean": float(values.sum(dtype=np.float64) / len(values)) if len(values) else np.nan,
+                         "median": median})
+            histograms.append(histogram)
+            if progress is not None:
+                progress(len(rows) / (len(names) * (len(names) + 1) / 2))
+
+    return pd.DataFrame(rows), np.array(histograms)
+
+def compare_distance_matrices(reference, reference_sgdids, computed, computed_sgdids, max_cells=2**22):
+    """Compare two 3D distance matrices, aligned on the positions of their loci.
+
+    The pairs i < j of the computed loci are read a block of rows at a time from both
+    matrices, and only running sums are kept: memory is bounded by max_cells, and the
+    matrices can be memory-mapped (e.g. the stores of two Parquet files).
+
+    Parameters
+    ----------
+    reference, computed : (loci, loci) arrays
+        3D distances, NaN for missing pairs (output of genomes.open_distance_matrix).
+    reference_sgdids, computed_sgdids : Pandas index
+        Loci of the matrices rows and columns.
+    max_cells : int
+        Maximum number of matrix cells read at a time, bounds memory.
+
+    Returns
+    -------
+    dict
+        Number of common and missing pairs, absolute differences and Pearson correlation of the common pairs.
+    """
+    # Position in the reference of each computed locus, -1 if missing
+    positions = reference_sgdids.get_indexer(computed_sgdids)
+    size = len(computed_sgdids)
+    common_pairs = missing_in_reference = reference_pairs = 0
+    max_difference = 0.0
+    # Sums of the common pairs: absolute differences, then x, y, x^2, y^2 and xy of the Pearson correlation
+    sums = np.zeros(6)
+
+    rows_number = max(1, max_cells // max(size, 1))
+    for start in range(0, size - 1, rows_number):
+        stop = min(start + rows_number, size - 1)
+        # Row k is the locus start + k, column l the locus start + 1 + l: pairs i < j for k <= l
+        upper = np.arange(stop - start)[:, None] <= np.arange(size - start - 1)[None, :]
+        computed_values = np.asarray(computed[start:stop, start + 1:size])[upper].astype(float)
+
+        rows, columns = positions[start:stop], positions[start + 1:size]
+        reference_block = np.full((stop - start, size - start - 1), np.nan)
+        found_rows, found_columns = np.flatnonzero(rows >= 0), np.flatnonzero(columns >= 0)
+        reference_block[np.ix_(found_rows, found_columns)] = reference[np.ix_(rows[found_rows], columns[found_columns])]
+        reference_values = reference_block[upper]
+
+        has_computed, has_reference = ~np.isnan(computed_values), ~np.isnan(reference_values)
+        both = has_computed & has_reference
+        x, y = reference_values[both], computed_values[both]
+        common_pairs += len(x)
+        missing_in_reference += int(np.sum(has_computed & ~has_reference))
+        reference_pairs += int(np.sum(has_reference))
+        if len(x):
+            max_difference = max(max_difference, float(np.abs(y - x).max()))
+            sums += [np.abs(y - x).sum(), x.sum(), y.sum(), (x * x).sum(), (y * y).sum(), (x * y).sum()]
+
+    # The reference pairs of the loci missing from the computed matrix, each pair once
+    missing = np.setdiff1d(np.arange(len(reference_sgdids)), positions[positions >= 0])
+    is_missing = np.zeros(len(reference_sgdids), dtype=bool)
+    is_missing[missing] = True
+    rows_number = max(1, max_cells // max(len(reference_sgdids), 1))
+    for start in range(0, len(missing), rows_number):
+        rows = missing[start:start + rows_number]
+        block = np.asarray(reference[rows])
+        kept = ~is_missing[None, :] | (np.arange(len(reference_sgdids))[None, :] > rows[:, None])
+        reference_pairs += int(np.sum(~np.isnan(block) & kept))
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        n = common_pairs
+        covariance = sums[5] - sums[1] * sums[2] / n
+        correlation = covariance / np.sqrt((sums[3] - sums[1] ** 2 / n) * (sums[4] - sums[2] ** 2 / n))
+
+    return {"common_pairs": common_pairs,
+            "missing_in_computed": reference_pairs - common_pairs,
+            "missing_in_reference": missing_in_reference,
+            "max_absolute_difference": max_difference if common_pairs else float("nan"),
+            "mean_absolute_difference": float(sums[0] / common_pairs) if common_pairs else float("nan"),
+            "pearson_correlation": float(correlation) if common_pairs > 1 else float("nan")}
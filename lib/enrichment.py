@@ -0,0 +1,102 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# Gene x GO slim term annotations of the SQLite database (input of build_membership_matrix)
+SQL_QUERY_GO = \
+"""SELECT Primary_SGDID, Feature_name, Chromosome, Strand, GO_slim_term
+FROM SGD_features, go_slim_mapping
+WHERE SGDID == Primary_SGDID
+"""
+
+def build_membership_matrix(go_mapping):
+    """Build the sparse gene x GO term membership matrix.
+
+    Parameters
+    ----------
+    go_mapping : Pandas dataframe
+        One row per gene annotation, with Primary_SGDID, Feature_name and GO_slim_term columns.
+
+    Returns
+    -------
+    dict
+        genes : Pandas index of the annotated genes (Primary_SGDID).
+        names : Feature_name of the genes.
+        terms : Pandas index of the GO terms.
+        matrix : (genes, terms) scipy.sparse.csr_matrix of 0/1 memberships.
+    """
+    go_mapping = go_mapping.drop_duplicates(subset=["Primary_SGDID", "GO_slim_term"])
+    gene_codes, genes = pd.factorize(go_mapping["Primary_SGDID"])
+    term_codes, terms = pd.factorize(go_mapping["GO_slim_term"])
+
+    matrix = sparse.csr_matrix((np.ones(len(go_mapping)), (gene_codes, term_codes)), shape=(len(genes), len(terms)))
+    names = go_mapping.drop_duplicates(subset=["Primary_SGDID"]).set_index("Primary_SGDID")["Feature_name"].reindex(genes)
+
+    return {"genes": pd.Index(genes),
+            "names": pd.Index(names),
+            "terms": pd.Index(terms),
+            "matrix": matrix}
+
+def benjamini_hochberg(p_values):
+    """Adjust p-values for multiple testing (false discovery rate).
+
+    Parameters
+    ----------
+    p_values : numpy array
+
+    Returns
+    -------
+    numpy array
+        Benjamini-Hochberg adjusted p-values.
+    """
+    p_values = np.asarray(p_values, dtype=float)
+    m = len(p_values)
+    order = np.argsort(p_values)
+    adjusted = p_values[order] * m / np.arange(1, m + 1)
+    # Monotonic from the largest p-value down
+    adjusted = np.minimum.accumulate(adjusted[::-1])[::-1]
+    result = np.empty(m)
+    result[order] = np.minimum(adjusted, 1)
+
+    return result
+
+def get_go_enrichment(membership, genes_list):
+    """Test the enrichment of a genes list in every GO term at once (hypergeometric test).
+
+    Parameters
+    ----------
+    membership : dict
+        Output of build_membership_matrix.
+    genes_list : list
+        Feature_name of the genes. Genes without GO annotation are ignored.
+
+    Returns
+    -------
+    Pandas dataframe
+        GO_slim_term, targets (list genes with the term), term_size, fold_enrichment,
+        p_value (one-sided, over-representation) and FDR, sorted by p-value.
+    """
+    selected = np.asarray(membership["names"].isin(genes_list), dtype=float)
+
+    universe_size = membership["matrix"].shape[0]
+    list_size = int(selected.sum())
+    term_sizes = np.asarray(membership["matrix"].sum(axis=0)).ravel()
+    # One sparse product counts the list genes of every term
+    targets = membership["matrix"].T @ selected
+
+    # P(X >= targets), scipy.stats is slow to import
+    from scipy.stats import hypergeom
+    p_values = hypergeom.sf(targets - 1, universe_size, term_sizes, list_size)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        fold_enrichment = (targets / list_size) / (term_sizes / universe_size)
+
+    enrichment = pd.DataFrame({"GO_slim_term": membership["terms"],
+                               "targets": targets.astype(int),
+                               "term_size": term_sizes.astype(int),
+                               "fold_enrichment": fold_enrichment,
+                               "p_value": p_values,
+                               "FDR": benjamini_hochberg(p_values)})
+    enrichment = enrichment.sort_values("p_value", kind="stable")
+    enrichment.index = range(1, len(enrichment) + 1)
+
+    return enrichment
@@ -0,0 +1,274 @@
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+import lib.distances as distances
+
+# Files of an ensemble directory: the loci of the matrices rows and columns, shared by the models,
+# and one subdirectory per model with its memory-mapped stores
+LOCI_FILE = "loci.csv"
+DISTANCES_FILE = "distances.npy"
+CENTROIDS_FILE = "centroids.npy"
+STATISTICS = ["mean", "variance", "sd", "min", "max"]
+STATISTIC_LABELS = {"mean": "Ensemble mean",
+                    "variance": "Ensemble variance",
+                    "sd": "Ensemble standard deviation (uncertainty)",
+                    "min": "Ensemble minimum",
+                    "max": "Ensemble maximum"}
+
+
+def write_ensemble_loci(directory, sgdids):
+    """Write the loci of the matrices rows and columns of an ensemble, in this order."""
+    os.makedirs(directory, exist_ok=True)
+    pd.DataFrame({"Primary_SGDID": pd.Index(sgdids)}).to_csv(os.path.join(directory, LOCI_FILE), index=False)
+
+def write_model(directory, geometry, sgdids, method="centroid", chunk_size=256):
+    """Write the stores of one 3D model of an ensemble: locus centroids and dense 3D distance matrix.
+
+    The matrix is written to a memory-mapped .npy file a block of rows at a time: memory
+    does not depend on the number of loci.
+
+    Parameters
+    ----------
+    directory : str
+        Model directory, created if missing.
+    geometry : dict
+        Loci geometry of the model (output of distances.get_locus_geometry).
+    sgdids : Pandas index
+        Loci of the ensemble (see write_ensemble_loci). Loci without 3D coordinates in
+        this model get NaN centroids and distances.
+    method : str
+        3D distance method, see distances.get_distance_block.
+    chunk_size : int
+        Number of rows computed at a time.
+    """
+    os.makedirs(directory, exist_ok=True)
+    sgdids = pd.Index(sgdids)
+    size = len(sgdids)
+    index = sgdids.get_indexer(geometry["sgdids"])
+    kept = np.flatnonzero(index >= 0)
+    index = index[kept]
+
+    centroids = np.full((size, 3), np.nan, dtype=np.float32)
+    centroids[index] = geometry["centroids"][kept]
+    np.save(os.path.join(directory, CENTROIDS_FILE), centroids)
+
+    matrix = np.lib.format.open_memmap(os.path.join(directory, DISTANCES_FILE), mode="w+", dtype=np.float32, shape=(size, size))
+    is_missing = np.ones(size, dtype=bool)
+    is_missing[index] = False
+    missing = np.flatnonzero(is_missing)
+    for start in range(0, len(missing), chunk_size):
+        matrix[missing[start:start + chunk_size]] = np.nan
+
+    loci = len(geometry["sgdids"])
+    for start in range(0, len(kept), chunk_size):
+        rows = kept[start:start + chunk_size]
+        # The kept loci are consecutive in the geometry but not in the ensemble
+        block = distances.get_distance_block(geometry, slice(rows[0], rows[-1] + 1), slice(0, loci), method)[rows - rows[0]][:, kept]
+        values = np.full((len(rows), size), np.nan, dtype=np.float32)
+        values[:, index] = block
+        matrix[index[start:start + chunk_size]] = values
+    matrix.flush()
+    del matrix
+
+def _read_block(matrix, rows, columns):
+    # Reading a block of a memory-mapped matrix only touches the pages of its rows
+    if isinstance(rows, slice) or isinstance(columns, slice):
+        return matrix[rows][:, columns]
+    return matrix[np.ix_(rows, columns)]
+
+def _get_statistics(count, total, squares, minimum, maximum, statistics):
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(count > 0, total / count, np.nan)
+        # Sample variance across the models, NaN with less than 2 models
+        variance = np.where(count > 1, np.maximum(squares - count * mean ** 2, 0) / (count - 1), np.nan)
+    values = {"mean": mean,
+              "variance": variance,
+              "sd": np.sqrt(variance),
+              "min": np.where(count > 0, minimum, np.nan),
+              "max": np.where(count > 0, maximum, np.nan)}
+    return {statistic: values[statistic].astype(np.float32) for statistic in statistics}
+
+
+class ModelEnsemble:
+    """Ensemble of 3D models of a genome, each with memory-mapped distances and centroids opened on first use.
+
+    The models share the loci of their matrices rows and columns. Their stores are .npy
+    files opened with mmap_mode="r": memory grows with the pages of the matrices that are
+    actually read (e.g. the rows of the genes of a list), not with the number of models.
+    The per-pair statistics across models are computed a block of pairs at a time.
+
+    Parameters
+    ----------
+    sgdids : Pandas index
+        Loci of the matrices rows and columns.
+    """
+
+    def __init__(self, sgdids):
+        self.sgdids = pd.Index(sgdids)
+        # name: model directory
+        self.models = {}
+        # name: memory-mapped (distances, centroids), opened on first use
+        self.stores = {}
+        # (bin_number, max_distance): density and CDF of each statistic over all the pairs
+        self.histograms = {}
+        self.lock = threading.Lock()
+        # One computation of the histograms at a time, concurrent requests wait for it
+        self.histograms_lock = threading.Lock()
+
+    @classmethod
+    def open(cls, directory):
+        """Open an ensemble directory (see write_ensemble_loci and write_model) and register its models, named after their subdirectory."""
+        ensemble = cls(pd.read_csv(os.path.join(directory, LOCI_FILE))["Primary_SGDID"].astype(str))
+        for name in sorted(os.listdir(directory)):
+            if os.path.exists(os.path.join(directory, name, DISTANCES_FILE)):
+                ensemble.register(name, os.path.join(directory, name))
+        return ensemble
+
+    def register(self, name, directory):
+        """Register a model directory, its stores are only opened when the model is first read."""
+        self.models[name] = directory
+
+    def __len__(self):
+        return len(self.models)
+
+    def _get_store(self, name):
+        with self.lock:
+            store = self.stores.get(name)
+            if store is None:
+                directory = self.models[name]
+                matrix = np.load(os.path.join(directory, DISTANCES_FILE), mmap_mode="r")
+                centroids = np.load(os.path.join(directory, CENTROIDS_FILE), mmap_mode="r")
+                if matrix.shape != (len(self.sgdids), len(self.sgdids)) or len(centroids) != len(self.sgdids):
+                    raise ValueError("Model {} does not have the {} loci of the ensemble".format(name, len(self.sgdids)))
+                store = self.stores[name] = (matrix, centroids)
+        return store
+
+    def get_distances(self, name):
+        """Memory-mapped (loci, loci) 3D distances of a model, NaN for the loci without coordinates."""
+        return self._get_store(name)[0]
+
+    def get_centroids(self, name):
+        """x, y, z centroids of a model indexed by Primary_SGDID (same columns as spatial.get_locus_centroids)."""
+        return pd.DataFrame(np.asarray(self._get_store(name)[1]), index=self.sgdids, columns=["x", "y", "z"])
+
+    def get_block_statistics(self, rows, columns, statistics=STATISTICS):
+        """Compute statistics of the 3D distances of a block of pairs across the models.
+
+        The block of each model is read in turn and accumulated (count, sum, sum of squares,
+        minimum and maximum): memory depends on the block size, not on the number of models.
+
+        Parameters
+        ----------
+        rows, columns : slice or numpy array
+            Positions of the loci in sgdids.
+        statistics : list
+            Among STATISTICS: mean, variance and sd (sample variance and standard deviation, NaN
+            for the pairs in less than 2 models), min and max.
+
+        Returns
+        -------
+        dict
+            statistic: (rows, columns) float32 array, NaN for the pairs without distance in any model.
+        """
+        count = total = squares = minimum = maximum = None
+        for name in self.models:
+            block = _read_block(self.get_distances(name), rows, columns).astype(float)
+            observed = ~np.isnan(block)
+            if count is None:
+                count = np.zeros(block.shape, dtype=np.int32)
+                total, squares = np.zeros(block.shape), np.zeros(block.shape)
+                minimum, maximum = np.full(block.shape, np.inf), np.full(block.shape, -np.inf)
+            count += observed
+            block[~observed] = 0
+            total += block
+            squares += block ** 2
+            block[~observed] = np.nan
+            np.fmin(minimum, block, out=minimum)
+            np.fmax(maximum, block, out=maximum)
+
+        if count is None:
+            shape = (len(np.arange(len(self.sgdids))[rows]), len(np.arange(len(self.sgdids))[columns]))
+            return {statistic: np.full(shape, np.nan, dtype=np.float32) for statistic in statistics}
+        return _get_statistics(count, total, squares, minimum, maximum, statistics)
+
+    def get_matrix(self, statistic, max_cells=2**22):
+        """(loci, loci) matrix of a statistic across the models, computed when its cells are read (see EnsembleMatrix)."""
+        if statistic not in STATISTICS:
+            raise ValueError("Unknown ensemble statistic: {} (expected one of {})".format(statistic, STATISTICS))
+        return EnsembleMatrix(self, statistic, max_cells)
+
+    def get_histogram(self, statistic, bin_number=50, max_distance=200, max_cells=2**22):
+        """Density and CDF of a statistic over all the pairs of loci, in bin_number bins of the [0, max_distance] range.
+
+        Computed at the first call, for all the statistics at once, a block of rows of the
+        upper triangle at a time, then cached.
+
+        Returns
+        -------
+        H2, F2 : numpy arrays
+            Same as the histogram of all the 3D distances of the dashboard.
+        """
+        key = (bin_number, max_distance)
+        with self.histograms_lock:
+            histograms = self.histograms.get(key)
+            if histograms is None:
+                histograms = self.histograms[key] = self._compute_histograms(bin_number, max_distance, max_cells)
+        return histograms[statistic]
+
+    def _compute_histograms(self, bin_number, max_distance, max_cells):
+        size = len(self.sgdids)
+        counts = {statistic: np.zeros(bin_number, dtype=np.int64) for statistic in STATISTICS}
+        pairs = dict.fromkeys(STATISTICS, 0)
+        rows_number = max(1, max_cells // max(size, 1))
+        for start in range(0, size - 1, rows_number):
+            stop = min(start + rows_number, size - 1)
+            # Row k is the locus start + k, column l the locus start + 1 + l: pairs i < j for k <= l
+            upper = np.arange(stop - start)[:, None] <= np.arange(size - start - 1)[None, :]
+            for statistic, values in self.get_block_statistics(slice(start, stop), slice(start + 1, size)).items():
+                values = values[upper]
+                values = values[~np.isnan(values)]
+                pairs[statistic] += len(values)
+                counts[statistic] += np.histogram(values, bins=bin_number, range=(0, max_distance))[0]
+
+        histograms = {}
+        for statistic, count in counts.items():
+            density = count / max(pairs[statistic], 1)
+            histograms[statistic] = (density, np.cumsum(density) / density.sum() if density.sum() else density)
+        return histograms
+
+
+class EnsembleMatrix:
+    """Read-only (loci, loci) matrix of a statistic across the models of an ensemble.
+
+    Stands for a distance matrix (e.g. in gene_lists.update_list_state): the cells are
+    computed by ModelEnsemble.get_block_statistics when they are read, max_cells at a time.
+    Indexes: a slice or an array of rows, a tuple of two of them, or the output of np.ix_.
+    """
+
+    def __init__(self, ensemble, statistic, max_cells=2**22):
+        self.ensemble = ensemble
+        self.statistic = statistic
+        self.max_cells = max_cells
+        self.shape = (len(ensemble.sgdids), len(ensemble.sgdids))
+        self.dtype = np.dtype(np.float32)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        rows, columns = key if isinstance(key, tuple) else (key, slice(None))
+        loci = np.arange(self.shape[0])
+        rows = loci[rows].ravel()
+        # Whole rows are read as slices, faster than fancy indexing
+        columns_number = len(loci[columns]) if isinstance(columns, slice) else np.size(columns)
+        columns = columns if isinstance(columns, slice) else loci[columns].ravel()
+
+        values = np.empty((len(rows), columns_number), dtype=np.float32)
+        rows_number = max(1, self.max_cells // max(columns_number, 1))
+        for start in range(0, len(rows), rows_number):
+            values[start:start + rows_number] = self.ensemble.get_block_statistics(rows[start:start + rows_number], columns,
+                                                                                   [self.statistic])[self.statistic]
+        return values
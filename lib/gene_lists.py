@@ -0,0 +1,279 @@
+import threading
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components, minimum_spanning_tree
+
+# get_list_pairs replaces the runs of a shared state by their merge
+_runs_lock = threading.Lock()
+
+
+def get_empty_list_state(bin_number=50, max_distance=200):
+    """Create the state of an empty genes list.
+
+    Parameters
+    ----------
+    bin_number : int
+        Number of bins of the 3D distances histogram.
+    max_distance : float
+        Upper bound of the histogram.
+
+    Returns
+    -------
+    dict
+        Output of update_list_state for a list without genes.
+    """
+    return {"positions": np.array([], dtype=np.int64),
+            "added_at": np.array([], dtype=np.int64),
+            "edit": 0,
+            "runs": [],
+            "degrees": np.array([], dtype=np.int64),
+            "forest": _get_empty_edges(),
+            "histogram": np.zeros(bin_number, dtype=np.int64),
+            "pairs": 0,
+            "max_distance": max_distance}
+
+def _get_empty_edges():
+    return np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([], dtype=np.float32)
+
+def _get_bin_counts(weights, bin_number, max_distance):
+    # Same bins as np.histogram(weights, bins=bin_number, range=(0, max_distance))
+    weights = weights[(weights >= 0) & (weights <= max_distance)]
+    bins = np.minimum((weights * (bin_number / max_distance)).astype(np.int64), bin_number - 1)
+
+    return np.bincount(bins, minlength=bin_number)
+
+def _get_pairs(matrix, rows, columns, upper=False):
+    # Source, target and 3D distance of the observed pairs of rows x columns (i < j among rows with upper)
+    block = matrix[np.ix_(rows, columns)]
+    if upper:
+        upper_1, upper_2 = np.triu_indices(len(rows), k=1)
+        source, target, weights = rows[upper_1], rows[upper_2], block[upper_1, upper_2]
+    else:
+        source, target, weights = np.repeat(rows, len(columns)), np.tile(columns, len(rows)), block.ravel()
+    observed = ~np.isnan(weights)
+
+    return source[observed], target[observed], weights[observed].astype(np.float32)
+
+def _get_spanning_forest(positions, source, target, weights):
+    # Minimum spanning forest of the genes (Kruskal's union-find in scipy), sorted by 3D distance.
+    # Zero distances would be missing edges of the sparse graph: they stand for the smallest float.
+    size = len(positions)
+    weights = np.where(weights > 0, weights.astype(float), np.finfo(float).tiny)
+    graph = sparse.coo_matrix((weights, (np.searchsorted(positions, source), np.searchsorted(positions, target))), shape=(size, size))
+    forest = minimum_spanning_tree(graph.tocsr()).tocoo()
+    order = np.argsort(forest.data, kind="stable")
+    weights = np.where(forest.data > np.finfo(float).tiny, forest.data, 0)[order].astype(np.float32)
+
+    return positions[forest.row[order]], positions[forest.col[order]], weights
+
+def _get_components(positions, source, target):
+    # Connected component of each gene
+    size = len(positions)
+    graph = sparse.coo_matrix((np.ones(len(source)), (np.searchsorted(positions, source), np.searchsorted(positions, target))), shape=(size, size))
+
+    return connected_components(graph, directed=False)[1]
+
+def _concatenate_edges(*edges):
+    return tuple(np.concatenate(column) for column in zip(*edges))
+
+def _is_alive(positions, added_at, ends, created):
+    # An edge is dropped with its genes: a gene removed then added again has new edges
+    if len(positions) == 0:
+        return np.zeros(len(ends), dtype=bool)
+    index = np.minimum(np.searchsorted(positions, ends), len(positions) - 1)
+    return (positions[index] == ends) & (created >= added_at[index])
+
+def _merge_runs(runs, positions, added_at):
+    # The runs are sorted by 3D distance: the stable sort merges them, ties in edit order
+    source, target, weights, created = _concatenate_edges(*runs)
+    alive = _is_alive(positions, added_at, source, created) & _is_alive(positions, added_at, target, created)
+    order = np.argsort(weights[alive], kind="stable")
+
+    return source[alive][order], target[alive][order], weights[alive][order], created[alive][order]
+
+def _join_fragments(forest, is_split_edge, runs, previous_positions, positions, added_at):
+    # The forest edges of the kept genes split the trees of the removed genes into fragments, joined
+    # again by the smallest 3D distances between fragments: at least the largest split edge. The
+    # sorted runs are read up to a threshold growing until the fragments of each tree are joined.
+    trees = _get_components(previous_positions, *forest[:2])
+    # Kept genes of the split trees
+    is_member = np.isin(trees, trees[np.searchsorted(previous_positions, forest[0][is_split_edge])]) & np.isin(previous_positions, positions)
+    members, member_trees = previous_positions[is_member], trees[is_member]
+    threshold = np.nextafter(forest[2][is_split_edge].max(), np.inf)
+    forest = tuple(column[~is_split_edge] for column in forest)
+    fragments = _get_components(previous_positions, *forest[:2])
+    largest_run = max(runs, key=lambda run: len(run[2]))[2]
+
+    while True:
+        source, target, weights, created = _concatenate_edges(*(tuple(column[:np.searchsorted(run[2], threshold)] for column in run)
+                                                                for run in runs))
+        alive = _is_alive(positions, added_at, source, created) & _is_alive(positions, added_at, target, created)
+        source, target, weights = source[alive], target[alive], weights[alive]
+        joining = fragments[np.searchsorted(previous_positions, source)] != fragments[np.searchsorted(previous_positions, target)]
+        joined = _get_spanning_forest(positions, *_concatenate_edges(forest, (source[joining], target[joining], weights[joining])))
+
+        # Joined when the kept genes of each tree have one component
+        components = _get_components(positions, *joined[:2])[np.searchsorted(positions, members)]
+        if np.isinf(threshold) or len(np.unique(member_trees * len(positions) + components)) == len(np.unique(member_trees)):
+            return joined
+        # At least twice more distances of the largest run
+        index = min(2 * np.searchsorted(largest_run, threshold), len(largest_run))
+        threshold = max(largest_run[index], threshold) if index < len(largest_run) else np.inf
+
+def update_list_state(state, matrix, positions):
+    """Update the 3D distances of a genes list after genes were added or removed.
+
+    Only the distances involving the added or removed genes are read, and the state is
+    updated with them: adding or removing m genes to a list of k genes costs O(m.k) instead
+    of extracting the k x k distances again.
+
+    - The new distances are sorted and appended as a run. Runs of similar sizes are merged
+      (amortized O(m.k.log) per edit) and the distances of removed genes are only dropped
+      when their run is merged, or when they are more than the kept ones.
+    - The histogram and the degrees are updated with the added and removed distances.
+    - The minimum spanning forest of the genes gives the connected components under any
+      3D distance threshold. Added genes merge it with their distances. The trees split by
+      removed genes are joined again by the smallest distances of the runs between their
+      fragments, read up to the threshold joining them (all the distances only when the
+      removed genes disconnect the list).
+
+    Parameters
+    ----------
+    state : dict
+        Previous state of the list (output of update_list_state or get_empty_list_state).
+    matrix : (loci, loci) array
+        3D distances (output of genomes.open_distance_matrix).
+    positions : numpy array
+        Positions of the genes of the edited list in the matrix.
+
+    Returns
+    -------
+    dict
+        positions : sorted positions of the genes.
+        added_at, edit : edit number when each gene was added, and of this edit.
+        runs : sorted runs of source, target, 3D distance and edit number of the pairs of
+               genes, read with get_list_pairs.
+        degrees : number of 3D distances of each gene.
+        forest : source, target and 3D distance of the minimum spanning forest edges, sorted
+                 by 3D distance.
+        histogram : counts of the 3D distances in bins of the [0, max_distance] range.
+        pairs : number of 3D distances, including the ones out of the histogram range.
+        max_distance : upper bound of the histogram.
+    """
+    positions = np.unique(positions)
+    removed = np.setdiff1d(state["positions"], positions, assume_unique=True)
+    added = np.setdiff1d(positions, state["positions"], assume_unique=True)
+    kept = np.intersect1d(state["positions"], positions, assume_unique=True)
+
+    edit = state["edit"] + 1
+    is_kept = np.isin(state["positions"], kept, assume_unique=True)
+    added_at = np.concatenate([state["added_at"][is_kept], np.full(len(added), edit, dtype=np.int64)])
+    degrees = np.concatenate([state["degrees"][is_kept], np.zeros(len(added), dtype=np.int64)])
+    order = np.argsort(np.concatenate([kept, added]), kind="stable")
+    added_at, degrees = added_at[order], degrees[order]
+
+    with _runs_lock:
+        runs = list(state["runs"])
+    forest = state["forest"]
+    histogram = state["histogram"].copy()
+    pairs = state["pairs"]
+    bin_number = len(histogram)
+
+    if len(removed):
+        # Distances of the removed genes with the kept genes, then between removed genes
+        source, target, weights = _concatenate_edges(_get_pairs(matrix, removed, kept), _get_pairs(matrix, removed, removed, upper=True))
+        histogram -= _get_bin_counts(weights, bin_number, state["max_distance"])
+        pairs -= len(weights)
+        degrees -= np.bincount(np.searchsorted(positions, target[np.isin(target, kept)]), minlength=len(positions))
+
+        # The forest edges of removed genes split their trees
+        is_split_edge = ~np.isin(forest[0], kept) | ~np.isin(forest[1], kept)
+        if is_split_edge.any():
+            forest = _join_fragments(forest, is_split_edge, runs, state["positions"], positions, added_at)
+
+    if len(added):
+        # Added genes with the kept genes, then pairs of added genes
+        source, target, weights = _concatenate_edges(_get_pairs(matrix, added, kept), _get_pairs(matrix, added, added, upper=True))
+        order = np.argsort(weights, kind="stable")
+        source, target, weights = source[order], target[order], weights[order]
+
+        histogram += _get_bin_counts(weights, bin_number, state["max_distance"])
+        pairs += len(weights)
+        degrees += np.bincount(np.searchsorted(positions, source), minlength=len(positions)) \
+                   + np.bincount(np.searchsorted(positions, target), minlength=len(positions))
+        forest = _get_spanning_forest(positions, *_concatenate_edges(forest, (source, target, weights)))
+        if len(weights):
+            runs.append((source, target, weights, np.full(len(weights), edit, dtype=np.int64)))
+
+    # Merge the last run while it is as large as the previous one
+    while len(runs) > 1 and len(runs[-2][2]) <= 2 * len(runs[-1][2]):
+        runs[-2:] = [_merge_runs(runs[-2:], positions, added_at)]
+    if sum(len(run[2]) for run in runs) > 2 * pairs:
+        runs = [_merge_runs(runs, positions, added_at)]
+
+    return {"positions": positions,
+            "added_at": added_at,
+            "edit": edit,
+            "runs": runs,
+            "degrees": degrees,
+            "forest": forest,
+            "histogram": histogram,
+            "pairs": pairs,
+            "max_distance": state["max_distance"]}
+
+def get_list_pairs(state):
+    """Get the 3D distances of the pairs of genes of a list, sorted by 3D distance.
+
+    The runs of the state are merged at the first call, and kept merged for the next ones.
+
+    Parameters
+    ----------
+    state : dict
+        Output of update_list_state.
+
+    Returns
+    -------
+    source, target, weights : numpy arrays
+        Positions and 3D distance of each pair of genes.
+    """
+    with _runs_lock:
+        runs = state["runs"]
+        if not runs:
+            return _get_empty_edges()
+        if len(runs) > 1 or len(runs[0][2]) > state["pairs"]:
+            runs = state["runs"] = [_merge_runs(runs, state["positions"], state["added_at"])]
+
+    return runs[0][:3]
+
+def get_threshold_summary(state):
+    """Summarize the edges of a genes list for client-side threshold filtering.
+
+    Edges are sorted by 3D distance so that the edges under a threshold are a prefix
+    of the sorted arrays. A gene is connected under a threshold when its smallest 3D
+    distance, an edge of the minimum spanning forest, is under it: the browser only needs
+    binary searches per slider move.
+
+    Parameters
+    ----------
+    state : dict
+        Output of update_list_state.
+
+    Returns
+    -------
+    dict
+        weights : sorted 3D distances.
+        source, target : node codes of each sorted edge.
+        first_weights : sorted smallest 3D distance of each gene with edges.
+    """
+    source, target, weights = get_list_pairs(state)
+    positions = state["positions"]
+    forest_source, forest_target, forest_weights = state["forest"]
+    first_weights = np.full(len(positions), np.inf, dtype=np.float32)
+    np.minimum.at(first_weights, np.searchsorted(positions, forest_source), forest_weights)
+    np.minimum.at(first_weights, np.searchsorted(positions, forest_target), forest_weights)
+
+    return {"weights": weights.tolist(),
+            "source": np.searchsorted(positions, source).tolist(),
+            "target": np.searchsorted(positions, target).tolist(),
+            "first_weights": np.sort(first_weights[np.isfinite(first_weights)]).tolist()}
@@ -0,0 +1,307 @@
+import collections
+import collections.abc
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+import numpy as np
+import pandas as pd
+
+import lib.distance_store as distance_store
+import lib.distances as distances
+import lib.metrics as metrics
+
+# Files of a genome bundle: a directory with the layout of static/
+DATABASE_FILE = "SCERE.db"
+SEGMENTS_FILE = "plotly_segments.csv"
+DISTANCES_FILE = "3D_distances.parquet.gzip"
+GO_TERMS_FILE = "GO_terms.csv"
+GO_COMPACTNESS_FILE = "GO_compactness.csv"
+DECAY_BINS_FILE = "distance_decay_bins.csv"
+CROWDING_FILE = "crowding_track.parquet"
+# Optional ensemble of 3D models (build_ensemble.py)
+MODELS_DIRECTORY = "models"
+# Optional description of the bundle (organism, chromosome_labels...)
+MANIFEST_FILE = "genome.json"
+# Distance stores of the genomes, shared by the dashboard and the CLIs (see open_distance_matrix)
+DISTANCES_CACHE = os.getenv("DISTANCES_CACHE") or os.path.join(tempfile.gettempdir(), "3D-Scere_distances")
+
+
+def get_size(value, mapped=False):
+    """Approximate the memory used by the data of a genome bundle.
+
+    Parameters
+    ----------
+    value : object
+        Numpy array, Pandas object, sparse matrix, k-d tree, or GenomeBundle, dict, list and tuple of them.
+        Only the computed items of a GenomeBundle are counted.
+    mapped : bool
+        Count the memory-mapped arrays (np.memmap, and the blocks of the distance matrix) instead
+        of the resident data. Their pages are read from their file on demand and can be evicted by
+        the system: they are not part of the memory budget of GenomeRegistry.
+
+    Returns
+    -------
+    int
+        Size in bytes.
+    """
+    if isinstance(value, GenomeBundle):
+        value = value.get_loaded()
+    if isinstance(value, dict):
+        return sum(get_size(item, mapped) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(get_size(item, mapped) for item in value)
+    if isinstance(value, (np.memmap, distance_store.BlockMatrix)):
+        return value.nbytes if mapped else 0
+    if mapped:
+        return 0
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(np.sum(value.memory_usage(deep=True)))
+    if isinstance(value, pd.Index):
+        return int(value.memory_usage(deep=True))
+
+    # Sparse matrices and k-d trees: their arrays
+    arrays = [getattr(value, name, None) for name in ("data", "indices", "indptr", "row", "col")]
+    return sum(array.nbytes for array in arrays if isinstance(array, np.ndarray)) or sys.getsizeof(value)
+
+def open_distance_matrix(distances_file, segments_file, feature_name, cache_directory=DISTANCES_CACHE, method="centroid",
+                         get_geometry=None, batch_size=2**20):
+    """Open the 3D distance matrix of a genome from a distance store written at the first call.
+
+    The store holds one memory-mapped file per pair of blocks of at most
+    distance_store.MAX_BLOCK_LOCI loci sorted by chromosome (see distance_store.BlockMatrix): a
+    list of genes only reads the blocks of its chromosomes. It is written from distances_file a
+    batch of pairs at a time, or from the loci geometry when the file is missing: the blocks
+    are then computed at their first read. The table of all the pairs is never in memory.
+    The store is named after its source (file, size, modification time, method and loci
+    chromosomes), a changed source is written again. The dashboard and the CLIs share it.
+
+    Parameters
+    ----------
+    distances_file : str
+        Parquet file of precomputed 3D distances (Primary_SGDID, Primary_SGDID_bis and 3D_distances columns),
+        may be missing or None.
+    segments_file : str
+        3D segments coordinates, used when distances_file is missing.
+    feature_name : Pandas dataframe
+        Primary_SGDID and Chromosome of the loci, the blocks of the matrix follow the chromosomes.
+    cache_directory : str
+        Directory of the stores, created if missing.
+    method : str
+        3D distance method when distances_file is missing, see distances.get_distance_block.
+    get_geometry : function, optional
+        get_geometry() returns the loci geometry (output of distances.get_locus_geometry), only
+        called when distances_file is missing. By default, the geometry of the loci of
+        feature_name is read from segments_file.
+    batch_size : int
+        Number of pairs of distances_file read at a time.
+
+    Returns
+    -------
+    sgdids : Pandas index
+        Loci of the matrix rows and columns.
+    matrix : distance_store.BlockMatrix
+        Read-only 3D distances, 0 on the diagonal and NaN for missing pairs.
+    """
+    source_file = distances_file if distances_file is not None and os.path.exists(distances_file) else segments_file
+    status = os.stat(source_file)
+    loci = feature_name.drop_duplicates(subset=["Primary_SGDID"]).set_index("Primary_SGDID")["Chromosome"]
+    source = {"file": os.path.abspath(source_file), "size": status.st_size, "mtime": status.st_mtime,
+              "method": None if source_file == distances_file else method,
+              "loci": int(pd.util.hash_pandas_object(loci.astype(str)).sum() % 2**63),
+              "max_block_loci": distance_store.MAX_BLOCK_LOCI}
+    store_directory = os.path.join(cache_directory, hashlib.sha1(json.dumps(source, sort_keys=True).encode()).hexdigest())
+
+    if not os.path.exists(os.path.join(store_directory, distance_store.LOCI_FILE)):
+        os.makedirs(cache_directory, exist_ok=True)
+        # Written then renamed: a concurrent process never opens a partial store
+        temporary = tempfile.mkdtemp(prefix=".tmp", dir=cache_directory)
+        try:
+            if source_file == distances_file:
+                distance_store.write_edges_store(temporary, distances_file, loci, batch_size=batch_size)
+            else:
+                if get_geometry is None:
+                    get_geometry = lambda: distances.get_locus_geometry(pd.read_csv(segments_file), loci.index)
+                distance_store.write_geometry_store(temporary, get_geometry(), loci, method=method)
+            try:
+                os.rename(temporary, store_directory)
+            except OSError:
+                # Written by a concurrent process in the meantime
+                if not os.path.exists(os.path.join(store_directory, distance_store.LOCI_FILE)):
+                    raise
+        finally:
+            shutil.rmtree(temporary, ignore_errors=True)
+
+    return distance_store.read_store_loci(store_directory), distance_store.BlockMatrix(store_directory)
+
+def read_manifest(directory, **defaults):
+    """Read the genome.json manifest of a bundle (organism, chromosome_labels...), its keys override defaults."""
+    manifest = os.path.join(directory, MANIFEST_FILE)
+    if not os.path.exists(manifest):
+        return defaults
+    with open(manifest) as manifest_file:
+        return {**defaults, **json.load(manifest_file)}
+
+
+class GenomeBundle(collections.abc.Mapping):
+    """Data of a genome bundle, with items computed when they are first read.
+
+    Items are set as values, or as loaders with set_loader: loader(bundle) computes the
+    item from the files or from other items of the bundle at its first read, then the
+    item is kept. A genome only pays for the data that is actually used (e.g. the API
+    of a genome without distances requests).
+    """
+
+    def __init__(self):
+        self.values = {}
+        # key: loader of the items not computed yet
+        self.loaders = {}
+        # One computation at a time, loaders read other items
+        self.lock = threading.RLock()
+
+    def __setitem__(self, key, value):
+        self.values[key] = value
+
+    def set_loader(self, key, loader):
+        self.loaders[key] = loader
+
+    def __getitem__(self, key):
+        if key in self.values:
+            return self.values[key]
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = self.loaders[key](self)
+            return self.values[key]
+
+    def __contains__(self, key):
+        return key in self.values or key in self.loaders
+
+    def __iter__(self):
+        return iter(list(self.values) + [key for key in self.loaders if key not in self.values])
+
+    def __len__(self):
+        return len(self.values.keys() | self.loaders.keys())
+
+    def get_loaded(self):
+        """Computed items."""
+        return dict(self.values)
+
+
+class GenomeRegistry:
+    """Genome bundles loaded on first use and kept in memory up to a size budget.
+
+    A bundle is a directory with the layout of static/ and an optional genome.json
+    manifest. Once loaded, a bundle stays in memory until the loaded bundles take
+    more than max_bytes: the least recently used ones are then unloaded, except the
+    pinned ones (e.g. the genome of the dashboard). The sizes are measured again at
+    each load, with the items of the GenomeBundle computed since, and only count the
+    resident data (see get_size).
+
+    Parameters
+    ----------
+    loader : function
+        loader(directory, metadata) returns the data of a bundle as a dict or a GenomeBundle.
+    max_bytes : int, optional
+        Memory budget of the loaded bundles, unbounded if None.
+    """
+
+    def __init__(self, loader, max_bytes=None):
+        self.loader = loader
+        self.max_bytes = max_bytes
+        # name: directory, metadata and pinned flag
+        self.genomes = {}
+        # name: data, least recently used first
+        self.loaded = collections.OrderedDict()
+        self.lock = threading.Lock()
+        # One load at a time per genome, concurrent requests wait for it
+        self.loading_locks = collections.defaultdict(threading.Lock)
+
+    def register(self, name, directory, **metadata):
+        """Register a bundle, the keys of its genome.json manifest override metadata."""
+        self.genomes[name] = {"directory": directory, "metadata": read_manifest(directory, **metadata), "pinned": False}
+
+    def discover(self, directory):
+        """Register the subdirectories of directory with a database, named after the subdirectory.
+
+        Returns
+        -------
+        list
+            Names of the registered genomes.
+        """
+        names = [name for name in sorted(os.listdir(directory))
+                 if os.path.exists(os.path.join(directory, name, DATABASE_FILE))]
+        for name in names:
+            self.register(name, os.path.join(directory, name))
+        return names
+
+    def pin(self, name):
+        """Never unload a genome."""
+        self.genomes[name]["pinned"] = True
+
+    def get_directory(self, name):
+        return self.genomes[name]["directory"]
+
+    def get(self, name):
+        """Get the data of a genome, loaded at the first call.
+
+        Raises
+        ------
+        KeyError
+            If the genome is not registered.
+        """
+        if name not in self.genomes:
+            raise KeyError(name)
+
+        with self.lock:
+            if name in self.loaded:
+                self.loaded.move_to_end(name)
+                metrics.record_cache("genomes", True)
+                return self.loaded[name]
+            loading_lock = self.loading_locks[name]
+
+        with loading_lock:
+            with self.lock:
+                # Loaded by a concurrent request in the meantime
+                if name in self.loaded:
+                    self.loaded.move_to_end(name)
+                    return self.loaded[name]
+            metrics.record_cache("genomes", False)
+            genome = self.genomes[name]
+            data = self.loader(genome["directory"], genome["metadata"])
+
+            with self.lock:
+                self.loaded[name] = data
+                self._unload(keep=name)
+        return data
+
+    def _unload(self, keep):
+        # Least recently used first, the genome just loaded is kept even above the budget
+        if self.max_bytes is None:
+            return
+        sizes = {name: get_size(data) for name, data in self.loaded.items()}
+        total = sum(sizes.values())
+        for name in list(self.loaded):
+            if total <= self.max_bytes:
+                break
+            if name != keep and not self.genomes[name]["pinned"]:
+                del self.loaded[name]
+                total -= sizes[name]
+
+    def get_info(self):
+        """Registered genomes: name, metadata, loaded flag, resident and memory-mapped sizes of the loaded ones."""
+        with self.lock:
+            loaded = dict(self.loaded)
+        sizes = {name: (get_size(data), get_size(data, mapped=True)) for name, data in loaded.items()}
+        return [{"name": name,
+                 **{key: value for key, value in genome["metadata"].items() if key != "chromosome_labels"},
+                 "pinned": genome["pinned"],
+                 "loaded": name in sizes,
+                 "bytes": sizes[name][0] if name in sizes else None,
+                 "mapped_bytes": sizes[name][1] if name in sizes else None}
+                for name, genome in sorted(self.genomes.items())]
@@ -0,0 +1,167 @@
+import collections
+import gzip
+import hashlib
+import importlib.util
+import os
+import threading
+
+import flask
+from flask_compress import Compress
+
+# Encodings of the compressed responses, by preference (brotli is optional)
+ALGORITHMS = ["br", "gzip"] if importlib.util.find_spec("brotli") else ["gzip"]
+# Compressed response types: pages, assets, callbacks and API responses (Arrow and Parquet are binary, Parquet is already compressed)
+MIMETYPES = ["text/html", "text/css", "text/plain", "text/javascript", "application/javascript", "application/json",
+             "image/svg+xml", "application/x-ndjson", "text/csv"]
+# Compression levels of the responses compressed once and cached (make_cached_response)
+CACHED_LEVELS = {"br": 9, "gzip": 6}
+COMPRESSED_CACHE_SIZE = 16
+# Version query parameters of the static files: m (Dash assets) and v (get_versioned_url)
+VERSION_PARAMETERS = ("m", "v")
+
+# Compressed bodies by (ETag, encoding), least recently used are dropped
+_compressed = collections.OrderedDict()
+_compressed_lock = threading.Lock()
+
+
+def get_etag(data):
+    """Strong ETag of a response body (SHA-1 of the bytes, as werkzeug)."""
+    return hashlib.sha1(data).hexdigest()
+
+def get_versioned_url(path):
+    """Add the modification time of a static file to its URL, the URL then changes with the file and can be cached forever.
+
+    Parameters
+    ----------
+    path : str
+        Path of the file relative to the server directory, also its relative URL (e.g. ./static/yeast_icon.png).
+    """
+    return "{}?v={}".format(path, int(os.path.getmtime(path))) if os.path.exists(path) else path
+
+def _get_matching_etag(etag):
+    # ETag of the browser copy if it is etag, Compress appends the encoding to the strong ETags of the responses it compresses ("etag:gzip")
+    if_none_match = flask.request.if_none_match
+    if if_none_match.star_tag:
+        return etag
+    return next((tag for tag in if_none_match.as_set() if tag == etag or tag.startswith(etag + ":")), None)
+
+def _not_modified(etag):
+    response = flask.Response(status=304)
+    response.set_etag(etag)
+    response.vary.add("Accept-Encoding")
+    response.cache_control.no_cache = True
+    return response
+
+def _choose_algorithm():
+    for algorithm in ALGORITHMS:
+        if flask.request.accept_encodings[algorithm]:
+            return algorithm
+    return None
+
+def _compress(data, algorithm):
+    if algorithm == "br":
+        import brotli
+        return brotli.compress(data, quality=CACHED_LEVELS["br"])
+    return gzip.compress(data, compresslevel=CACHED_LEVELS["gzip"])
+
+def make_cached_response(data, mimetype="application/json"):
+    """Response of a deterministic body: strong ETag, revalidated by the browsers, compressed once per encoding.
+
+    Parameters
+    ----------
+    data : bytes
+        Response body, the same bytes for the same content.
+    mimetype : str
+
+    Returns
+    -------
+    flask.Response
+        304 when the browser has the body (If-None-Match), else the body compressed
+        with the best encoding accepted by the browser.
+    """
+    etag = get_etag(data)
+    matching_etag = _get_matching_etag(etag)
+    if matching_etag is not None:
+        return _not_modified(matching_etag)
+
+    algorithm = _choose_algorithm()
+    if algorithm is None or len(data) < flask.current_app.config["COMPRESS_MIN_SIZE"]:
+        response = flask.Response(data, mimetype=mimetype)
+        response.set_etag(etag)
+    else:
+        with _compressed_lock:
+            body = _compressed.get((etag, algorithm))
+            if body is not None:
+                _compressed.move_to_end((etag, algorithm))
+        if body is None:
+            body = _compress(data, algorithm)
+            with _compressed_lock:
+                _compressed[(etag, algorithm)] = body
+                while len(_compressed) > COMPRESSED_CACHE_SIZE:
+                    _compressed.popitem(last=False)
+        # Compress leaves the responses with a Content-Encoding as they are
+        response = flask.Response(body, mimetype=mimetype, headers={"Content-Encoding": algorithm})
+        response.set_etag("{}:{}".format(etag, algorithm))
+
+    response.vary.add("Accept-Encoding")
+    response.cache_control.no_cache = True
+    return response
+
+def instrument_server(server, min_size=500, brotli_level=4, static_max_age=31536000):
+    """Compress the responses of a Flask server and set their cache headers.
+
+    - Responses of the MIMETYPES types (JSON, HTML, CSS, JavaScript, CSV...) larger than
+      min_size bytes are compressed with brotli (if installed) or gzip, as accepted by
+      the browser. Create the Dash app with compress=False: Dash only enables gzip.
+    - Versioned static files (?m= of the Dash assets, ?v= of get_versioned_url) are
+      cached by the browsers for static_max_age seconds, without revalidation. The
+      responses with a max-age set by their route (e.g. the fingerprinted Dash bundles
+      of /_dash-component-suites/) are cached without revalidation too.
+    - The other GET responses in memory (page, layout, callbacks list, API JSON) get a
+      strong ETag: the browsers revalidate them and get a 304 when they did not change.
+
+    Parameters
+    ----------
+    server : Flask
+        Server, e.g. app.server of a Dash app.
+    min_size : int
+        Smaller responses are not compressed.
+    brotli_level : int
+        Brotli quality of the responses compressed at each request (0 to 11).
+    static_max_age : int
+        Browser cache duration of the versioned static files, in seconds.
+    """
+    server.config.update(COMPRESS_ALGORITHM=ALGORITHMS,
+                         COMPRESS_MIMETYPES=MIMETYPES,
+                         COMPRESS_MIN_SIZE=min_size,
+                         COMPRESS_BR_LEVEL=brotli_level)
+    Compress(server)
+
+    # Registered after Compress: runs before it on the uncompressed response
+    @server.after_request
+    def set_cache_headers(response):
+        if flask.request.method not in ("GET", "HEAD") or response.status_code != 200:
+            return response
+
+        # Long-cached responses, without ETag: their URL changes with their content
+        static_paths = (server.static_url_path + "/", "/assets/")
+        versioned = flask.request.path.startswith(static_paths) and any(name in flask.request.args for name in VERSION_PARAMETERS)
+        # Fingerprinted Dash bundles (/_dash-component-suites/), and any response already given a max-age by its route
+        long_cached = response.cache_control.max_age is not None
+        if versioned or long_cached:
+            response.cache_control.public = True
+            if versioned:
+                response.cache_control.max_age = static_max_age
+            response.cache_control.immutable = True
+            response.cache_control.no_cache = None
+            return response
+
+        if response.is_streamed or response.get_etag()[0] is not None:
+            return response
+        etag = get_etag(response.get_data())
+        matching_etag = _get_matching_etag(etag)
+        if matching_etag is not None:
+            return _not_modified(matching_etag)
+        response.set_etag(etag)
+        response.cache_control.no_cache = True
+        return response
@@ -0,0 +1,178 @@
+import io
+
+import numpy as np
+import pandas as pd
+
+ROMAN_NUMERALS = ["I", "II", "III", "IV", "V", "VI", "VII", "VIII",
+                  "IX", "X", "XI", "XII", "XIII", "XIV", "XV", "XVI"]
+
+# Chromosome names used in BED files, mapped to the SGD_features chromosome numbers (17 = mitochondrial)
+CHROMOSOME_ALIASES = {**{name: number for number, name in enumerate(ROMAN_NUMERALS, start=1)},
+                      **{str(number): number for number in range(1, 18)},
+                      "M": 17, "MT": 17, "MITO": 17, "MITOCHONDRION": 17, "MITOCHONDRIAL": 17}
+
+
+def get_chromosome_number(names):
+    """Convert BED chromosome names (chrIV, chr4, IV, 4, chrM...) to chromosome numbers.
+
+    Parameters
+    ----------
+    names : Pandas series
+
+    Returns
+    -------
+    Pandas series
+        Chromosome numbers, 0 for unknown chromosomes.
+    """
+    # Few distinct names: convert the categories only
+    names = names.astype(str).astype("category")
+    categories = names.cat.categories.str.upper().str.replace(r"^CHR(OMOSOME)?[_ ]?", "", regex=True)
+    numbers = np.append(categories.map(CHROMOSOME_ALIASES).fillna(0).to_numpy(dtype=int), 0)
+
+    return pd.Series(numbers[names.cat.codes.to_numpy()], index=names.index)
+
+def read_bed(text):
+    """Read BED intervals.
+
+    Parameters
+    ----------
+    text : str
+        BED file content (tab separated). Header lines (track, browser, #) are ignored.
+        Only the chrom, chromStart, chromEnd and, if present, score columns are used.
+
+    Returns
+    -------
+    Pandas dataframe
+        Chromosome (number), Start and End (0-based, half-open as in BED) and Score columns.
+    """
+    # Header lines are at the beginning of the file
+    header_number = 0
+    line = ""
+    for line in io.StringIO(text):
+        if line.strip() and not line.startswith(("#", "track", "browser")):
+            break
+        header_number += 1
+    columns = [0, 1, 2, 4] if len(line.split("\t")) > 4 else [0, 1, 2]
+
+    bed = pd.read_csv(io.StringIO(text), sep="\t", header=None, skiprows=header_number, usecols=columns,
+                      comment="#", skip_blank_lines=True, dtype={0: str, 1: np.int64, 2: np.int64})
+
+    intervals = pd.DataFrame({"Chromosome": get_chromosome_number(bed[0]),
+                              "Start": bed[1].astype(np.int64),
+                              "End": bed[2].astype(np.int64)})
+    if 4 in bed.columns:
+        intervals["Score"] = pd.to_numeric(bed[4], errors="coerce")
+
+    return intervals
+
+def build_interval_index(feature_name):
+    """Build a per-chromosome sorted index of the loci coordinates.
+
+    Parameters
+    ----------
+    feature_name : Pandas dataframe
+        Loci with Chromosome, Start_coordinate and Stop_coordinate columns
+        (1-based, Start_coordinate > Stop_coordinate on the C strand).
+
+    Returns
+    -------
+    dict
+        For each chromosome number: starts and stops (sorted by starts) of the loci,
+        rows (positions in feature_name) and max_length (longest locus).
+    """
+    start = feature_name["Start_coordinate"].to_numpy(dtype=np.int64)
+    stop = feature_name["Stop_coordinate"].to_numpy(dtype=np.int64)
+    low = np.minimum(start, stop)
+    high = np.maximum(start, stop)
+    chromosome = feature_name["Chromosome"].to_numpy(dtype=int)
+
+    interval_index = {}
+    for chromosome_id in np.unique(chromosome):
+        rows = np.flatnonzero(chromosome == chromosome_id)
+        rows = rows[np.argsort(low[rows], kind="stable")]
+        interval_index[chromosome_id] = {"starts": low[rows],
+                                         "stops": high[rows],
+                                         "rows": rows,
+                                         "max_length": int((high[rows] - low[rows]).max())}
+
+    return interval_index
+
+def get_overlapping_loci(interval_index, intervals):
+    """Find the loci overlapping each interval.
+
+    For each chromosome, the candidate loci of all the intervals are found with two
+    searchsorted calls: loci starting after the interval end cannot overlap, neither can
+    loci starting more than max_length before the interval start.
+
+    Parameters
+    ----------
+    interval_index : dict
+        Output of build_interval_index.
+    intervals : Pandas dataframe
+        Chromosome, Start and End columns (BED coordinates, output of read_bed).
+
+    Returns
+    -------
+    Pandas dataframe
+        interval (position in intervals) and locus (position in the indexed feature_name) of each overlap.
+    """
+    chromosome = intervals["Chromosome"].to_numpy(dtype=int)
+    # BED [Start, End) to 1-based closed coordinates
+    query_start = intervals["Start"].to_numpy(dtype=np.int64) + 1
+    query_end = intervals["End"].to_numpy(dtype=np.int64)
+
+    overlaps_interval = []
+    overlaps_locus = []
+    for chromosome_id, index in interval_index.items():
+        queries = np.flatnonzero(chromosome == chromosome_id)
+        if len(queries) == 0:
+            continue
+
+        first = np.searchsorted(index["starts"], query_start[queries] - index["max_length"], side="left")
+        last = np.searchsorted(index["starts"], query_end[queries], side="right")
+        candidates_number = np.maximum(last - first, 0)
+
+        # Expand the [first, last) candidate ranges
+        query_of_candidate = np.repeat(queries, candidates_number)
+        range_start = np.cumsum(candidates_number) - candidates_number
+        candidate = np.arange(candidates_number.sum()) - np.repeat(range_start - first, candidates_number)
+
+        overlap = index["stops"][candidate] >= query_start[query_of_candidate]
+        overlaps_interval.append(query_of_candidate[overlap])
+        overlaps_locus.append(index["rows"][candidate[overlap]])
+
+    if not overlaps_interval:
+        return pd.DataFrame({"interval": np.array([], dtype=int), "locus": np.array([], dtype=int)})
+
+    return pd.DataFrame({"interval": np.concatenate(overlaps_interval),
+                         "locus": np.concatenate(overlaps_locus)})
+
+def get_bed_loci(intervals, feature_name, interval_index):
+    """Get the loci overlapping BED intervals, as a genes list.
+
+    Parameters
+    ----------
+    intervals : Pandas dataframe
+        Output of read_bed.
+    feature_name : Pandas dataframe
+        Loci used to build interval_index (with a Feature_name column).
+    interval_index : dict
+        Output of build_interval_index.
+
+    Returns
+    -------
+    Pandas dataframe
+        YORF (Feature_name of the overlapping loci), number of overlapping intervals
+        and, if the BED file has scores, the max score of the overlapping intervals.
+    """
+    overlaps = get_overlapping_loci(interval_index, intervals)
+    overlaps["YORF"] = feature_name["Feature_name"].to_numpy()[overlaps["locus"].to_numpy()]
+
+    aggregations = {"intervals": ("interval", "size")}
+    if "Score" in intervals.columns:
+        overlaps["Score"] = intervals["Score"].to_numpy()[overlaps["interval"].to_numpy()]
+        aggregations["score"] = ("Score", "max")
+
+    loci = overlaps.groupby("YORF", sort=False).agg(**aggregations).reset_index()
+
+    return loci
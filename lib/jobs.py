@@ -0,0 +1,305 @@
+import atexit
+import collections
+import contextlib
+import mmap
+import multiprocessing
+import os
+import pickle
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+# Arrays memory-mapped and data loaded by the worker processes
+_shared_arrays = {}
+_shared_data = {}
+# Barrier of the no-op jobs starting the worker processes, inherited when they are forked
+_start_barrier = None
+
+SharedArray = collections.namedtuple("SharedArray", ["name"])
+SharedArray.__doc__ = "Placeholder for a job argument, replaced by the shared array of that name in the worker process."
+
+SharedData = collections.namedtuple("SharedData", ["name"])
+SharedData.__doc__ = "Placeholder for a job argument, replaced by the shared data (e.g. a dataframe) of that name in the worker process."
+
+
+class JobCancelled(Exception):
+    """Raised in a job when it was cancelled."""
+
+
+class JobQueueFull(Exception):
+    """Raised when too many jobs are queued or running."""
+
+
+@contextlib.contextmanager
+def _connect(database):
+    # One short transaction per operation: the job store is shared by threads and processes
+    connection = sqlite3.connect(database, timeout=30)
+    connection.row_factory = sqlite3.Row
+    try:
+        with connection:
+            yield connection
+    finally:
+        connection.close()
+
+def _get_shared_array(directory, name):
+    # Memory-mapped at first use: the worker processes share the pages of the arrays
+    if name not in _shared_arrays:
+        _shared_arrays[name] = np.load(os.path.join(directory, name + ".npy"), mmap_mode="r")
+    return _shared_arrays[name]
+
+def _is_mapped_file(array):
+    # The array of a memory-mapped .npy file, its views have another memmap as base
+    return isinstance(array, np.memmap) and isinstance(array.base, mmap.mmap) and str(array.filename).endswith(".npy")
+
+def _get_shared_data(directory, name):
+    # Loaded at first use, then kept by the worker process
+    if name not in _shared_data:
+        with open(os.path.join(directory, name + ".data.pickle"), "rb") as data_file:
+            _shared_data[name] = pickle.load(data_file)
+    return _shared_data[name]
+
+def _get_argument(directory, arg):
+    if isinstance(arg, SharedArray):
+        return _get_shared_array(directory, arg.name)
+    if isinstance(arg, SharedData):
+        return _get_shared_data(directory, arg.name)
+    return arg
+
+def _wait_started():
+    # Blocks its worker process until every worker runs one: each one is started by its own job
+    _start_barrier.wait(timeout=60)
+
+def _run_job(database, directory, shared_directory, job_id, function, args, kwargs):
+    with _connect(database) as connection:
+        started = connection.execute("UPDATE jobs SET status = 'running', updated = ? WHERE id = ? AND status = 'queued'",
+                                     (time.time(), job_id)).rowcount
+    if not started:
+        return
+
+    last_update = [0.0]
+
+    def progress(fraction):
+        # Throttled: at most a few writes per second, each one also checks for cancellation
+        now = time.time()
+        if now - last_update[0] < 0.2 and fraction < 1:
+            return
+        last_update[0] = now
+        with _connect(database) as connection:
+            connection.execute("UPDATE jobs SET progress = ?, updated = ? WHERE id = ? AND status = 'running'",
+                               (float(fraction), now, job_id))
+            status = connection.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()["status"]
+        if status == "cancelled":
+            raise JobCancelled(job_id)
+
+    args = [_get_argument(shared_directory, arg) for arg in args]
+    kwargs = {key: _get_argument(shared_directory, arg) for key, arg in kwargs.items()}
+    try:
+        result = function(*args, progress=progress, **kwargs)
+        with open(os.path.join(directory, job_id + ".pickle"), "wb") as result_file:
+            pickle.dump(result, result_file, protocol=pickle.HIGHEST_PROTOCOL)
+        status, error = "done", None
+    except JobCancelled:
+        status, error = "cancelled", None
+    except Exception as exception:
+        status, error = "error", "{}: {}".format(type(exception).__name__, exception)
+
+    with _connect(database) as connection:
+        connection.execute("UPDATE jobs SET status = ?, progress = CASE WHEN ? = 'done' THEN 1 ELSE progress END, error = ?, updated = ? "
+                           "WHERE id = ? AND status = 'running'", (status, status, error, time.time(), job_id))
+
+
+class JobExecutor:
+    """Run long computations in a local process pool, with a SQLite job store.
+
+    The executor must be created before the server starts its threads.
+
+    Jobs are functions accepting a progress keyword argument: progress(fraction) records
+    the progress of the job and raises JobCancelled when the job was cancelled.
+    A new job of an owner (e.g. a user table) cancels its previous unfinished jobs.
+
+    The job store and the job results can be shared by several server processes (e.g. gunicorn
+    workers), each one saves its shared arrays and data in its own subdirectory (shared_<pid>_...).
+
+    Parameters
+    ----------
+    directory : str
+        Directory of the job store, the shared arrays and the job results.
+    shared_arrays : dict
+        Numpy arrays saved once and memory-mapped by the worker processes,
+        passed to the jobs as SharedArray(name) arguments (see also share_array
+        and share_data).
+    processes : int
+        Number of worker processes.
+    max_pending : int
+        Maximum number of queued and running jobs, new jobs are refused above.
+    max_age : float
+        Finished jobs and their results are deleted after max_age seconds.
+    """
+
+    def __init__(self, directory, shared_arrays=None, processes=2, max_pending=8, max_age=3600):
+        self.directory = directory
+        self.database = os.path.join(directory, "jobs.db")
+        self.processes = processes
+        self.max_pending = max_pending
+        self.max_age = max_age
+        self.futures = {}
+        self.lock = threading.Lock()
+        self.array_paths = {}
+
+        os.makedirs(directory, exist_ok=True)
+        self.shared_directory = tempfile.mkdtemp(prefix="shared_{}_".format(os.getpid()), dir=directory)
+        for name, array in (shared_arrays or {}).items():
+            self.share_array(name, array)
+
+        with _connect(self.database) as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, owner TEXT, status TEXT, progress REAL, "
+                               "error TEXT, created REAL, updated REAL)")
+
+        self.pool = self._start_pool()
+        atexit.register(self.close)
+
+    def _start_pool(self):
+        # Every worker is forked now, while the server has no threads yet (spawned workers would import the app again):
+        # the pool only starts a worker process when a job finds none idle, the start jobs wait for each other
+        global _start_barrier
+        context = multiprocessing.get_context("fork")
+        _start_barrier = context.Barrier(self.processes)
+        pool = ProcessPoolExecutor(self.processes, mp_context=context)
+        for future in [pool.submit(_wait_started) for _ in range(self.processes)]:
+            future.result()
+        return pool
+
+    def restart(self):
+        """Replace a broken pool (a worker process died), its unfinished jobs are recorded as errors."""
+        with self.lock:
+            if self.pool._broken:
+                self.pool.shutdown(wait=False)
+                self.pool = self._start_pool()
+
+    def close(self):
+        """Stop the worker processes and delete the shared arrays and data files of this process."""
+        for future in list(self.futures.values()):
+            future.cancel()
+        self.pool.shutdown(wait=False)
+        for path in self.array_paths.values():
+            if os.path.lexists(path):
+                os.remove(path)
+        with contextlib.suppress(OSError):
+            os.rmdir(self.shared_directory)
+
+    def share_array(self, name, array):
+        """Save an array for the jobs (SharedArray(name) arguments), also after the worker processes started.
+
+        An array memory-mapped from a whole .npy file (np.load with mmap_mode) is linked instead of copied.
+        """
+        path = os.path.join(self.shared_directory, name + ".npy")
+        # Written then renamed: a worker never maps a partial file
+        if _is_mapped_file(array):
+            if os.path.lexists(path + ".tmp"):
+                os.remove(path + ".tmp")
+            os.symlink(os.path.abspath(array.filename), path + ".tmp")
+        else:
+            with open(path + ".tmp", "wb") as array_file:
+                np.save(array_file, array)
+        os.replace(path + ".tmp", path)
+        self.array_paths[name] = path
+
+    def share_data(self, name, value):
+        """Save picklable data for the jobs (SharedData(name) arguments), loaded once by each worker process."""
+        path = os.path.join(self.shared_directory, name + ".data.pickle")
+        with open(path + ".tmp", "wb") as data_file:
+            pickle.dump(value, data_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + ".tmp", path)
+        self.array_paths[name] = path
+
+    def submit(self, owner, function, *args, **kwargs):
+        """Queue a job, after cancelling the unfinished jobs of the same owner.
+
+        Returns
+        -------
+        str
+            Job identifier.
+
+        Raises
+        ------
+        JobQueueFull
+            When max_pending jobs are already queued or running.
+        BrokenProcessPool
+            When a worker process died, the job is recorded as an error (see restart).
+        """
+        job_id = uuid.uuid4().hex
+        with self.lock:
+            for previous_id in self._get_unfinished(owner):
+                self.cancel(previous_id)
+            self._purge()
+
+            with _connect(self.database) as connection:
+                pending = connection.execute("SELECT count(*) FROM jobs WHERE status IN ('queued', 'running')").fetchone()[0]
+                if pending >= self.max_pending:
+                    raise JobQueueFull("{} jobs are queued or running".format(pending))
+                connection.execute("INSERT INTO jobs VALUES (?, ?, 'queued', 0, NULL, ?, ?)", (job_id, owner, time.time(), time.time()))
+
+            try:
+                self.futures[job_id] = self.pool.submit(_run_job, self.database, self.directory, self.shared_directory,
+                                                        job_id, function, args, kwargs)
+            except BrokenProcessPool as exception:
+                with _connect(self.database) as connection:
+                    connection.execute("UPDATE jobs SET status = 'error', error = ?, updated = ? WHERE id = ?",
+                                       ("{}: {}".format(type(exception).__name__, exception), time.time(), job_id))
+                raise
+            self.futures[job_id].add_done_callback(lambda future, job_id=job_id: self._forget(job_id, future))
+
+        return job_id
+
+    def cancel(self, job_id):
+        """Cancel a job: queued jobs never start, running jobs stop at their next progress call."""
+        with _connect(self.database) as connection:
+            connection.execute("UPDATE jobs SET status = 'cancelled', updated = ? WHERE id = ? AND status IN ('queued', 'running')",
+                               (time.time(), job_id))
+        future = self.futures.get(job_id)
+        if future is not None:
+            future.cancel()
+
+    def get_job(self, job_id):
+        """Get the status (queued, running, done, cancelled or error), progress and error of a job, None if unknown."""
+        with _connect(self.database) as connection:
+            row = connection.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def get_result(self, job_id):
+        """Get the result of a done job, None if not available."""
+        path = os.path.join(self.directory, job_id + ".pickle")
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as result_file:
+            return pickle.load(result_file)
+
+    def _get_unfinished(self, owner):
+        with _connect(self.database) as connection:
+            rows = connection.execute("SELECT id FROM jobs WHERE owner = ? AND status IN ('queued', 'running')", (owner,)).fetchall()
+        return [row["id"] for row in rows]
+
+    def _forget(self, job_id, future):
+        self.futures.pop(job_id, None)
+        if not future.cancelled() and future.exception() is not None:
+            # The worker process died before recording the job status
+            with _connect(self.database) as connection:
+                connection.execute("UPDATE jobs SET status = 'error', error = ?, updated = ? WHERE id = ? AND status IN ('queued', 'running')",
+                                   ("{}: {}".format(type(future.exception()).__name__, future.exception()), time.time(), job_id))
+
+    def _purge(self):
+        with _connect(self.database) as connection:
+            rows = connection.execute("SELECT id FROM jobs WHERE status IN ('done', 'cancelled', 'error') AND updated < ?",
+                                      (time.time() - self.max_age,)).fetchall()
+            for row in rows:
+                path = os.path.join(self.directory, row["id"] + ".pickle")
+                if os.path.exists(path):
+                    os.remove(path)
+            connection.executemany("DELETE FROM jobs WHERE id = ?", [(row["id"],) for row in rows])
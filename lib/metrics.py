@@ -0,0 +1,204 @@
+import bisect
+import collections
+import contextlib
+import functools
+import threading
+import time
+
+from dash.exceptions import PreventUpdate
+
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = (1e3, 4e3, 1.6e4, 6.4e4, 2.56e5, 1e6, 4e6, 1.6e7, 6.4e7)
+
+# Registered metrics, in registration order
+_metrics = []
+# Current callback and time of its stages, per server thread
+_local = threading.local()
+
+
+class Histogram:
+    """Prometheus histogram with labels.
+
+    Parameters
+    ----------
+    name : str
+        Metric name.
+    documentation : str
+        HELP text of the metric.
+    labels : list
+        Label names, the label values are given in this order to observe.
+    buckets : tuple
+        Upper bounds of the buckets, sorted.
+    """
+
+    def __init__(self, name, documentation, labels, buckets=TIME_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # label values: [bucket counts (not cumulative, last one is +Inf), sum]
+        self.values = {}
+        _metrics.append(self)
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            if label_values not in self.values:
+                self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts = self.values[label_values]
+            counts[0][index] += 1
+            counts[1] += value
+
+    def get_lines(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation), "# TYPE {} histogram".format(self.name)]
+        with self.lock:
+            values = [(label_values, list(counts), total) for label_values, (counts, total) in self.values.items()]
+        for label_values, counts, total in sorted(values):
+            labels = _format_labels(self.labels, label_values)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append("{}_bucket{{{}le=\"{}\"}} {}".format(self.name, labels + "," if labels else "", bound, cumulative))
+            lines.append("{}_sum{{{}}} {}".format(self.name, labels, total))
+            lines.append("{}_count{{{}}} {}".format(self.name, labels, cumulative))
+        return lines
+
+
+class Counter:
+    """Prometheus counter with labels (same parameters as Histogram, without buckets)."""
+
+    def __init__(self, name, documentation, labels):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values = collections.defaultdict(float)
+        _metrics.append(self)
+
+    def increment(self, *label_values, value=1):
+        with self.lock:
+            self.values[label_values] += value
+
+    def get_lines(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation), "# TYPE {} counter".format(self.name)]
+        with self.lock:
+            values = sorted(self.values.items())
+        lines.extend("{}{{{}}} {}".format(self.name, _format_labels(self.labels, label_values), value) for label_values, value in values)
+        return lines
+
+
+def _format_labels(names, values):
+    return ",".join("{}=\"{}\"".format(name, str(value).replace("\\", "\\\\").replace("\"", "\\\"")) for name, value in zip(names, values))
+
+
+CALLBACK_SECONDS = Histogram("dashboard_callback_seconds", "Wall time of the Dash callbacks, including the JSON serialization.",
+                             ["callback", "status"])
+STAGE_SECONDS = Histogram("dashboard_callback_stage_seconds",
+                          "Wall time of the callback stages: sql (get_locus_info), figure (figure construction), "
+                          "pandas (rest of the callback) and serialization (JSON response).",
+                          ["callback", "stage"])
+RESPONSE_BYTES = Histogram("dashboard_callback_response_bytes", "Size of the JSON responses of the Dash callbacks.",
+                           ["callback"], BYTES_BUCKETS)
+CACHE_REQUESTS = Counter("dashboard_cache_requests_total", "Lookups in the server caches, by callback and result (hit or miss).",
+                         ["callback", "cache", "result"])
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Add the time of the block to a stage of the current callback (nested stages are counted in the outer one)."""
+    stages = getattr(_local, "stages", None)
+    if stages is None or _local.in_stage:
+        yield
+        return
+
+    _local.in_stage = True
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages[name] += time.perf_counter() - start
+        _local.in_stage = False
+
+def timed(name):
+    """Decorator adding the time of the function to a stage of the current callback."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def record_cache(cache, hit):
+    """Count a cache lookup of the current callback."""
+    CACHE_REQUESTS.increment(getattr(_local, "callback", None) or "", cache, "hit" if hit else "miss")
+
+def _time_function(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _local.function_time = time.perf_counter() - start
+    return wrapper
+
+def _time_response(name, add_context):
+    @functools.wraps(add_context)
+    def wrapper(*args, **kwargs):
+        _local.callback = name
+        _local.stages = collections.defaultdict(float)
+        _local.in_stage = False
+        _local.function_time = 0.0
+        status = "error"
+        start = time.perf_counter()
+        try:
+            response = add_context(*args, **kwargs)
+            status = "ok"
+            RESPONSE_BYTES.observe(len(response), name)
+            return response
+        except PreventUpdate:
+            status = "prevented"
+            raise
+        finally:
+            total = time.perf_counter() - start
+            stages, function_time = _local.stages, _local.function_time
+            _local.callback = _local.stages = None
+            CALLBACK_SECONDS.observe(total, name, status)
+            if status == "ok":
+                sql, figure = stages["sql"], stages["figure"]
+                STAGE_SECONDS.observe(sql, name, "sql")
+                STAGE_SECONDS.observe(figure, name, "figure")
+                STAGE_SECONDS.observe(max(function_time - sql - figure, 0), name, "pandas")
+                STAGE_SECONDS.observe(max(total - function_time, 0), name, "serialization")
+    return wrapper
+
+def instrument_app(app):
+    """Time the server callbacks of a Dash app, to call before the callbacks are registered.
+
+    The callback function (and its sql and figure stages) is timed apart from the
+    serialization of its outputs by Dash, the callbacks are named after their function.
+    """
+    register = app.callback
+
+    @functools.wraps(register)
+    def callback(*args, **kwargs):
+        wrap_func = register(*args, **kwargs)
+
+        def decorator(function):
+            add_context = wrap_func(_time_function(function))
+            for entry in app.callback_map.values():
+                if entry.get("callback") is add_context:
+                    entry["callback"] = _time_response(function.__name__, add_context)
+            return add_context
+        return decorator
+
+    app.callback = callback
+
+def get_metrics_text():
+    """Metrics in the Prometheus text format."""
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.get_lines())
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,178 @@
+import collections
+import cProfile
+import io
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+import tracemalloc
+import urllib.parse
+
+from flask import g, request
+
+PROFILERS = ("sampling", "cprofile")
+
+
+class StackSampler:
+    """Sampling profiler of one thread: its Python stack is recorded every interval seconds.
+
+    Parameters
+    ----------
+    thread_id : int
+        Identifier of the profiled thread (threading.get_ident()).
+    interval : float
+        Sampling interval in seconds.
+    """
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def _sample(self):
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def get_collapsed(self):
+        """Stacks in the collapsed format of flamegraph.pl and speedscope: root;...;leaf count."""
+        return "".join("{} {}\n".format(stack, count) for stack, count in self.stacks.most_common())
+
+    def get_summary(self, top=40):
+        """Functions with the most samples, on top of the stack (self) and anywhere in it (total)."""
+        total = sum(self.stacks.values())
+        own = collections.Counter()
+        inclusive = collections.Counter()
+        for stack, count in self.stacks.items():
+            functions = stack.split(";")
+            own[functions[-1]] += count
+            for function in set(functions):
+                inclusive[function] += count
+
+        lines = ["{} samples every {:.1f} ms".format(total, self.interval * 1000), ""]
+        for title, counter in (("self", own), ("total", inclusive)):
+            lines.append("{:>8} {:>7}  function ({})".format("samples", "%", title))
+            lines.extend("{:>8} {:>6.1f}%  {}".format(count, 100 * count / max(total, 1), function)
+                         for function, count in counter.most_common(top))
+            lines.append("")
+        return "\n".join(lines)
+
+
+def _is_requested():
+    # Header, query flag of the request, or of the dashboard page (the Dash requests come from it)
+    if request.headers.get("X-Profile", "").lower() in ("1", "true"):
+        return True
+    if request.args.get("profile", "").lower() in ("1", "true"):
+        return True
+    referrer = urllib.parse.urlparse(request.referrer or "")
+    return urllib.parse.parse_qs(referrer.query).get("profile", [""])[0].lower() in ("1", "true")
+
+def _get_request_name():
+    name = request.path
+    if request.path.endswith("_dash-update-component"):
+        # Named after the first output of the callback
+        name = (request.get_json(silent=True) or {}).get("output", name).strip(".").split("...")[0]
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", name).strip("_")[:80]
+
+def instrument_server(server, directory="logs", profiler="sampling", memory=False, interval=0.005):
+    """Profile the requests of a Flask server that ask for it.
+
+    A request is profiled when it has a X-Profile: 1 header or a profile=1 query
+    parameter, or when the dashboard page was opened with ?profile=1. The profile
+    is written in directory, named after the date and the callback (or route):
+
+    - sampling profiler: .collapsed file (flamegraph.pl, speedscope) and a .txt
+      summary of the functions with the most samples;
+    - cprofile: .prof file (pstats, snakeviz) and a .txt summary by cumulative time.
+
+    With memory, the allocations of the request are traced (tracemalloc), the peak and
+    the top allocation sites are added to the summary. tracemalloc traces the whole
+    process: concurrent requests are counted too.
+
+    Parameters
+    ----------
+    server : Flask
+        Server, e.g. app.server of a Dash app.
+    directory : str
+        Directory of the profiles.
+    profiler : str
+        sampling or cprofile.
+    memory : bool
+        Trace the memory allocations.
+    interval : float
+        Sampling interval in seconds.
+    """
+    if profiler not in PROFILERS:
+        raise ValueError("unknown profiler {}, use one of {}".format(profiler, ", ".join(PROFILERS)))
+    os.makedirs(directory, exist_ok=True)
+    memory_lock = threading.Lock()
+
+    @server.before_request
+    def start_profile():
+        if not _is_requested():
+            return
+        g.profile_start = time.perf_counter()
+        if profiler == "sampling":
+            g.profiler = StackSampler(threading.get_ident(), interval)
+            g.profiler.start()
+        else:
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+        # One memory trace at a time
+        g.profile_memory = memory and memory_lock.acquire(blocking=False)
+        if g.profile_memory:
+            # One frame per trace: deeper tracebacks slow down the figure builds by orders of magnitude
+            tracemalloc.start(1)
+
+    @server.teardown_request
+    def write_profile(exception=None):
+        if getattr(g, "profiler", None) is None:
+            return
+        duration = time.perf_counter() - g.profile_start
+        if profiler == "sampling":
+            g.profiler.stop()
+        else:
+            g.profiler.disable()
+
+        path = os.path.join(directory, "profile_{}_{}".format(time.strftime("%Y%m%d-%H%M%S"), _get_request_name()))
+        summary = ["{} {} in {:.3f} s".format(request.method, request.path, duration), ""]
+
+        if profiler == "sampling":
+            with open(path + ".collapsed", "w") as collapsed_file:
+                collapsed_file.write(g.profiler.get_collapsed())
+            summary.append(g.profiler.get_summary())
+        else:
+            g.profiler.dump_stats(path + ".prof")
+            stream = io.StringIO()
+            pstats.Stats(g.profiler, stream=stream).sort_stats("cumulative").print_stats(40)
+            summary.append(stream.getvalue())
+
+        if g.profile_memory:
+            snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, __file__),
+                                                                  tracemalloc.Filter(False, "<frozen importlib._bootstrap*>")])
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            memory_lock.release()
+            summary.append("memory: {:.1f} MiB peak, {:.1f} MiB still allocated".format(peak / 2**20, current / 2**20))
+            summary.extend(str(statistic) for statistic in snapshot.statistics("lineno")[:20])
+
+        with open(path + ".txt", "w") as summary_file:
+            summary_file.write("\n".join(summary) + "\n")
+        g.profiler = None
@@ -0,0 +1,281 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.spatial import cKDTree
+
+
+def get_locus_centroids(plotly_segments):
+    """Compute the 3D centroid of each locus from its segments.
+
+    Parameters
+    ----------
+    plotly_segments : Pandas dataframe
+        3D segments coordinates (x, y, z) and their associated locus (Primary_SGDID).
+        Segments are separated by rows with missing coordinates.
+
+    Returns
+    -------
+    Pandas dataframe
+        x, y, z coordinates indexed by Primary_SGDID.
+    """
+    points = plotly_segments.dropna(subset=["x", "y", "z", "Primary_SGDID"])
+    centroids = points.groupby("Primary_SGDID", sort=False)[["x", "y", "z"]].mean()
+
+    return centroids
+
+def build_spatial_index(centroids):
+    """Build a KD-tree over the loci centroids.
+
+    Parameters
+    ----------
+    centroids : Pandas dataframe
+        x, y, z coordinates indexed by Primary_SGDID (output of get_locus_centroids).
+
+    Returns
+    -------
+    scipy.spatial.cKDTree
+    """
+    return cKDTree(centroids[["x", "y", "z"]].to_numpy(dtype=float))
+
+def get_neighbours_within(spatial_index, centroids, center, radius):
+    """Get the loci within a 3D radius of a locus or of a point.
+
+    Parameters
+    ----------
+    spatial_index : scipy.spatial.cKDTree
+        KD-tree over the loci centroids (output of build_spatial_index).
+    centroids : Pandas dataframe
+        x, y, z coordinates indexed by Primary_SGDID.
+    center : str or array-like
+        Primary_SGDID of a locus, or x, y, z coordinates of a point.
+    radius : float
+        3D distance radius.
+
+    Returns
+    -------
+    Pandas dataframe
+        Primary_SGDID and 3D_distances of the neighbours, sorted by distance.
+        The center locus itself is excluded.
+    """
+    if isinstance(center, str):
+        point = centroids.loc[center].to_numpy(dtype=float)
+    else:
+        point = np.asarray(center, dtype=float)
+
+    index = np.asarray(spatial_index.query_ball_point(point, radius), dtype=int)
+    distances = np.sqrt(((spatial_index.data[index] - point) ** 2).sum(axis=1))
+
+    neighbours = pd.DataFrame({"Primary_SGDID": centroids.index[index],
+                               "3D_distances": distances})
+    if isinstance(center, str):
+        neighbours = neighbours[neighbours["Primary_SGDID"] != center]
+    neighbours = neighbours.sort_values("3D_distances", kind="stable")
+    neighbours.index = range(1, len(neighbours) + 1)
+
+    return neighbours
+
+def get_nearest_neighbours(spatial_index, centroids, sgdids, k):
+    """Get the k nearest loci of each locus in a list.
+
+    Parameters
+    ----------
+    spatial_index : scipy.spatial.cKDTree
+        KD-tree over the loci centroids (output of build_spatial_index).
+    centroids : Pandas dataframe
+        x, y, z coordinates indexed by Primary_SGDID.
+    sgdids : list
+        Primary_SGDID of the query loci. Loci without 3D coordinates are ignored.
+    k : int
+        Number of neighbours per locus.
+
+    Returns
+    -------
+    Pandas dataframe
+        Primary_SGDID (query), Primary_SGDID_bis (neighbour), rank and 3D_distances.
+    """
+    sgdids = pd.Index(sgdids)
+    sgdids = sgdids[sgdids.isin(centroids.index)]
+    k = min(k, len(centroids) - 1)
+    if len(sgdids) == 0 or k < 1:
+        return pd.DataFrame(columns=["Primary_SGDID", "Primary_SGDID_bis", "rank", "3D_distances"])
+
+    points = centroids.loc[sgdids].to_numpy(dtype=float)
+    # Query one more neighbour: the closest one is the locus itself
+    distances, index = spatial_index.query(points, k=k + 1)
+    distances = distances.reshape(len(sgdids), k + 1)
+    index = index.reshape(len(sgdids), k + 1)
+
+    # Drop the query locus, wherever it is ranked among equidistant loci
+    query_position = centroids.index.get_indexer(sgdids)
+    is_self = index == query_position[:, None]
+    is_self[~is_self.any(axis=1), -1] = True
+    keep = ~is_self
+
+    neighbours = pd.DataFrame({"Primary_SGDID": np.repeat(sgdids.to_numpy(), k),
+                               "Primary_SGDID_bis": centroids.index.to_numpy()[index[keep]],
+                               "rank": np.tile(np.arange(1, k + 1), len(sgdids)),
+                               "3D_distances": distances[keep]})
+
+    return neighbours
+
+def get_spatial_weights(spatial_index, k=10, bandwidth=None):
+    """Build a sparse spatial weight matrix from the k nearest neighbours of each locus.
+
+    Parameters
+    ----------
+    spatial_index : scipy.spatial.cKDTree
+        KD-tree over the loci centroids (output of build_spatial_index).
+    k : int
+        Number of neighbours per locus.
+    bandwidth : float, optional
+        Gaussian kernel bandwidth. By default, all the neighbours have a weight of 1.
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        Symmetric (loci, loci) weights, without self weights.
+    """
+    loci_number = spatial_index.n
+    k = min(k, loci_number - 1)
+    distances, index = spatial_index.query(spatial_index.data, k=k + 1)
+
+    rows = np.repeat(np.arange(loci_number), k + 1)
+    columns = index.ravel()
+    distances = distances.ravel()
+    if bandwidth is None:
+        weights = np.ones(len(columns))
+    else:
+        weights = np.exp(-0.5 * (distances / bandwidth) ** 2)
+
+    not_self = rows != columns
+    weights = sparse.csr_matrix((weights[not_self], (rows[not_self], columns[not_self])), shape=(loci_number, loci_number))
+
+    # i neighbour of j or j neighbour of i
+    return weights.maximum(weights.T).tocsr()
+
+def get_centroid_values(centroids, feature_name, data, key, columns):
+    """Map quantitative variables on the loci centroids.
+
+    Parameters
+    ----------
+    centroids : Pandas dataframe
+        x, y, z coordinates indexed by Primary_SGDID.
+    feature_name : Pandas dataframe
+        Primary_SGDID and Feature_name of the loci.
+    data : Pandas dataframe
+        Uploaded data, one row per locus.
+    key : str
+        The name of the data column containing the YORF.
+    columns : list
+        The names of the data columns containing the quantitative variables.
+
+    Returns
+    -------
+    numpy array
+        (loci, columns) values in the order of centroids, NaN for loci without value.
+    """
+    data = data.drop_duplicates(subset=[key])
+    values = data[columns].apply(pd.to_numeric, errors="coerce").to_numpy(dtype=float)
+    values = np.vstack([values, np.full(len(columns), np.nan)])
+
+    names = feature_name.set_index("Primary_SGDID")["Feature_name"].reindex(centroids.index)
+    rows = pd.Index(data[key].astype(str)).get_indexer(names.fillna(""))
+
+    return values[rows]
+
+def smooth_values(weights, values):
+    """Average the values over the 3D neighbourhood of each locus.
+
+    Parameters
+    ----------
+    weights : scipy.sparse matrix
+        (loci, loci) spatial weights (output of get_spatial_weights).
+    values : numpy array
+        (loci, variables) values, NaN for missing values.
+
+    Returns
+    -------
+    numpy array
+        (loci, variables) weighted mean of the locus and its neighbours with a value,
+        NaN when none of them has a value.
+    """
+    observed = ~np.isnan(values)
+    filled = np.where(observed, values, 0)
+
+    # The locus itself has a weight of 1
+    total = weights @ filled + filled
+    weight_sum = weights @ observed.astype(float) + observed
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(weight_sum > 0, total / weight_sum, np.nan)
+
+def get_spatial_autocorrelation(weights, values, permutations=999, seed=0, batch_size=100):
+    """Compute the global Moran's I and Geary's C of a variable, with permutation p-values.
+
+    Parameters
+    ----------
+    weights : scipy.sparse matrix
+        (loci, loci) spatial weights (output of get_spatial_weights).
+    values : numpy array
+        (loci,) values, NaN for missing values. Only the loci with a value are used.
+    permutations : int
+        Number of random permutations of the values.
+    seed : int
+        Random generator seed.
+    batch_size : int
+        Number of permutations computed at once, bounds memory.
+
+    Returns
+    -------
+    dict
+        n, morans_i, morans_i_p_value, gearys_c, gearys_c_p_value.
+        One-sided pseudo p-values, in the direction of the observed statistic.
+    """
+    observed = np.flatnonzero(~np.isnan(values))
+    n = len(observed)
+    weights = sparse.csr_matrix(weights)[observed][:, observed]
+    s0 = weights.sum()
+    # Weights of each locus, as a source or as a target
+    degrees = np.asarray(weights.sum(axis=0)).ravel() + np.asarray(weights.sum(axis=1)).ravel()
+
+    z = values[observed] - values[observed].mean()
+    squares = (z * z).sum()
+    if n < 3 or s0 == 0 or squares == 0:
+        return {"n": n, "morans_i": np.nan, "morans_i_p_value": np.nan, "gearys_c": np.nan, "gearys_c_p_value": np.nan}
+
+    def statistics(z):
+        # z: (loci, permutations), the sum of squares is invariant to permutations
+        cross = (z * (weights @ z)).sum(axis=0)
+        morans_i = n / s0 * cross / squares
+        gearys_c = (n - 1) / (2 * s0) * ((degrees @ (z * z)) - 2 * cross) / squares
+        return morans_i, gearys_c
+
+    morans_i, gearys_c = statistics(z[:, None])
+
+    rng = np.random.default_rng(seed)
+    permuted_i = []
+    permuted_c = []
+    for start in range(0, permutations, batch_size):
+        size = min(batch_size, permutations - start)
+        order = np.argsort(rng.random((n, size)), axis=0)
+        i, c = statistics(z[order])
+        permuted_i.append(i)
+        permuted_c.append(c)
+    permuted_i = np.concatenate(permuted_i)
+    permuted_c = np.concatenate(permuted_c)
+
+    # Expectations under randomness: I = -1 / (n - 1), C = 1
+    if morans_i[0] >= -1 / (n - 1):
+        morans_i_p_value = ((permuted_i >= morans_i[0]).sum() + 1) / (permutations + 1)
+    else:
+        morans_i_p_value = ((permuted_i <= morans_i[0]).sum() + 1) / (permutations + 1)
+    if gearys_c[0] <= 1:
+        gearys_c_p_value = ((permuted_c <= gearys_c[0]).sum() + 1) / (permutations + 1)
+    else:
+        gearys_c_p_value = ((permuted_c >= gearys_c[0]).sum() + 1) / (permutations + 1)
+
+    return {"n": n,
+            "morans_i": float(morans_i[0]),
+            "morans_i_p_value": float(morans_i_p_value),
+            "gearys_c": float(gearys_c[0]),
+            "gearys_c_p_value": float(gearys_c_p_value)}
@@ -1,5 +1,4 @@
 import pandas as pd
-import matplotlib.pyplot as plt
 import numpy as np
 import sqlite3
 import dash_html_components as html
@@ -8,6 +7,9 @@ import base64
 from io import BytesIO
 import io
 
+import lib.intervals as intervals
+import lib.metrics as metrics
+
 
 def display_module_version():
     """Display dependencies versions.
@@ -15,6 +17,7 @@ def display_module_version():
     print("sqlite3 version:", sqlite3.version)
     print("pandas version:", pd.__version__)
 
+@metrics.timed("sql")
 def get_locus_info(database, query):
     """Query the SQLite database.
 
@@ -51,7 +54,12 @@ def get_locus_info(database, query):
 
 ############UPLOAD_PARSING############
 
-def parse_contents(contents, filename, datatable_id):
+def parse_contents(contents, filename, datatable_id, feature_name=None, interval_index=None):
+    """Parse an uploaded file into a DataTable.
+
+    csv and excel files are displayed as is. BED files of genomic intervals are
+    converted to the list of overlapping loci (requires feature_name and interval_index).
+    """
     content_type, content_string = contents.split(',')
 
     decoded = base64.b64decode(content_string)
@@ -63,6 +71,10 @@ def parse_contents(contents, filename, datatable_id):
         elif 'xls' in filename:
             # Assume that the user uploaded an excel file
             df = pd.read_excel(io.BytesIO(decoded))
+        elif 'bed' in filename and interval_index is not None:
+            # Assume that the user uploaded a BED file of genomic intervals
+            bed = intervals.read_bed(decoded.decode('utf-8'))
+            df = intervals.get_bed_loci(bed, feature_name, interval_index)
     except Exception as e:
         print(e)
         return html.Div([
@@ -91,26 +103,33 @@ def parse_contents(contents, filename, datatable_id):
         #html.Pre(contents[0:200] + '...', style={'whiteSpace': 'pre-wrap','wordBreak': 'break-all'})
     ])
 
-def get_edges_list(gene_list, edges_list, feature_name):
-
-    # Add SGDID
-    feature_name = feature_name.merge(gene_list, left_on = "Feature_name", right_on = gene_list.columns[0])
+@metrics.timed("figure")
+def distri_counts(H, pairs_number, H2, F2, bin_number, input1):
+    """Plot the 3D distances histogram of a genes list from its bin counts.
 
-    # Extract distances for selected genes list
-    edges_list_select = edges_list[edges_list["Primary_SGDID"].isin(feature_name["Primary_SGDID"])]
-    edges_list_select = edges_list_select[edges_list_select["Primary_SGDID_bis"].isin(feature_name["Primary_SGDID"])]
-    edges_list_select.index = range(1, len(edges_list_select) + 1)
-
-    return edges_list_select
+    Parameters
+    ----------
+    H : numpy array
+        Counts of the 3D distances in bin_number bins of the [0, 200] range.
+    pairs_number : int
+        Number of 3D distances, including the ones out of the histogram range.
+    H2, F2 : numpy array
+        Density and CDF of the 3D distances between all genes.
+    bin_number : int
+    input1 : float
+        Threshold drawn as a dashed line, None for no line.
 
-def distri(genes_list, edges_list, feature_name, H2, F2, bin_number, input1):
+    Returns
+    -------
+    matplotlib figure
+    """
+    # Imported at first use: matplotlib is slow to import and only needed for the histograms
+    import matplotlib.pyplot as plt
 
-    edges_list_select = get_edges_list(genes_list, edges_list, feature_name)
-    x = list(edges_list_select["3D_distances"])
-    H, X1 = np.histogram(x, bins = bin_number, range = (0, 200))
-    F1 = np.cumsum(H)/len(x)
+    X1 = np.linspace(0, 200, bin_number + 1)
+    F1 = np.cumsum(H)/pairs_number
 
-    H = H/len(x)
+    H = H/pairs_number
 
     fig, ax = plt.subplots()
     ax.hist(X1[:-1], X1, weights=H2, color="#5767FF", alpha=0.3, label="All distances")
@@ -125,11 +144,37 @@ def distri(genes_list, edges_list, feature_name, H2, F2, bin_number, input1):
     ax.legend(bbox_to_anchor = (0.6, 0.9), loc="upper left")
     ax2.legend(bbox_to_anchor = (0.6, 0.7), loc="upper left")
 
-    plt.axvline(x=input1, color='black', linestyle='--')
+    if input1 is not None:
+        plt.axvline(x=input1, color='black', linestyle='--')
 
     return fig
 
+def draw_histogram(H, pairs_number, H2, F2, bin_number, input1, progress=None):
+    """Render the 3D distances histogram of a genes list as a PNG URI, in a background job (lib.jobs).
+
+    Parameters
+    ----------
+    H, pairs_number, H2, F2, bin_number, input1 : see distri_counts
+    progress : function
+        Called with the fraction of the rendering done.
+
+    Returns
+    -------
+    str
+        PNG data URI (output of fig_to_uri).
+    dict
+        Position of the axes (figure fraction), x0, x1, y0, y1, and their maximum 3D distance xmax,
+        to draw the threshold line in the browser.
+    """
+    fig = distri_counts(H, pairs_number, H2, F2, bin_number, input1)
+    if progress is not None:
+        progress(0.5)
+
+    axes = fig.axes[0].get_position()
+    return fig_to_uri(fig), {"x0": axes.x0, "x1": axes.x1, "y0": axes.y0, "y1": axes.y1, "xmax": 200}
+
 #From https://github.com/4QuantOSS/DashIntro/blob/master/notebooks/Tutorial.ipynb
+@metrics.timed("figure")
 def fig_to_uri(in_fig, close_all=True, **save_args):
     """
     Save a figure as a URI
@@ -137,8 +182,54 @@ def fig_to_uri(in_fig, close_all=True, **save_args):
     out_img = BytesIO()
     in_fig.savefig(out_img, format='png', **save_args)
     if close_all:
+        import matplotlib.pyplot as plt
         in_fig.clf()
         plt.close('all')
     out_img.seek(0)  # rewind file
     encoded = base64.b64encode(out_img.read()).decode("ascii").replace("\n", "")
-    return "data:image/png;base64,{}".format(encoded)
\ No newline at end of file
+    return "data:image/png;base64,{}".format(encoded)
+
+def get_plotly_colors(values):
+    """Colors of a quantitative Plotly trace: values rounded to 4 decimals, None (no color) for NaN."""
+    return np.where(np.isnan(values), None, np.round(values, 4).astype(object)).tolist()
+
+def get_color_ranges(values, common_scale=True):
+    """Color scale range (cmin, cmax) of each column of values.
+
+    Parameters
+    ----------
+    values : numpy array
+        (items, variables) values, NaN for missing values.
+    common_scale : bool
+        One range for all the variables, else one range per variable (variables of different units).
+
+    Returns
+    -------
+    list
+        (cmin, cmax) of each variable, (0, 1) without finite values.
+    """
+    def get_range(column):
+        finite = column[np.isfinite(column)]
+        return (float(finite.min()), float(finite.max())) if len(finite) else (0, 1)
+
+    if common_scale:
+        return [get_range(values.ravel())] * values.shape[1]
+    return [get_range(values[:, i]) for i in range(values.shape[1])]
+
+def get_animation_layout(names):
+    """Play and pause buttons and slider of an animated Plotly figure with one frame per name."""
+    transition = {"frame": {"duration": 1000, "redraw": True}, "transition": {"duration": 0}, "mode": "immediate"}
+    return {"updatemenus": [{"type": "buttons",
+                             "direction": "left",
+                             "x": 0.1,
+                             "y": 0,
+                             "xanchor": "right",
+                             "yanchor": "top",
+                             "buttons": [{"label": "Play", "method": "animate", "args": [None, {**transition, "fromcurrent": True}]},
+                                         {"label": "Pause", "method": "animate", "args": [[None], {**transition, "frame": {"duration": 0, "redraw": False}}]}]}],
+            "sliders": [{"x": 0.1,
+                         "y": 0,
+                         "len": 0.9,
+                         "currentvalue": {"prefix": "Variable : "},
+                         "steps": [{"label": str(name), "method": "animate", "args": [[str(name)], transition]}
+                                   for name in names]}]}
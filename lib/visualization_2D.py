@@ -1,14 +1,17 @@
-import matplotlib
 import numpy as np
 import pandas as pd
 import plotly
 import plotly.express as px
 import sqlite3
 
+import lib.metrics as metrics
+import lib.tools as tools
+
 
 def display_module_version():
     """Display dependencies versions.
     """
+    import matplotlib
     print("sqlite3 version:", sqlite3.version)
     print("pandas version:", pd.__version__)
     print("matplotlib version:", matplotlib.__version__)
@@ -16,12 +19,16 @@ def display_module_version():
     print("plotly version:", plotly.__version__)
     print("ipywidgets version:", widgets.__version__)
 
+# Graphical space between two chromosomes in the 2D representation
+SPACE_BETWEEN_CHROMOSOMES = 6
+
 def format_coordinates(coordinates, space_between_chromosomes):
     """Format the locus coordinates for Plotly visualization.
 
     Each locus is represented by three rows:
     x1, x2 (the two values are in the column x) and none.
     The third row allow the separation between lines.
+    A row of none separates the chromosomes.
 
     Parameters
     ----------
@@ -35,132 +42,127 @@ def format_coordinates(coordinates, space_between_chromosomes):
     Pandas dataframe
     """
 
-    genome_data = pd.DataFrame(columns=coordinates.columns)
-    row_null = {"Start_coordinate": "none", "Stop_coordinate": "none"}
-
-    for chromosome_id in range(1, coordinates["Chromosome"].max() + 1):
-        chrom = coordinates[coordinates["Chromosome"] == chromosome_id]
-        row_one = chrom.copy()
-        row_one.index = range(0, len(chrom)*3, 3)
-        row_one = row_one.drop("Stop_coordinate", axis = 1)
-        row_one = row_one.transpose()
-
-        row_two = chrom.copy()
-        row_two.index = range(1, len(chrom)*3, 3)
-        row_two["Start_coordinate"] = row_two["Stop_coordinate"]
-        row_two = row_two.drop("Stop_coordinate", axis = 1)
-        row_two = row_two.transpose()
+    chromosome_ids = np.arange(1, coordinates["Chromosome"].max() + 1)
+    loci = coordinates[coordinates["Chromosome"].isin(chromosome_ids)].sort_values("Chromosome", kind="stable")
 
-        row_three = chrom.assign(Start_coordinate = "none")
-        row_three.index = range(2, len(chrom)*3, 3)
-        row_three = row_three.drop("Stop_coordinate", axis = 1)
-        row_three = row_three.transpose()
+    # Three rows per locus: start, stop, none
+    genome_data = loci.iloc[np.repeat(np.arange(len(loci)), 3)].reset_index(drop=True)
+    x = np.empty(len(genome_data), dtype=object)
+    x[0::3] = loci["Start_coordinate"].to_numpy()
+    x[1::3] = loci["Stop_coordinate"].to_numpy()
+    x[2::3] = "none"
 
-        chrom_data = pd.merge(row_one, row_two, left_index = True, right_index = True)
-        chrom_data = pd.merge(chrom_data, row_three, left_index = True, right_index = True)
-        chrom_data = chrom_data.transpose()
-        chrom_data = chrom_data.sort_index()
-
-        # Add y-coordinates
-        chrom_data["Stop_coordinate"] = (chromosome_id - 1) * space_between_chromosomes
-        chrom_data["Stop_coordinate"] = chrom_data.apply(lambda x: x["Stop_coordinate"] + 0.2 if x["Strand"] == "C" else x["Stop_coordinate"] - 0.2, axis=1)
-
-        chrom_data = chrom_data.append(row_null, ignore_index = True)
-        genome_data = genome_data.append(chrom_data)
+    # y-coordinates: + strand above the chromosome line, - strand below
+    y = (genome_data["Chromosome"].to_numpy() - 1) * space_between_chromosomes
+    y = y + np.where(genome_data["Strand"].to_numpy() == "C", 0.2, -0.2)
 
+    genome_data["Start_coordinate"] = x
+    genome_data["Stop_coordinate"] = y
     genome_data = genome_data.rename(columns={"Start_coordinate": "x", "Stop_coordinate": "y"})
 
+    # The stable sort keeps each separation row after the loci of its chromosome
+    separations = pd.DataFrame({"x": "none", "y": "none", "separation_chromosome": chromosome_ids})
+    genome_data = pd.concat([genome_data.assign(separation_chromosome=genome_data["Chromosome"]), separations], ignore_index=True)
+    genome_data = genome_data.sort_values("separation_chromosome", kind="stable").drop(columns="separation_chromosome")
+    genome_data.index = range(len(genome_data))
+
     return genome_data
 
 # Chromosome shapes.
 
-def get_chromosome_lenght(chrom_number):
-    """Get the chromosome length from the SQL database.
+def get_chromosome_layout(database, space_between_chromosomes=SPACE_BETWEEN_CHROMOSOMES, labels=None):
+    """Get the chromosomes of the 2D representation from the SQL database.
+
+    The chromosome numbers and lengths come from the chromosome_length table, or from
+    the loci coordinates (end of the last locus) when the database has no such table.
 
     Parameters
     ----------
-    chrom_number : int
+    database : str
+        Path to the SQLite database.
+    space_between_chromosomes : int
+        Graphical space to leave between chromosomes.
+    labels : list, optional
+        Name of each chromosome, in the order of their numbers (default: the numbers).
 
     Returns
     -------
-    int
+    Pandas dataframe
+        chromosome, length, y (position of the chromosome line) and label, sorted by chromosome.
     """
 
     #SQL request
-    db_connexion = sqlite3.connect('./static/SCERE.db')
-
-    cursor = db_connexion.cursor()
-
-    chromosome_length = cursor.execute("""
-    SELECT length
-    FROM chromosome_length
-    """)
-
-    chromosome_length = chromosome_length.fetchall()
-    chromosome_length = pd.DataFrame(chromosome_length, columns = ["length"], index = list(range(1,18)))
-
-    return chromosome_length.loc[chrom_number][0]
-
-def format_chromosomes(y1, y2):
+    with sqlite3.connect(database) as db_connexion:
+        tables = [name for name, in db_connexion.execute("SELECT name FROM sqlite_master WHERE type == 'table'")]
+        if "chromosome_length" in tables:
+            query = "SELECT chromosome, length FROM chromosome_length"
+        else:
+            query = """SELECT Chromosome AS chromosome, MAX(MAX(Start_coordinate, Stop_coordinate)) AS length
+            FROM SGD_features
+            WHERE Strand IN ('W', 'C') AND Chromosome != '2-micron'
+            GROUP BY Chromosome
+            """
+        layout = pd.read_sql_query(query, db_connexion)
+
+    layout = layout.astype({"chromosome": int, "length": int}).sort_values("chromosome", ignore_index=True)
+    layout["y"] = (layout["chromosome"] - 1) * space_between_chromosomes
+    if labels is None:
+        labels = layout["chromosome"].astype(str)
+    elif len(labels) != len(layout):
+        raise ValueError("{} chromosome labels for {} chromosomes in {}".format(len(labels), len(layout), database))
+    layout["label"] = list(labels)
+
+    return layout
+
+def format_chromosomes(chromosome_layout):
     """Format the chromosomes coordinates for Plotly visualization.
 
-    Each chromosome is represented by three rows:
+    Each chromosome is represented by two lines (+ and - strands) of three rows:
     x1, x2 (the two values are in the column x) and none.
     The third row allow the separation between lines.
 
     Parameters
     ----------
-    y1 : list
-        List containing chromosomes y coordinates (+ strand).
-    y2 : list
-        List containing chromosomes y coordinates (- strand).
+    chromosome_layout : Pandas dataframe
+        Output of get_chromosome_layout.
 
     Returns
     -------
     Pandas dataframe
     """
 
-    chromosomes = pd.DataFrame(columns = ["x", "y", "Chromosome"])
-
-    for c in range(1,18):
-        chrom_lenght = get_chromosome_lenght(c)
-        chromosomes = chromosomes.append({"x": 0,
-                                          "y": y1[c-1],
-                                          "Chromosome": 0,
-                                          "Feature_type": "0"}, ignore_index = True)
-        chromosomes = chromosomes.append({"x": chrom_lenght,
-                                          "y": y1[c-1],
-                                          "Chromosome": 0,
-                                          "Feature_type": "0"}, ignore_index = True)
-        chromosomes = chromosomes.append({"x": "none",
-                                          "y": "none",
-                                          "Chromosome": 0,
-                                          "Feature_type": "0"}, ignore_index = True)
-
-        chromosomes = chromosomes.append({"x": 0,
-                                          "y": y2[c-1],
-                                          "Chromosome": 0,
-                                          "Feature_type": "0"}, ignore_index = True)
-        chromosomes = chromosomes.append({"x": chrom_lenght,
-                                          "y": y2[c-1],
-                                          "Chromosome": 0,
-                                          "Feature_type": "0"}, ignore_index = True)
-        chromosomes = chromosomes.append({"x": "none",
-                                          "y": "none",
-                                          "Chromosome": 0,
-                                          "Feature_type": "0"}, ignore_index = True)
+    lengths = chromosome_layout["length"].to_numpy()
+    y = chromosome_layout["y"].to_numpy()
+
+    # Rows of each chromosome: + strand (0, length, none), - strand (0, length, none)
+    x = np.empty((len(chromosome_layout), 6), dtype=object)
+    x[:, [0, 3]] = 0
+    x[:, [1, 4]] = lengths[:, None]
+    x[:, [2, 5]] = "none"
+    strand_y = np.empty((len(chromosome_layout), 6), dtype=object)
+    strand_y[:, [0, 1]] = (y + 0.2)[:, None]
+    strand_y[:, [3, 4]] = (y - 0.2)[:, None]
+    strand_y[:, [2, 5]] = "none"
+
+    chromosomes = pd.DataFrame({"x": x.ravel(),
+                                "y": strand_y.ravel(),
+                                "Chromosome": 0,
+                                "Feature_type": "0"})
 
     return chromosomes
 
 # Genome drawing.
 
-def genome_drawing(genome_data, parameter, values = "null", values_colors = "null", hover = []):
-    """Draw the 2D plotly figure, representing the 16 chromosomes (+ mitochondrial plasmid) in lightgrey and all the loci in darkgrey.
+@metrics.timed("figure")
+def genome_drawing(genome_data, chromosome_layout, parameter, values = "null", values_colors = "null", hover = []):
+    """Draw the 2D plotly figure, representing the chromosomes in lightgrey and all the loci in darkgrey.
 
     Parameters
     ----------
     genome_data : Pandas dataframe
         2D coordinates of all the loci for Plotly visualization.
+    chromosome_layout : Pandas dataframe
+        Chromosomes lengths, positions and labels (output of get_chromosome_layout).
     parameter : str
         The name of the genome_data column containing the coloring parameter.
     values : list
@@ -174,7 +176,7 @@ def genome_drawing(genome_data, parameter, values = "null", values_colors = "nul
     Plotly figure
     """
 
-    chromosomes = format_chromosomes(list(i + 0.2 for i in range(0,108,6)), list(i - 0.2 for i in range(0,108,6)))
+    chromosomes = format_chromosomes(chromosome_layout)
 
     genome_data = chromosomes.append(genome_data)
     genome_data.index = range(1, len(genome_data) + 1)
@@ -198,9 +200,8 @@ def genome_drawing(genome_data, parameter, values = "null", values_colors = "nul
                       showlegend = True)
 
     fig.update_yaxes(tickmode = "array",
-                     tickvals = list(range(0,102,6)),
-                     ticktext = ["1", "2", "3", "4", "5", "6", "7", "8", "9",
-                                 "10", "11", "12", "13", "14", "15", "16", "mitochondrial"],
+                     tickvals = chromosome_layout["y"].tolist(),
+                     ticktext = chromosome_layout["label"].tolist(),
                      title = "Chromosomes number")
     fig.update_xaxes(title = "Coordinates (bp)")
 
@@ -209,6 +210,86 @@ def genome_drawing(genome_data, parameter, values = "null", values_colors = "nul
 
     return fig
 
+@metrics.timed("figure")
+def genome_values_drawing(loci, chromosome_layout, values, names, colorscale=None, common_scale=True):
+    """Draw the 2D genome with the loci colored by quantitative variables, one animation frame per variable.
+
+    Each locus is a marker at its middle, above the chromosome line for the - strand and
+    below for the + strand (as genome_drawing). The figure is built as a dictionary.
+
+    Parameters
+    ----------
+    loci : Pandas dataframe
+        Feature_name, Chromosome, Strand, Start_coordinate and Stop_coordinate of the loci.
+    chromosome_layout : Pandas dataframe
+        Chromosomes lengths, positions and labels (output of get_chromosome_layout).
+    values : numpy array
+        (loci, variables) values, NaN for loci without value.
+    names : list
+        Names of the variables.
+    colorscale : str
+        Plotly color scale name.
+    common_scale : bool
+        One color scale for all the frames, else one per frame (variables of different units).
+
+    Returns
+    -------
+    dict
+        Plotly figure.
+    """
+    # Line breaks are None in the figure dictionary
+    chromosomes = format_chromosomes(chromosome_layout)
+    chromosomes_x, chromosomes_y = ([None if value == "none" else value for value in chromosomes[axis]] for axis in ["x", "y"])
+    y = chromosome_layout.set_index("chromosome")["y"].reindex(loci["Chromosome"]).to_numpy(dtype=float)
+    y = y + np.where(loci["Strand"].to_numpy() == "C", 0.2, -0.2)
+    ranges = tools.get_color_ranges(values, common_scale)
+
+    marker = {"color": tools.get_plotly_colors(values[:, 0]),
+              "cmin": ranges[0][0],
+              "cmax": ranges[0][1],
+              "showscale": True,
+              "symbol": "square",
+              "size": 7}
+    if colorscale is not None:
+        marker["colorscale"] = colorscale
+
+    traces = [{"type": "scattergl",
+               "x": chromosomes_x,
+               "y": chromosomes_y,
+               "mode": "lines",
+               "line": {"color": "lightgrey", "width": 9},
+               "hoverinfo": "skip",
+               "showlegend": False},
+              {"type": "scattergl",
+               "x": ((loci["Start_coordinate"] + loci["Stop_coordinate"]) / 2).tolist(),
+               "y": y.tolist(),
+               "mode": "markers",
+               "name": "",
+               "marker": marker,
+               "customdata": loci["Feature_name"].fillna("").tolist(),
+               "hovertemplate": "<b>YORF :</b> %{customdata} <br><b>Value :</b> %{marker.color} <br>",
+               "hoverlabel": {"bgcolor": "white", "font": {"size": 16}},
+               "showlegend": False}]
+
+    layout = {"plot_bgcolor": "white",
+              "xaxis": {"showgrid": False, "title": {"text": "Coordinates (bp)"}},
+              "yaxis": {"showgrid": False, "tickmode": "array", "tickvals": chromosome_layout["y"].tolist(),
+                        "ticktext": chromosome_layout["label"].tolist(), "title": {"text": "Chromosomes number"}},
+              "title": {"text": str(names[0])}}
+
+    figure = {"data": traces, "layout": layout}
+
+    if len(names) > 1:
+        figure["frames"] = [{"name": str(name),
+                             "data": [{"type": "scattergl", "marker": {"color": tools.get_plotly_colors(values[:, i]),
+                                                                       "cmin": ranges[i][0], "cmax": ranges[i][1]}}],
+                             "traces": [1],
+                             "layout": {"title": {"text": str(name)}}}
+                            for i, name in enumerate(names)]
+        layout.update(tools.get_animation_layout(names))
+
+    return figure
+
 # Adding color.
 
 def get_color_discreet(genome_data, parameter, values):
@@ -1,8 +1,41 @@
+import numpy as np
+import pandas as pd
 import plotly.graph_objects as go
 
+import lib.crowding as crowding
+import lib.metrics as metrics
+import lib.spatial as spatial
+import lib.tools as tools
+
+SQL_QUERY_LOCI = \
+"""SELECT Primary_SGDID, count(SGDID), Feature_name, Start_coordinate, Stop_coordinate, Chromosome, Strand, GO_slim_term
+FROM SGD_features, go_slim_mapping
+WHERE SGDID == Primary_SGDID
+GROUP BY SGDID
+ORDER BY Start_coordinate
+"""
+
+SQL_QUERY_GO_TERM_LOCI = \
+"""SELECT Primary_SGDID, Feature_name, Start_coordinate, Stop_coordinate, Chromosome, Strand, GO_slim_term
+FROM SGD_features, go_slim_mapping
+WHERE SGDID == Primary_SGDID
+AND (GO_slim_term == '{}')
+GROUP BY SGDID
+ORDER BY Start_coordinate
+"""
+
+SQL_QUERY_LITERATURE_LOCI = \
+"""SELECT Primary_SGDID, Start_coordinate, Stop_coordinate, Chromosome, Feature_name, Strand
+FROM gene_literature, SGD_features
+WHERE SGDID == Primary_SGDID
+GROUP BY SGDID
+ORDER BY Start_coordinate
+"""
+
 
 #3D Genome drawing.
 
+@metrics.timed("figure")
 def genome_drawing(whole_genome_segments):
     """Draw the 3D plotly figure, representing the 16 chromosomes in lightgrey and all the loci in darkgrey.
 
@@ -61,4 +94,233 @@ def get_color_discreet_3D(genome_data, parameter, values, values_colors):
 
     genome_data.loc[genome_data["Primary_SGDID"].isna() == True, "legend"] = "whitesmoke"
 
-    return genome_data
\ No newline at end of file
+    return genome_data
+
+#Quantitative variables in 3D
+
+def get_values_3D(genome_data, data, key, columns):
+    """Map quantitative variables on the 3D segments in one pass.
+
+    Parameters
+    ----------
+    genome_data : Pandas dataframe
+        3D segments coordinates and their associated locus (Feature_name).
+    data : Pandas dataframe
+        Uploaded data, one row per locus.
+    key : str
+        The name of the data column containing the YORF.
+    columns : list
+        The names of the data columns containing the quantitative variables.
+
+    Returns
+    -------
+    numpy array
+        (segments, columns) values, NaN for loci without value.
+    """
+    data = data.drop_duplicates(subset=[key])
+    values = data[columns].apply(pd.to_numeric, errors="coerce").to_numpy(dtype=float)
+    # Loci missing from the data point to the last (NaN) row
+    values = np.vstack([values, np.full(len(columns), np.nan)])
+
+    rows = pd.Index(data[key].astype(str)).get_indexer(genome_data["Feature_name"])
+
+    return values[rows]
+
+@metrics.timed("figure")
+def genome_animation(genome_data, values, names, colorscale=None, common_scale=True):
+    """Draw the 3D genome colored by quantitative variables, one animation frame per variable.
+
+    The frames share the geometry of the first trace and only change the colors,
+    with a color scale common to all the frames unless common_scale is False. The
+    figure is built as a dictionary to skip the validation of the large color arrays.
+
+    Parameters
+    ----------
+    genome_data : Pandas dataframe
+        3D segments coordinates for Plotly visualization and their associated locus (Feature_name).
+    values : numpy array
+        (segments, variables) values (output of get_values_3D).
+    names : list
+        Names of the variables.
+    colorscale : str
+        Plotly color scale name.
+    common_scale : bool
+        One color scale for all the frames, else one per frame (variables of different units).
+
+    Returns
+    -------
+    dict
+        Plotly figure.
+    """
+    ranges = tools.get_color_ranges(values, common_scale)
+
+    line = {"color": tools.get_plotly_colors(values[:, 0]),
+            "cmin": ranges[0][0],
+            "cmax": ranges[0][1],
+            "showscale": True,
+            "width": 12}
+    if colorscale is not None:
+        line["colorscale"] = colorscale
+
+    trace = {"type": "scatter3d",
+             "x": genome_data["x"].tolist(),
+             "y": genome_data["y"].tolist(),
+             "z": genome_data["z"].tolist(),
+             "mode": "lines",
+             "name": "",
+             "line": line,
+             "customdata": genome_data["Feature_name"].fillna("").tolist(),
+             "hovertemplate": "<b>YORF :</b> %{customdata} <br>",
+             "hoverlabel": {"bgcolor": "white", "font": {"size": 16}}}
+
+    layout = {"scene": {"xaxis": {"showgrid": False, "backgroundcolor": "white"},
+                        "yaxis": {"showgrid": False, "backgroundcolor": "white"},
+                        "zaxis": {"showgrid": False, "backgroundcolor": "white"}},
+              "height": 800,
+              "title": {"text": str(names[0])}}
+
+    figure = {"data": [trace], "layout": layout}
+
+    if len(names) > 1:
+        figure["frames"] = [{"name": str(name),
+                             "data": [{"type": "scatter3d", "line": {"color": tools.get_plotly_colors(values[:, i]),
+                                                                     "cmin": ranges[i][0], "cmax": ranges[i][1]}}],
+                             "traces": [0],
+                             "layout": {"title": {"text": str(name)}}}
+                            for i, name in enumerate(names)]
+        layout.update(tools.get_animation_layout(names))
+
+    return figure
+
+#Figures computed by the background jobs (lib.jobs): progress(fraction) is called between their steps
+
+def draw_genes_3D(database, plotly_segments, genes, go_term, color, progress=None):
+    """Draw the 3D genome with a genes list in blue and its genes annotated with a GO slim term in color.
+
+    Parameters
+    ----------
+    database : str
+        Path to the SQLite database.
+    plotly_segments : Pandas dataframe
+        3D segments coordinates for Plotly visualization.
+    genes : list
+        YORF of the genes list, None to color all the genes annotated with the GO slim term.
+    go_term : str
+    color : str
+    progress : function
+        Called with the fraction of the drawing done.
+
+    Returns
+    -------
+    dict
+        Plotly figure as JSON: sent back by the job much faster than the figure object.
+    """
+    progress = progress or (lambda fraction: None)
+    selected_loci = tools.get_locus_info(database, SQL_QUERY_GO_TERM_LOCI.format(go_term))
+
+    if genes is not None:
+        all_loci = tools.get_locus_info(database, SQL_QUERY_LOCI)
+        progress(0.2)
+        loci = all_loci.assign(FT_target=all_loci.Feature_name.isin(genes))
+        loci = loci.assign(GoTerm=loci.Primary_SGDID.isin(selected_loci.Primary_SGDID))
+
+        loci.loc[loci.FT_target == True, "colors_parameters"]="Targets"
+        loci.loc[(loci.GoTerm == True) & (loci.FT_target == True), "colors_parameters"]=str(go_term)
+
+        loci_segments = plotly_segments.merge(loci, on="Primary_SGDID", how="left", copy=False)
+        loci_segments.index = range(1, len(loci_segments) + 1)
+        loci_segments = get_color_discreet_3D(loci_segments, "colors_parameters", [str(go_term), "Targets"], [str(color), "blue"])
+
+    else:
+        progress(0.2)
+        loci_segments = plotly_segments.merge(selected_loci, on="Primary_SGDID", how="left", copy=False)
+        loci_segments.index = range(1, len(loci_segments) + 1)
+        loci_segments = get_color_discreet_3D(loci_segments, "GO_slim_term", [str(go_term)], [str(color)])
+
+    progress(0.5)
+    return genome_drawing(loci_segments).to_plotly_json()
+
+def get_locus_variables(loci, data, selected_columns, smoothing, tracks, feature_name, locus_centroids, spatial_weights, crowding_track):
+    """Values of the uploaded variables and of the crowding tracks for loci (3D segments or 2D loci).
+
+    Parameters
+    ----------
+    loci : Pandas dataframe
+        Primary_SGDID and Feature_name of the loci (NaN between the 3D segments).
+    data : list
+        Rows of the uploaded table, the first selected column is the YORF.
+    selected_columns : list
+    smoothing : str
+        raw or smoothed (mean over the 3D neighbourhood), for the uploaded variables.
+    tracks : list
+        Crowding tracks, shown after the uploaded variables.
+    feature_name : Pandas dataframe
+        Primary_SGDID and Feature_name of all the loci.
+    locus_centroids, spatial_weights : see spatial.get_locus_centroids and spatial.get_spatial_weights
+    crowding_track : Pandas dataframe
+        Output of crowding.compute_crowding_track.
+
+    Returns
+    -------
+    values : numpy array
+        (loci, variables) values, NaN for loci without value.
+    names : list
+        Names of the variables.
+    """
+    variables = [str(column) for column in (selected_columns or [])[1:]]
+    tracks = [track for track in tracks or [] if track in crowding_track.columns]
+    # Locus centroid of each row, the rows without centroid point to the last (NaN) row
+    rows = locus_centroids.index.get_indexer(loci["Primary_SGDID"])
+    columns = []
+
+    if variables:
+        data = pd.DataFrame(data)
+        if smoothing == "smoothed":
+            locus_values = spatial.get_centroid_values(locus_centroids, feature_name, data, str(selected_columns[0]), variables)
+            locus_values = spatial.smooth_values(spatial_weights, locus_values)
+            columns.append(np.vstack([locus_values, np.full(len(variables), np.nan)])[rows])
+        else:
+            columns.append(get_values_3D(loci, data, str(selected_columns[0]), variables))
+
+    # Precomputed: no distance computation per request
+    if tracks:
+        columns.append(np.vstack([crowding_track[tracks].to_numpy(dtype=float), np.full(len(tracks), np.nan)])[rows])
+
+    names = variables + [crowding.get_track_label(track) for track in tracks]
+    return (np.hstack(columns) if columns else np.empty((len(loci), 0))), names
+
+def draw_variables_3D(database, plotly_segments, data, selected_columns, colorscale, smoothing, tracks,
+                      feature_name, locus_centroids, spatial_weights, crowding_track, progress=None):
+    """Draw the 3D genome colored by the uploaded variables and the crowding tracks, one animation frame each.
+
+    Parameters
+    ----------
+    database : str
+        Path to the SQLite database.
+    plotly_segments : Pandas dataframe
+        3D segments coordinates for Plotly visualization.
+    data, selected_columns, smoothing, tracks, feature_name, locus_centroids, spatial_weights, crowding_track :
+        See get_locus_variables.
+    colorscale : str
+        Plotly color scale name.
+    progress : function
+        Called with the fraction of the drawing done.
+
+    Returns
+    -------
+    dict
+        Plotly figure (output of genome_animation).
+    """
+    progress = progress or (lambda fraction: None)
+    whole_genome = tools.get_locus_info(database, SQL_QUERY_LITERATURE_LOCI)
+
+    whole_genome_segments = plotly_segments.merge(whole_genome, on="Primary_SGDID", how="left", copy=False)
+    whole_genome_segments.index = range(1, len(whole_genome_segments) + 1)
+    progress(0.2)
+
+    values, names = get_locus_variables(whole_genome_segments, data, selected_columns, smoothing, tracks,
+                                        feature_name, locus_centroids, spatial_weights, crowding_track)
+    progress(0.5)
+
+    # The tracks and the uploaded variables have different units
+    return genome_animation(whole_genome_segments, values, names, colorscale, common_scale=not tracks)
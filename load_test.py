@@ -0,0 +1,342 @@
+"""
+Replay the callback traffic of dashboard users against a running server and report the latencies.
+
+Each virtual user uploads a genes list on the "GO term projection" tab and submits it, then
+uploads it on the "3D distances histogram and network" tab, submits it and drags the threshold
+slider. The requests are the /_dash-update-component calls of the browser: the callbacks are read
+from /_dash-dependencies and fired, with the callbacks their outputs trigger, as the browser
+would (clientside callbacks excepted, the 3D chromosomes figure they load is requested as the browser
+does, revalidated with its ETag). The figures drawn by background jobs are polled until they are done. Run it against localhost with the synthetic data, e.g.
+
+    python make_synthetic_data.py --output ./synthetic_data/static
+    (cd synthetic_data && ln -s ../example_data . && mkdir -p logs && gunicorn --config ../gunicorn.py --pythonpath .. app:server)
+    python load_test.py --url http://127.0.0.1:8000 --users 8 --server-pid <gunicorn master pid>
+
+The report gives the p50/p95/p99 latency and the compressed response size of each callback,
+the throughput, the error rate and the resident memory of the server processes (with --server-pid).
+"""
+
+import argparse
+import base64
+import gzip
+import json
+import os
+import sqlite3
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import numpy as np
+import pandas as pd
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8050",
+                        help="dashboard URL (default: %(default)s)")
+    parser.add_argument("--users", type=int, default=4,
+                        help="number of concurrent virtual users (default: %(default)s)")
+    parser.add_argument("--iterations", type=int, default=3,
+                        help="number of scenarios run by each user (default: %(default)s)")
+    parser.add_argument("--ramp-up", type=float, default=5,
+                        help="seconds over which the users start (default: %(default)s)")
+    parser.add_argument("--think-time", type=float, default=0.5,
+                        help="mean pause (seconds) between two user actions (default: %(default)s)")
+    parser.add_argument("--slider-steps", type=int, default=10,
+                        help="number of threshold slider positions per scenario (default: %(default)s)")
+    parser.add_argument("--genes-list", default="./example_data/gene_list_example_UPC2_38_targets.csv",
+                        help="genes list uploaded by the users, first column (default: %(default)s)")
+    parser.add_argument("--database", default=None,
+                        help="SCERE.db of the server data: each scenario then uploads a random list of --list-size loci")
+    parser.add_argument("--list-size", type=int, default=200,
+                        help="size of the random genes lists (default: %(default)s)")
+    parser.add_argument("--server-pid", type=int, default=None,
+                        help="pid of the server (e.g. gunicorn master), its resident memory and the one of its children is sampled")
+    parser.add_argument("--accept-encoding", default="gzip",
+                        help="Accept-Encoding of the requests: gzip, br (requires brotli) or '' for uncompressed responses (default: %(default)s)")
+    parser.add_argument("--timeout", type=float, default=300,
+                        help="request timeout in seconds (default: %(default)s)")
+    parser.add_argument("--output", default=None,
+                        help="JSON file of the results")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="random generator seed (default: %(default)s)")
+    return parser.parse_args()
+
+def get_genes_lists(args):
+    """Genes lists uploaded by the scenarios (one list, or random lists of loci of the database)."""
+    if args.database is None:
+        genes = pd.read_csv(args.genes_list).iloc[:, 0].dropna().astype(str).tolist()
+        return lambda rng: genes
+
+    with sqlite3.connect(args.database) as connection:
+        loci = pd.read_sql_query("SELECT Feature_name FROM SGD_features WHERE Strand IN ('W', 'C')", connection)["Feature_name"].to_numpy()
+    return lambda rng: rng.choice(loci, min(args.list_size, len(loci)), replace=False).tolist()
+
+def get_rss(pid):
+    """Resident memory (bytes) of a process and its descendants, 0 if it is gone."""
+    total = 0
+    pids = [pid]
+    while pids:
+        pid = pids.pop()
+        try:
+            with open("/proc/{}/status".format(pid)) as status:
+                total += next(int(line.split()[1]) * 1024 for line in status if line.startswith("VmRSS:"))
+            for task in os.listdir("/proc/{}/task".format(pid)):
+                with open("/proc/{}/task/{}/children".format(pid, task)) as children:
+                    pids.extend(int(child) for child in children.read().split())
+        except (OSError, StopIteration):
+            continue
+    return total
+
+
+def decode(content, encoding):
+    if encoding == "gzip":
+        return gzip.decompress(content)
+    if encoding == "br":
+        import brotli
+        return brotli.decompress(content)
+    return content
+
+
+class Recorder:
+    """Thread-safe record of the request latencies, sizes and errors."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = []
+
+    def add(self, name, start, duration, error, received=0):
+        with self.lock:
+            self.records.append((name, start, duration, error, received))
+
+    def get_dataframe(self):
+        with self.lock:
+            return pd.DataFrame(self.records, columns=["callback", "start", "duration", "error", "received"])
+
+
+class DashSession:
+    """Dashboard client firing the server callbacks as the browser does.
+
+    Parameters
+    ----------
+    url : str
+        Dashboard URL.
+    dependencies : list
+        Callbacks of /_dash-dependencies.
+    recorder : Recorder
+        Record of the request latencies.
+    accept_encoding : str
+        Accept-Encoding header of the requests.
+    """
+
+    def __init__(self, url, dependencies, recorder, timeout=300, accept_encoding="gzip"):
+        self.url = url.rstrip("/")
+        self.dependencies = dependencies
+        self.recorder = recorder
+        self.timeout = timeout
+        self.accept_encoding = accept_encoding
+        # Browser side values of the component properties, "id.property": value
+        self.values = {}
+        # Browser cache: ETag of the GET responses, by path
+        self.etags = {}
+
+    def set(self, **values):
+        for key, value in values.items():
+            self.values[key.replace("__", ".")] = value
+
+    def fire(self, *triggers):
+        """Set the triggering properties, then call the callbacks they trigger and the callbacks triggered in turn."""
+        fired = set()
+        triggers = list(triggers)
+        while triggers:
+            changed = []
+            for callback in self.dependencies:
+                if callback["output"] in fired or "clientside_function" in callback and callback["clientside_function"]:
+                    continue
+                inputs = ["{}.{}".format(i["id"], i["property"]) for i in callback["inputs"]]
+                triggered = [prop for prop in triggers if prop in inputs]
+                if triggered:
+                    fired.add(callback["output"])
+                    changed.extend(self.call(callback, triggered))
+            triggers = changed
+
+    def poll(self, interval, period=0.5):
+        """Fire a dcc.Interval enabled by a callback (progress of a background job) until a callback disables it, as the browser does."""
+        while self.values.get(interval + ".disabled") is False:
+            time.sleep(period)
+            self.values[interval + ".n_intervals"] = (self.values.get(interval + ".n_intervals") or 0) + 1
+            self.fire(interval + ".n_intervals")
+
+    def call(self, callback, triggered):
+        outputs = [output.split(".") for output in callback["output"].strip(".").split("...")]
+        if callback["output"].startswith(".."):
+            outputs_spec = [{"id": i, "property": p} for i, p in outputs]
+        else:
+            outputs_spec = {"id": outputs[0][0], "property": outputs[0][1]}
+        body = {"output": callback["output"],
+                "outputs": outputs_spec,
+                "inputs": [dict(i, value=self.values.get("{}.{}".format(i["id"], i["property"]))) for i in callback["inputs"]],
+                "state": [dict(s, value=self.values.get("{}.{}".format(s["id"], s["property"]))) for s in callback["state"]],
+                "changedPropIds": triggered}
+        # Named after the first output
+        name = "{}.{}".format(*outputs[0]) + (" (+{})".format(len(outputs) - 1) if len(outputs) > 1 else "")
+        content = self.request(name, "/_dash-update-component", json.dumps(body).encode())
+        response = json.loads(content)["response"] if content else None
+
+        changed = []
+        for component_id, properties in (response or {}).items():
+            for prop, value in properties.items():
+                self.values["{}.{}".format(component_id, prop)] = value
+                changed.append("{}.{}".format(component_id, prop))
+        return changed
+
+    def request(self, name, path, data=None):
+        """POST data, or GET path with the ETag of the previous response. Record the latency and the size
+        of the response on the wire, return the decoded body (None on errors and empty responses)."""
+        headers = {"Accept-Encoding": self.accept_encoding} if self.accept_encoding else {}
+        if data is not None:
+            headers["Content-Type"] = "application/json"
+        elif path in self.etags:
+            headers["If-None-Match"] = self.etags[path]
+
+        start = time.time()
+        error = None
+        content = None
+        received = 0
+        try:
+            with urllib.request.urlopen(urllib.request.Request(self.url + path, data=data, headers=headers), timeout=self.timeout) as reply:
+                content = reply.read()
+                received = len(content)
+                if data is None and reply.headers.get("ETag"):
+                    self.etags[path] = reply.headers["ETag"]
+                content = decode(content, reply.headers.get("Content-Encoding"))
+        except urllib.error.HTTPError as exception:
+            # 204: the callback raised PreventUpdate, 304: the cached response is up to date
+            if exception.code not in (204, 304):
+                error = "HTTP {}".format(exception.code)
+        except (urllib.error.URLError, OSError, ValueError) as exception:
+            error = type(exception).__name__
+        self.recorder.add(name, start, time.time() - start, error, received)
+        return content
+
+
+def run_scenario(session, genes, args, rng):
+    """Upload and submit a genes list on the GO term projection and network tabs, then drag the threshold slider."""
+    contents = "data:text/csv;base64," + base64.b64encode(("genes\n" + "\n".join(genes) + "\n").encode()).decode()
+    table = [{"genes": gene} for gene in genes]
+
+    def think():
+        time.sleep(rng.exponential(args.think_time) if args.think_time > 0 else 0)
+
+    # GO term projection tab
+    session.set(upload_data_tab1__filename=["genes.csv"], upload_data_tab1__contents=[contents])
+    session.fire("upload_data_tab1.contents")
+    # The uploaded table, its first column selected
+    session.set(datatable_tab1__derived_virtual_data=table, datatable_tab1__selected_columns=["genes"])
+    session.fire("datatable_tab1.selected_columns")
+    think()
+    session.set(Submit_tab1__n_clicks=session.values.get("Submit_tab1.n_clicks", 0) + 1)
+    session.fire("Submit_tab1.n_clicks")
+    # The 3D figure is drawn by a background job
+    session.poll("3D_interval_tab1")
+    # Loaded by a clientside callback of the submit
+    session.request("figures/chromosomes_3D", "/figures/chromosomes_3D")
+    think()
+
+    # 3D distances histogram and network tab
+    session.set(upload_data_tab3__filename=["genes.csv"], upload_data_tab3__contents=[contents])
+    session.fire("upload_data_tab3.contents")
+    session.set(datatable_tab3__derived_virtual_data=table, datatable_tab3__selected_columns=["genes"])
+    session.fire("datatable_tab3.selected_columns")
+    think()
+    session.set(Submit_tab3__n_clicks=session.values.get("Submit_tab3.n_clicks", 0) + 1)
+    session.fire("Submit_tab3.n_clicks")
+    session.poll("hist_interval_tab3")
+
+    # Slider drags, between the bounds set by the submit
+    low = session.values.get("treshold_slider.min") or 0
+    high = session.values.get("treshold_slider.max") or 200
+    for value in rng.uniform(low, high, args.slider_steps):
+        think()
+        session.set(treshold_slider__value=round(float(value), 1))
+        session.fire("treshold_slider.value")
+        session.poll("hist_interval_tab3")
+
+def run_user(user, dependencies, recorder, get_genes, args):
+    rng = np.random.default_rng([args.seed, user])
+    time.sleep(args.ramp_up * user / max(args.users, 1))
+    session = DashSession(args.url, dependencies, recorder, args.timeout, args.accept_encoding)
+    # Layout defaults of the properties read by the scenario callbacks
+    session.set(**{"GoTerm-dropdown__value": None, "color-dropdown__value": None, "go_term_click__data": None,
+                   "treshold_slider__value": 50, "lists_statistic_tab3__value": "median"})
+    for _ in range(args.iterations):
+        run_scenario(session, get_genes(rng), args, rng)
+
+def sample_rss(pid, samples, stop):
+    while not stop.is_set():
+        samples.append((time.time(), get_rss(pid)))
+        stop.wait(0.5)
+
+def get_report(records, duration):
+    """Latency percentiles (ms), response size (kB, on the wire), calls and errors of each callback, with a total row."""
+    records = records.assign(duration=records["duration"] * 1000, failed=records["error"].notna())
+    groups = list(records.groupby("callback")) + [("TOTAL", records)]
+    rows = []
+    for name, group in groups:
+        rows.append({"callback": name,
+                     "calls": len(group),
+                     "errors": int(group["failed"].sum()),
+                     "p50_ms": group["duration"].quantile(0.5),
+                     "p95_ms": group["duration"].quantile(0.95),
+                     "p99_ms": group["duration"].quantile(0.99),
+                     "max_ms": group["duration"].max(),
+                     "mean_kB": group["received"].mean() / 1000,
+                     "per_second": len(group) / duration})
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    get_genes = get_genes_lists(args)
+
+    with urllib.request.urlopen(args.url.rstrip("/") + "/_dash-dependencies", timeout=args.timeout) as reply:
+        dependencies = json.loads(reply.read())
+
+    recorder = Recorder()
+    rss_samples = []
+    stop = threading.Event()
+    if args.server_pid is not None:
+        threading.Thread(target=sample_rss, args=(args.server_pid, rss_samples, stop), daemon=True).start()
+
+    start = time.time()
+    users = [threading.Thread(target=run_user, args=(user, dependencies, recorder, get_genes, args))
+             for user in range(args.users)]
+    for user in users:
+        user.start()
+    for user in users:
+        user.join()
+    duration = time.time() - start
+    stop.set()
+
+    records = recorder.get_dataframe()
+    report = get_report(records, duration)
+    pd.set_option("display.width", 200)
+    print(report.to_string(index=False, float_format="{:.1f}".format))
+    print("{} users, {} requests in {:.1f} s: {:.1f} requests/s, {:.2%} errors".format(
+        args.users, len(records), duration, len(records) / duration, records["error"].notna().mean() if len(records) else 0))
+    errors = records["error"].dropna().value_counts()
+    if len(errors):
+        print("errors: " + ", ".join("{} ({})".format(error, count) for error, count in errors.items()))
+    print("{:.1f} MB received, {:.1f} MB per scenario".format(records["received"].sum() / 1e6,
+                                                               records["received"].sum() / 1e6 / (args.users * args.iterations)))
+    if rss_samples:
+        rss = np.array([sample for _, sample in rss_samples]) / 2**20
+        print("server RSS: {:.0f} MiB at start, {:.0f} MiB peak, {:.0f} MiB at end".format(rss[0], rss.max(), rss[-1]))
+
+    if args.output is not None:
+        with open(args.output, "w") as output_file:
+            json.dump({"arguments": vars(args),
+                       "duration": duration,
+                       "callbacks": report.to_dict("records"),
+                       "rss": rss_samples}, output_file, indent=2)
@@ -0,0 +1,216 @@
+"""
+Generate synthetic reference data with the schema of the dashboard data files.
+
+The output directory has the layout of the repository static/ directory
+(SCERE.db with the SGD_features, go_slim_mapping, gene_literature and chromosome_length
+tables, plotly_segments.csv, 3D_distances.parquet.gzip, GO_terms.csv and, with --models,
+an ensemble of 3D models in models/), so that the
+dashboard, the command-line tools and benchmark.py can run on it. --scale 1 is about the
+size of the S. cerevisiae data, --scale 10 and 100 stress the code with more loci.
+
+The 3D model is a random walk per chromosome inside a spherical nucleus: the data is
+only meant to exercise the code paths at a given size, not to be biologically realistic.
+The other models of an ensemble are the first one with noise added to the coordinates.
+"""
+
+import argparse
+import os
+import sqlite3
+import time
+
+import numpy as np
+import pandas as pd
+
+import lib.distances as distances
+import lib.ensembles as ensembles
+
+# S. cerevisiae chromosome lengths (bp), chromosome 17 is the mitochondrial genome
+CHROMOSOME_LENGTHS = [230218, 813184, 316620, 1531933, 576874, 270161, 1090940, 562643,
+                      439888, 745751, 666816, 1078177, 924431, 784333, 1091291, 948066, 85779]
+CHROMOSOME_LETTERS = "ABCDEFGHIJKLMNOPQ"
+
+# Loci with 3D segments and other features (filtered out by tools.get_locus_info) at scale 1
+LOCI_NUMBER = 9000
+OTHER_FEATURES_NUMBER = 1500
+
+NUCLEUS_CENTER = np.array([105.0, 75.0, 94.0])
+NUCLEUS_RADIUS = 70.0
+# Standard deviation of the noise added to the coordinates of the other models of an ensemble
+MODEL_NOISE = 3.0
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", default="./synthetic_data/static",
+                        help="output directory (default: %(default)s)")
+    parser.add_argument("--scale", type=float, default=1,
+                        help="number of loci relative to the S. cerevisiae data (default: %(default)s)")
+    parser.add_argument("--distance-loci", type=int, default=LOCI_NUMBER,
+                        help="maximum number of loci in the 3D distances file, the number of pairs grows quadratically (default: %(default)s)")
+    parser.add_argument("--go-terms", default="./static/GO_terms.csv",
+                        help="GO slim terms list (default: %(default)s)")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="number of worker processes for the 3D distances (default: %(default)s)")
+    parser.add_argument("--models", type=int, default=0,
+                        help="number of models of the 3D models ensemble, none if 0 (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="random generator seed (default: %(default)s)")
+    return parser.parse_args()
+
+def make_features(loci_number, other_number, rng):
+    """Generate the SGD_features table.
+
+    Returns
+    -------
+    Pandas dataframe
+        Same columns as SGD_features. Loci (ORF on the W or C strand) come first,
+        sorted by chromosome and start coordinate, then the other features.
+    """
+    lengths = np.array(CHROMOSOME_LENGTHS, dtype=float)
+    # Loci per chromosome proportional to the chromosome length, the genome is scaled with the loci
+    loci_per_chromosome = np.maximum(np.round(loci_number * lengths / lengths.sum()).astype(int), 1)
+    scale = loci_per_chromosome.sum() / LOCI_NUMBER
+
+    features = []
+    for chromosome, (number, length) in enumerate(zip(loci_per_chromosome, lengths), start=1):
+        length = int(length * max(scale, 1))
+        starts = np.sort(rng.choice(np.arange(1, length - 3000, 16), number, replace=False))
+        stops = starts + rng.integers(300, 3000, number)
+        strands = rng.choice(["W", "C"], number)
+        # Systematic names as YAL001C: chromosome letter, arm (L/R of the middle), rank from the middle
+        arms = np.where(np.arange(number) < number // 2, "L", "R")
+        ranks = np.where(arms == "L", number // 2 - np.arange(number), np.arange(number) - number // 2 + 1)
+        names = ["Y{}{}{:03d}{}".format(CHROMOSOME_LETTERS[chromosome - 1], arm, rank, strand)
+                 for arm, rank, strand in zip(arms, ranks, strands)]
+
+        features.append(pd.DataFrame({"Feature_type": "ORF",
+                                      "Feature_name": names,
+                                      "Chromosome": str(chromosome),
+                                      "Start_coordinate": np.where(strands == "W", starts, stops),
+                                      "Stop_coordinate": np.where(strands == "W", stops, starts),
+                                      "Strand": strands}))
+    features = pd.concat(features, ignore_index=True)
+
+    # Features without strand and 2-micron plasmid genes
+    other = pd.DataFrame({"Feature_type": rng.choice(["ARS", "centromere", "telomere", "tRNA gene"], other_number),
+                          "Feature_name": ["SYN{:07d}".format(i) for i in range(other_number)],
+                          "Chromosome": rng.choice([str(c) for c in range(1, 17)] + ["2-micron"], other_number),
+                          "Start_coordinate": rng.integers(1, 200000, other_number),
+                          "Stop_coordinate": rng.integers(1, 200000, other_number),
+                          "Strand": rng.choice(["", "0"], other_number)})
+    features = pd.concat([features, other], ignore_index=True)
+
+    features.insert(0, "Primary_SGDID", ["S{:09d}".format(i) for i in rng.permutation(len(features))])
+    standard_names = pd.Series(["SYN{}".format(i) for i in range(len(features))])
+    features["Standard_gene_name"] = standard_names.where(rng.random(len(features)) < 0.6)
+    features["Description"] = ["Synthetic feature {}".format(i) for i in range(len(features))]
+
+    return features[["Primary_SGDID", "Feature_type", "Feature_name", "Standard_gene_name", "Chromosome",
+                     "Start_coordinate", "Stop_coordinate", "Strand", "Description"]]
+
+def make_segments(loci, rng):
+    """Generate the 3D segments of the loci: a random walk per chromosome inside the nucleus.
+
+    Returns
+    -------
+    Pandas dataframe
+        x, y, z and Primary_SGDID, two rows per segment followed by a row with missing
+        coordinates (as static/plotly_segments.csv). Consecutive segments share their ends.
+    """
+    segments = []
+    for _, chromosome in loci.groupby("Chromosome", sort=False):
+        low = np.minimum(chromosome["Start_coordinate"], chromosome["Stop_coordinate"]).to_numpy()
+        chromosome = chromosome.iloc[np.argsort(low, kind="stable")]
+        segments_number = 1 + (chromosome["Start_coordinate"] - chromosome["Stop_coordinate"]).abs().to_numpy() // 1000
+
+        # Random walk, points outside the nucleus are projected back on its surface
+        start = NUCLEUS_CENTER + rng.normal(0, NUCLEUS_RADIUS / 3, 3)
+        points = start + np.cumsum(rng.normal(0, 0.6, (segments_number.sum() + 1, 3)), axis=0)
+        radius = np.linalg.norm(points - NUCLEUS_CENTER, axis=1, keepdims=True)
+        points = np.where(radius > NUCLEUS_RADIUS, NUCLEUS_CENTER + (points - NUCLEUS_CENTER) * NUCLEUS_RADIUS / radius, points)
+
+        # Rows: start, end, separator for each segment
+        sgdids = np.repeat(chromosome["Primary_SGDID"].to_numpy(), segments_number)
+        xyz = np.empty((3 * len(sgdids), 3))
+        xyz[0::3] = points[:-1]
+        xyz[1::3] = points[1:]
+        xyz[2::3] = np.nan
+        segments.append(pd.DataFrame({"x": xyz[:, 0], "y": xyz[:, 1], "z": xyz[:, 2],
+                                      "Primary_SGDID": np.repeat(sgdids, 3)}))
+
+    return pd.concat(segments, ignore_index=True)
+
+def make_go_mapping(features, terms, rng):
+    """Generate the go_slim_mapping table: 1 to 7 terms per locus, some terms much more frequent than others."""
+    loci = features[features["Strand"].isin(["W", "C"])]
+    terms_number = rng.integers(1, 8, len(loci))
+    popularity = 1 / np.arange(1, len(terms) + 1)
+    popularity = rng.permutation(popularity / popularity.sum())
+    aspects = rng.choice(["P", "F", "C"], len(terms))
+
+    term_codes = np.concatenate([rng.choice(len(terms), number, replace=False, p=popularity) for number in terms_number])
+    rows = np.repeat(np.arange(len(loci)), terms_number)
+
+    return pd.DataFrame({"ORF": loci["Feature_name"].to_numpy()[rows],
+                         "SGDID": loci["Primary_SGDID"].to_numpy()[rows],
+                         "GO_aspect": aspects[term_codes],
+                         "GO_slim_term": np.asarray(terms, dtype=object)[term_codes]})
+
+def make_literature(features, rng):
+    """Generate the gene_literature table: 0 to 5 topics per locus."""
+    topics_number = rng.integers(0, 6, len(features))
+    rows = np.repeat(np.arange(len(features)), topics_number)
+
+    return pd.DataFrame({"SGDID": features["Primary_SGDID"].to_numpy()[rows],
+                         "Literature_topic": rng.choice(["Primary Literature", "Additional Literature", "Reviews"], len(rows))})
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    rng = np.random.default_rng(args.seed)
+    os.makedirs(args.output, exist_ok=True)
+    start = time.perf_counter()
+
+    if os.path.exists(args.go_terms):
+        terms = pd.read_csv(args.go_terms)["GO_terms"].tolist()
+    else:
+        terms = ["synthetic GO term {}".format(i) for i in range(170)]
+    pd.DataFrame({"GO_terms": terms}).to_csv(os.path.join(args.output, "GO_terms.csv"), index=False)
+
+    features = make_features(int(LOCI_NUMBER * args.scale), int(OTHER_FEATURES_NUMBER * args.scale), rng)
+    loci = features[features["Strand"].isin(["W", "C"])]
+    lengths = loci.assign(Chromosome=loci["Chromosome"].astype(int),
+                          end=loci[["Start_coordinate", "Stop_coordinate"]].max(axis=1)).groupby("Chromosome")["end"].max()
+
+    database = os.path.join(args.output, "SCERE.db")
+    if os.path.exists(database):
+        os.remove(database)
+    with sqlite3.connect(database) as connection:
+        features.to_sql("SGD_features", connection, index=False)
+        make_go_mapping(features, terms, rng).to_sql("go_slim_mapping", connection, index=False)
+        make_literature(features, rng).to_sql("gene_literature", connection, index=False)
+        pd.DataFrame({"chromosome": np.arange(1, 18),
+                      "length": (lengths.reindex(range(1, 18)).fillna(0) + 1000).astype(int).to_numpy()}).to_sql("chromosome_length", connection, index=False)
+    print("loci: {} ({} features)".format(len(loci), len(features)))
+
+    segments = make_segments(loci, rng)
+    segments.to_csv(os.path.join(args.output, "plotly_segments.csv"), index=False)
+    print("segments: {}".format(len(segments) // 3))
+
+    distance_loci = loci["Primary_SGDID"].iloc[np.sort(rng.permutation(len(loci))[:args.distance_loci])]
+    geometry = distances.get_locus_geometry(segments, distance_loci)
+    pairs_number = distances.write_distance_edges(os.path.join(args.output, "3D_distances.parquet.gzip"), geometry, processes=args.processes)
+    print("3D distances: {} pairs".format(pairs_number))
+
+    if args.models > 0:
+        models_directory = os.path.join(args.output, "models")
+        ensembles.write_ensemble_loci(models_directory, geometry["sgdids"])
+        for model in range(args.models):
+            model_segments = segments.copy()
+            if model > 0:
+                model_segments[["x", "y", "z"]] += rng.normal(0, MODEL_NOISE, (len(segments), 3))
+            ensembles.write_model(os.path.join(models_directory, "model_{}".format(model + 1)),
+                                  distances.get_locus_geometry(model_segments, geometry["sgdids"]), geometry["sgdids"])
+        print("3D models ensemble: {} models".format(args.models))
+
+    print("written to {} in {:.1f} s".format(args.output, time.perf_counter() - start))